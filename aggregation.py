@@ -0,0 +1,285 @@
+"""
+Motor de agregación factorizado para las tablas de producto, tienda y tienda×cluster
+Convierte una sola vez los identificadores de producto, tienda y cluster en
+códigos enteros y calcula todas las tablas con reducciones vectorizadas
+(np.bincount) sobre esos códigos, en lugar de varios groupby, pivot_table y
+merge sobre las mismas filas. Las tablas resultantes son las mismas que las
+de los groupby de pandas.
+"""
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed, effective_n_jobs
+
+# Máximo de celdas grupo×valor para contar distintos con una matriz densa
+DENSE_PAIR_LIMIT = 50_000_000
+
+OUTLET_ATTRIBUTES = [
+    'Outlet_Type',
+    'Outlet_Size',
+    'Outlet_Location_Type',
+    'Outlet_Establishment_Year'
+]
+
+
+def factorize_sales(df_clean):
+    """Códigos enteros de producto y tienda para cada fila de ventas
+
+    Devuelve un diccionario con los códigos, los valores únicos ordenados y
+    las medidas en float64 que usan las reducciones.
+    """
+    item_codes, items = pd.factorize(df_clean['Item_Identifier'], sort=True)
+    outlet_codes, outlets = pd.factorize(df_clean['Outlet_Identifier'], sort=True)
+    return {
+        'item_codes': item_codes,
+        'items': items,
+        'outlet_codes': outlet_codes,
+        'outlets': outlets,
+        'sales': df_clean['Item_Outlet_Sales'].to_numpy(dtype='float64', na_value=np.nan),
+        'mrp': df_clean['Item_MRP'].to_numpy(dtype='float64', na_value=np.nan)
+    }
+
+
+def _sum_count(codes, values, n_groups):
+    """Suma y número de valores no nulos por grupo"""
+    valid = ~np.isnan(values)
+    sums = np.bincount(codes[valid], weights=values[valid], minlength=n_groups)
+    counts = np.bincount(codes[valid], minlength=n_groups)
+    return sums, counts
+
+
+def _divide(numerator, denominator):
+    """División elemento a elemento con NaN cuando el denominador es 0"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+def _mean(codes, values, n_groups):
+    sums, counts = _sum_count(codes, values, n_groups)
+    return _divide(sums, counts)
+
+
+def _nunique(group_codes, value_codes, n_groups, n_values):
+    """Número de valores distintos por grupo (pares únicos grupo-valor)"""
+    pairs = group_codes.astype(np.int64) * n_values + value_codes
+    if n_groups * n_values <= DENSE_PAIR_LIMIT:
+        # Marcar los pares presentes en una matriz densa evita ordenar
+        present = np.zeros(n_groups * n_values, dtype=bool)
+        present[pairs] = True
+        return present.reshape(n_groups, n_values).sum(axis=1)
+    pairs = np.unique(pairs)
+    return np.bincount(pairs // n_values, minlength=n_groups)
+
+
+def _first_valid(codes, values, n_groups):
+    """Primer valor no nulo de cada grupo (como 'first' en groupby)"""
+    valid = np.flatnonzero(values.notna().to_numpy())
+    positions = np.full(n_groups, len(values))
+    np.minimum.at(positions, codes[valid], valid)
+    found = positions < len(values)
+    result = values.iloc[np.where(found, positions, 0)].reset_index(drop=True)
+    return result.where(pd.Series(found))
+
+
+def product_table(df_clean, codes=None):
+    """Agregar las ventas a nivel producto con reducciones sobre los códigos"""
+    if codes is None:
+        codes = factorize_sales(df_clean)
+    item_codes = codes['item_codes']
+    n_items = len(codes['items'])
+
+    sales_sum, sales_count = _sum_count(item_codes, codes['sales'], n_items)
+    sales_mean = _divide(sales_sum, sales_count)
+
+    # Desviación estándar muestral en dos pasadas (NaN con un solo registro)
+    valid = ~np.isnan(codes['sales'])
+    deviation = codes['sales'][valid] - sales_mean[item_codes[valid]]
+    m2 = np.bincount(item_codes[valid], weights=deviation ** 2, minlength=n_items)
+    sales_std = np.sqrt(_divide(m2, sales_count - 1))
+
+    weight = df_clean['Item_Weight'].to_numpy(dtype='float64', na_value=np.nan)
+    visibility = df_clean['Item_Visibility'].to_numpy(dtype='float64', na_value=np.nan)
+
+    return pd.DataFrame({
+        'Item_Identifier': codes['items'],
+        'Total_Sales': sales_sum,
+        'Avg_Sales_Per_Store': sales_mean,
+        'Std_Sales': sales_std,
+        'Num_Store_Records': sales_count.astype('int64'),
+        'Avg_MRP': _mean(item_codes, codes['mrp'], n_items),
+        'Avg_Weight': _mean(item_codes, weight, n_items),
+        'Avg_Visibility': _mean(item_codes, visibility, n_items),
+        'Num_Stores': _nunique(item_codes, codes['outlet_codes'], n_items, len(codes['outlets'])).astype('int64'),
+        'Item_Type': _first_valid(item_codes, df_clean['Item_Type'], n_items),
+        'Item_Fat_Content': _first_valid(item_codes, df_clean['Item_Fat_Content'], n_items)
+    })
+
+
+def row_clusters(product_metrics, codes):
+    """Cluster de cada fila de ventas a partir del cluster de su producto"""
+    clusters_by_item = product_metrics.set_index('Item_Identifier')['cluster_producto']
+    item_clusters = clusters_by_item.reindex(np.asarray(codes['items'], dtype=object))
+    return item_clusters.to_numpy()[codes['item_codes']]
+
+
+def _store_cells(outlet_codes, item_codes, cluster_codes, sales, mrp, attribute_valid,
+                 n_outlets, n_items, n_clusters):
+    """Reducciones por tienda×cluster y por tienda sobre un conjunto de filas
+
+    Los códigos de tienda son locales (0..n_outlets-1), de modo que la misma
+    función sirve para todas las filas o para un fragmento de tiendas.
+    attribute_valid es una matriz filas×atributos con los valores no nulos;
+    se devuelve la posición (dentro de estas filas) del primer valor válido
+    de cada atributo por tienda.
+    """
+    # Celdas tienda×cluster (las filas sin cluster no forman celda)
+    has_cluster = cluster_codes >= 0
+    cell_codes = outlet_codes[has_cluster] * n_clusters + cluster_codes[has_cluster]
+    n_cells = n_outlets * n_clusters
+    cell_sales, cell_count = _sum_count(cell_codes, sales[has_cluster], n_cells)
+    store_sales, _ = _sum_count(outlet_codes, sales, n_outlets)
+
+    n_rows = len(outlet_codes)
+    first_positions = np.full((n_outlets, attribute_valid.shape[1]), n_rows)
+    for j in range(attribute_valid.shape[1]):
+        valid = np.flatnonzero(attribute_valid[:, j])
+        np.minimum.at(first_positions[:, j], outlet_codes[valid], valid)
+
+    return {
+        'cell_rows': np.bincount(cell_codes, minlength=n_cells),
+        'cell_sales': cell_sales,
+        'cell_count': cell_count,
+        'cell_mrp': _mean(cell_codes, mrp[has_cluster], n_cells),
+        'cell_items': _nunique(cell_codes, item_codes[has_cluster], n_cells, n_items),
+        'store_sales': store_sales,
+        'store_items': _nunique(outlet_codes, item_codes, n_outlets, n_items),
+        'first_positions': first_positions
+    }
+
+
+def _shard_bounds(outlet_counts, n_shards):
+    """Cortes de tiendas consecutivas en fragmentos con filas similares"""
+    cumulative = np.cumsum(outlet_counts)
+    targets = cumulative[-1] * np.arange(1, n_shards) / n_shards
+    cuts = np.searchsorted(cumulative, targets, side='left') + 1
+    return np.unique(np.concatenate([[0], np.clip(cuts, 0, len(outlet_counts)), [len(outlet_counts)]]))
+
+
+def _sharded_store_cells(outlet_codes, item_codes, cluster_codes, sales, mrp, attribute_valid,
+                         n_outlets, n_items, n_clusters, n_jobs, n_shards):
+    """_store_cells repartido por fragmentos de tiendas en un pool de procesos
+
+    Las filas se ordenan por tienda de forma estable, así que dentro de cada
+    tienda conservan su orden original y las sumas son idénticas a las de
+    la pasada única. Los resultados de los fragmentos se concatenan.
+    """
+    order = np.argsort(outlet_codes, kind='stable')
+    bounds = _shard_bounds(np.bincount(outlet_codes, minlength=n_outlets), n_shards)
+    row_bounds = np.searchsorted(outlet_codes[order], bounds)
+
+    def shard_args(i):
+        rows = order[row_bounds[i]:row_bounds[i + 1]]
+        first, last = bounds[i], bounds[i + 1]
+        return (outlet_codes[rows] - first, item_codes[rows], cluster_codes[rows], sales[rows],
+                mrp[rows], attribute_valid[rows], last - first, n_items, n_clusters)
+
+    shards = Parallel(n_jobs=n_jobs)(
+        delayed(_store_cells)(*shard_args(i)) for i in range(len(bounds) - 1)
+    )
+
+    cells = {
+        key: np.concatenate([shard[key] for shard in shards])
+        for key in shards[0] if key != 'first_positions'
+    }
+    # Posiciones locales del fragmento -> posiciones en las filas originales
+    first_positions = []
+    for i, shard in enumerate(shards):
+        rows = order[row_bounds[i]:row_bounds[i + 1]]
+        positions = shard['first_positions']
+        found = positions < len(rows)
+        first_positions.append(np.where(found, rows[np.minimum(positions, max(len(rows) - 1, 0))],
+                                        len(outlet_codes)))
+    cells['first_positions'] = np.concatenate(first_positions)
+    return cells
+
+
+def store_tables(df_clean, product_metrics, codes=None, include_rows=True, n_jobs=1, n_shards=None):
+    """Calcular df_with_clusters, store_cluster_analysis y store_analysis
+
+    Equivale al merge de cluster_producto sobre las filas seguido de los
+    groupby por tienda×cluster y por tienda y del pivot de porcentajes
+    Pct_Cluster_<k>, pero en una sola pasada sobre los códigos enteros.
+    Con include_rows=False no se copia el dataset de filas y
+    df_with_clusters se devuelve como None.
+
+    Con n_jobs distinto de 1 las filas se reparten por tienda en n_shards
+    fragmentos (por defecto, uno por proceso) que se calculan en paralelo;
+    el resultado es idéntico al de la pasada única.
+    """
+    if codes is None:
+        codes = factorize_sales(df_clean)
+    outlet_codes = codes['outlet_codes']
+    n_outlets = len(codes['outlets'])
+    n_items = len(codes['items'])
+
+    row_cluster_values = row_clusters(product_metrics, codes)
+    df_with_clusters = None
+    if include_rows:
+        df_with_clusters = df_clean.assign(cluster_producto=row_cluster_values)
+
+    cluster_codes, clusters = pd.factorize(row_cluster_values, sort=True)
+    n_clusters = len(clusters)
+    n_cells = n_outlets * n_clusters
+    attribute_valid = np.column_stack([df_clean[col].notna().to_numpy() for col in OUTLET_ATTRIBUTES])
+
+    args = (outlet_codes, codes['item_codes'], cluster_codes, codes['sales'], codes['mrp'],
+            attribute_valid, n_outlets, n_items, n_clusters)
+    if n_jobs == 1 and n_shards is None:
+        cells = _store_cells(*args)
+    else:
+        n_shards = n_shards or max(1, effective_n_jobs(n_jobs))
+        cells = _sharded_store_cells(*args, n_jobs=n_jobs, n_shards=min(n_shards, n_outlets))
+    cell_sales = cells['cell_sales']
+    cell_count = cells['cell_count']
+    store_sales = cells['store_sales']
+
+    observed = np.flatnonzero(cells['cell_rows'] > 0)
+    cell_outlets = observed // n_clusters
+    store_cluster_analysis = pd.DataFrame({
+        'Outlet_Identifier': codes['outlets'][cell_outlets],
+        'cluster_producto': clusters[observed % n_clusters],
+        'Total_Sales_Cluster': cell_sales[observed],
+        'Avg_Sales_Per_Product': _divide(cell_sales, cell_count)[observed],
+        'Num_Records': cell_count[observed].astype('int64'),
+        'Num_Unique_Products': cells['cell_items'][observed].astype('int64'),
+        'Avg_MRP': cells['cell_mrp'][observed],
+        'Store_Total_Sales': store_sales[cell_outlets]
+    })
+    store_cluster_analysis['Pct_Sales_From_Cluster'] = (
+        store_cluster_analysis['Total_Sales_Cluster'] /
+        store_cluster_analysis['Store_Total_Sales'] * 100
+    )
+
+    # Dataset a nivel tienda con la mezcla de clusters en columnas
+    store_analysis = pd.DataFrame({
+        'Outlet_Identifier': codes['outlets'],
+        'Total_Sales': store_sales
+    })
+    n_rows = len(outlet_codes)
+    for j, col in enumerate(OUTLET_ATTRIBUTES):
+        # Primer valor no nulo de cada tienda (como 'first' en groupby)
+        positions = cells['first_positions'][:, j]
+        found = positions < n_rows
+        values = df_clean[col].iloc[np.where(found, positions, 0)].reset_index(drop=True)
+        store_analysis[col] = values.where(pd.Series(found))
+    store_analysis['Num_Unique_Products'] = cells['store_items'].astype('int64')
+
+    pct = np.zeros(n_cells)
+    pct[observed] = store_cluster_analysis['Pct_Sales_From_Cluster'].to_numpy()
+    pct = pct.reshape(n_outlets, n_clusters)
+    for j, cluster in enumerate(clusters):
+        store_analysis[f'Pct_Cluster_{int(cluster)}'] = pct[:, j]
+    # Como en el pivot, solo las tiendas con alguna celda tienda×cluster
+    store_analysis = store_analysis[np.bincount(cell_outlets, minlength=n_outlets) > 0].reset_index(drop=True)
+
+    return df_with_clusters, store_cluster_analysis, store_analysis
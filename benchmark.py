@@ -0,0 +1,199 @@
+"""
+Benchmark por etapas del pipeline de segmentación
+Genera datos sintéticos a una o varias escalas (synthetic_data.py) y mide
+por separado cada etapa del pipeline: carga, limpieza, agregación por
+producto, barrido de k, ajuste final, PCA, análisis por tienda y
+exportación. Para cada etapa registra (con instrumentation.Recorder) el
+tiempo de reloj, el tiempo de CPU del proceso, el pico de memoria residente
+(RSS) y las filas procesadas, además de los tiempos de cada k del barrido, y
+escribe el resultado en un informe JSON para comparar entre versiones.
+
+Uso:
+    python benchmark.py --rows 10000 100000 1000000 --report benchmark_report.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+
+import aggregation
+import clustering
+import data_pipeline
+import export
+import instrumentation
+import synthetic_data
+
+STAGES = [
+    'load',
+    'clean',
+    'product_aggregation',
+    'k_sweep',
+    'final_fit',
+    'pca',
+    'store_analysis',
+    'export'
+]
+
+
+def _print_stage(record):
+    memory = '—' if record['rss_peak_mb'] is None else f"{record['rss_peak_mb']:.1f}"
+    print(f"   {record['stage']:<20} {record['wall_s']:>9.3f} s  {memory:>9} MB")
+
+
+def run_pipeline(path, work_dir, k_values, n_jobs=1, sample_size=None, fmt='parquet', store_jobs=1):
+    """Ejecutar todas las etapas sobre un CSV y devolver sus métricas"""
+    recorder = instrumentation.Recorder()
+
+    def timed(stage, fn, *args, rows=None):
+        with recorder.stage(stage, rows=rows) as record:
+            result = fn(*args)
+        _print_stage(record)
+        return result
+
+    with recorder.stage('load') as record:
+        raw = data_pipeline.load_raw_data(path, delta_log=None)
+        record['rows'] = len(raw)
+    _print_stage(record)
+    # raw se pasa como argumento (no en un lambda) para poder liberarlo
+    df_clean = timed('clean', data_pipeline.clean_data, raw, rows=len(raw))
+    del raw
+
+    codes = aggregation.factorize_sales(df_clean)
+    product_metrics, le_item_type, le_fat_content = timed(
+        'product_aggregation',
+        lambda: data_pipeline.finalize_product_metrics(
+            data_pipeline.aggregate_product_metrics(df_clean, codes)
+        ),
+        rows=len(df_clean)
+    )
+
+    X_scaled = StandardScaler().fit_transform(product_metrics[data_pipeline.CLUSTERING_FEATURES])
+    sweep = timed(
+        'k_sweep',
+        lambda: clustering.sweep_k(
+            X_scaled, k_values=k_values, n_jobs=n_jobs, sample_size=sample_size,
+            strata=product_metrics['Item_Type_Encoded']
+        ),
+        rows=len(X_scaled)
+    )
+    kmeans = timed(
+        'final_fit',
+        lambda: KMeans(n_clusters=sweep['best_k'], random_state=clustering.RANDOM_STATE,
+                       n_init=clustering.N_INIT).fit(X_scaled),
+        rows=len(X_scaled)
+    )
+    timed('pca', lambda: PCA(n_components=3).fit_transform(X_scaled), rows=len(X_scaled))
+
+    product_metrics['cluster_producto'] = kmeans.labels_
+    df_with_clusters, store_cluster_analysis, store_analysis = timed(
+        'store_analysis',
+        lambda: aggregation.store_tables(df_clean, product_metrics, codes, n_jobs=store_jobs),
+        rows=len(df_clean)
+    )
+    timed(
+        'export',
+        lambda: export.write_tables(
+            {
+                'product_metrics_with_clusters': product_metrics,
+                'store_analysis_with_clusters': store_analysis,
+                'store_cluster_analysis': store_cluster_analysis,
+                'original_data_with_clusters': df_with_clusters
+            },
+            output_dir=work_dir,
+            fmt=fmt
+        ),
+        rows=len(df_with_clusters)
+    )
+    instrumentation.record_sweep(recorder, sweep)
+    stages = [r for r in recorder.records if r['stage'] in STAGES]
+    return stages, recorder.stages('k_sweep.k'), {
+        'n_products': len(product_metrics),
+        'n_outlets': len(store_analysis),
+        'best_k': sweep['best_k'],
+        'evaluated_k': sweep['evaluated_k']
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark por etapas del pipeline")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000],
+                        help="Escalas a medir (filas de ventas sintéticas)")
+    parser.add_argument('--items', type=int, default=None,
+                        help="Productos por escala (por defecto proporcional a las filas)")
+    parser.add_argument('--outlets', type=int, default=10, help="Tiendas por escala")
+    parser.add_argument('--seed', type=int, default=synthetic_data.RANDOM_STATE, help="Semilla de los datos")
+    parser.add_argument('--k-min', type=int, default=2, help="Menor k del barrido")
+    parser.add_argument('--k-max', type=int, default=10, help="Mayor k del barrido")
+    parser.add_argument('--n-jobs', type=int, default=1, help="Procesos del barrido de k")
+    parser.add_argument('--store-jobs', type=int, default=1, help="Procesos del análisis por tienda")
+    parser.add_argument('--sample-size', type=int, default=None,
+                        help="Muestra del Silhouette en el barrido (por defecto todos los productos)")
+    parser.add_argument('--format', default='parquet', choices=export.OUTPUT_FORMATS,
+                        help="Formato de la etapa de exportación")
+    parser.add_argument('--data-dir', default=None,
+                        help="Directorio para los CSV sintéticos (se conservan entre ejecuciones)")
+    parser.add_argument('--report', default='benchmark_report.json', help="Informe JSON de salida")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    k_values = list(range(args.k_min, args.k_max + 1))
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'pipeline_version': data_pipeline.PIPELINE_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'config': {
+            'k_values': k_values,
+            'n_jobs': args.n_jobs,
+            'store_jobs': args.store_jobs,
+            'sample_size': args.sample_size,
+            'format': args.format,
+            'seed': args.seed
+        },
+        'runs': []
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        for n_rows in args.rows:
+            n_items = args.items or synthetic_data.default_items(n_rows)
+            path = os.path.join(data_dir, f'synthetic_{n_rows}_{n_items}_{args.outlets}_{args.seed}.csv')
+            print(f"\n{n_rows:,} filas, {n_items:,} productos, {args.outlets} tiendas")
+            if not os.path.exists(path):
+                synthetic_data.generate(path, n_rows, n_items, args.outlets, args.seed)
+
+            work_dir = os.path.join(tmp_dir, f'export_{n_rows}')
+            stages, sweep_ks, summary = run_pipeline(
+                path, work_dir, k_values, args.n_jobs, args.sample_size, args.format, args.store_jobs
+            )
+            report['runs'].append({
+                'rows': n_rows,
+                'items': n_items,
+                'outlets': args.outlets,
+                'csv_mb': round(os.path.getsize(path) / 1e6, 1),
+                'total_wall_s': round(sum(s['wall_s'] for s in stages), 4),
+                'summary': summary,
+                'stages': stages,
+                'k_sweep': sweep_ks
+            })
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✓ Informe escrito en {args.report}")
+
+
+if __name__ == '__main__':
+    main()
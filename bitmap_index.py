@@ -0,0 +1,71 @@
+"""
+Índices bitmap para los filtros de la tabla de productos
+Para cada valor de una columna (Item_Type, cluster_producto) se guarda un
+bitmap empaquetado con un bit por producto. Una combinación de filtros se
+resuelve con OR entre los valores elegidos de cada columna y AND entre
+columnas, sin recorrer la tabla; solo las filas seleccionadas se extraen.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def build_index(values):
+    """Bitmap de cada valor distinto de `values` (valores ordenados)"""
+    codes, categories = pd.factorize(pd.Series(values), sort=True)
+    size = len(codes)
+    # Posiciones agrupadas por valor con una sola ordenación
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(categories) + 1))
+    bitmaps = np.zeros((len(categories), (size + 7) // 8), dtype=np.uint8)
+    for i in range(len(categories)):
+        bits = np.zeros(size, dtype=bool)
+        bits[order[bounds[i]:bounds[i + 1]]] = True
+        bitmaps[i] = np.packbits(bits)
+    return {
+        'values': np.asarray(categories),
+        'bitmaps': bitmaps,
+        'counts': np.diff(bounds),
+        'size': size
+    }
+
+
+def select(index, chosen):
+    """Bitmap de las filas cuyo valor está en `chosen` (OR de sus bitmaps)
+
+    Devuelve None si `chosen` incluye todos los valores (sin filtro).
+    """
+    rows = pd.Index(index['values']).get_indexer(list(chosen))
+    rows = np.unique(rows[rows >= 0])
+    if len(rows) == len(index['values']):
+        return None
+    if len(rows) == 0:
+        return np.zeros(index['bitmaps'].shape[1], dtype=np.uint8)
+    return np.bitwise_or.reduce(index['bitmaps'][rows], axis=0)
+
+
+def positions(bitmaps, size):
+    """Posiciones de las filas presentes en todos los bitmaps (AND)
+
+    Los None (columnas sin filtro) se ignoran; si no queda ninguno devuelve
+    None, es decir, todas las filas.
+    """
+    bitmaps = [bitmap for bitmap in bitmaps if bitmap is not None]
+    if not bitmaps:
+        return None
+    combined = np.bitwise_and.reduce(bitmaps, axis=0)
+    return np.flatnonzero(np.unpackbits(combined, count=size))
+
+
+def filter_rows(df, indexes, selections):
+    """Filas de df que cumplen los filtros {columna: valores elegidos}
+
+    `indexes` son los índices de build_index por columna, construidos sobre
+    df en su orden actual. Sin filtros activos devuelve df tal cual (sin
+    copia); si no, solo se extraen las filas seleccionadas.
+    """
+    bitmaps = [select(indexes[column], chosen) for column, chosen in selections.items()]
+    selected = positions(bitmaps, len(df))
+    if selected is None:
+        return df
+    return df.take(selected)
@@ -0,0 +1,410 @@
+"""
+Motor de selección del número de clusters (k) para el clustering de productos
+Evalúa los valores candidatos de k en un pool de procesos, con arranque en
+caliente opcional desde los centroides del k anterior y parada temprana cuando
+la curva de puntuación ya alcanzó su máximo.
+
+Criterios de selección disponibles:
+- silhouette: Silhouette Score, sobre todos los productos o sobre una muestra
+  estratificada cuya matriz de distancias se calcula una sola vez
+- calinski_harabasz: índice de Calinski-Harabasz (O(n), mayor es mejor)
+- davies_bouldin: índice de Davies-Bouldin (O(n), menor es mejor)
+- inertia: codo de la curva de inercia de KMeans (O(n))
+
+También incluye ClusterSolutions, que precalcula en segundo plano las
+soluciones de todos los k del slider del dashboard.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA
+from sklearn.metrics import (
+    calinski_harabasz_score, davies_bouldin_score, pairwise_distances, silhouette_score
+)
+from sklearn.preprocessing import StandardScaler
+
+import instrumentation
+
+# Rango de k evaluado por defecto (igual que el slider del dashboard)
+K_RANGE = range(2, 11)
+
+RANDOM_STATE = 42
+N_INIT = 10
+
+# Criterios de selección y su nombre para mostrar
+CRITERIA = {
+    'silhouette': 'Silhouette Score',
+    'calinski_harabasz': 'Calinski-Harabasz',
+    'davies_bouldin': 'Davies-Bouldin',
+    'inertia': 'Codo de inercia'
+}
+
+
+def _fit_kmeans(X, k, init_centers=None, random_state=RANDOM_STATE, n_init=N_INIT):
+    """Ajustar KMeans para un k, opcionalmente desde centroides iniciales"""
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    if init_centers is None:
+        kmeans = KMeans(n_clusters=k, random_state=random_state, n_init=n_init)
+    else:
+        # Con centroides iniciales una sola inicialización es suficiente
+        kmeans = KMeans(n_clusters=k, init=init_centers, random_state=random_state, n_init=1)
+    labels = kmeans.fit_predict(X)
+    return {
+        'k': k,
+        'model': kmeans,
+        'labels': labels,
+        'centers': kmeans.cluster_centers_,
+        'inertia': kmeans.inertia_,
+        'n_iter': kmeans.n_iter_,
+        # Tiempos y memoria del proceso que hizo el ajuste
+        'timing': {
+            'fit_wall_s': round(time.perf_counter() - wall_start, 4),
+            'fit_cpu_s': round(time.process_time() - cpu_start, 4),
+            'rows': len(X),
+            'n_iter': int(kmeans.n_iter_),
+            'worker_pid': os.getpid()
+        }
+    }
+
+
+def _score_fit(X, fit, criterion='silhouette', sample_idx=None, distances=None):
+    """Calcular la puntuación de un ajuste y descartar las etiquetas"""
+    fit = dict(fit)
+    labels = fit.pop('labels')
+    fit.pop('model', None)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    if criterion == 'silhouette':
+        if distances is not None:
+            sample_labels = labels[sample_idx]
+            # Una muestra con un único cluster no tiene Silhouette definido
+            if len(np.unique(sample_labels)) < 2:
+                fit['score'] = -1.0
+            else:
+                fit['score'] = silhouette_score(distances, sample_labels, metric='precomputed')
+        else:
+            fit['score'] = silhouette_score(X, labels)
+    elif criterion == 'calinski_harabasz':
+        fit['score'] = calinski_harabasz_score(X, labels)
+    elif criterion == 'davies_bouldin':
+        fit['score'] = davies_bouldin_score(X, labels)
+    else:
+        fit['score'] = fit['inertia']
+    fit['timing'] = dict(
+        fit['timing'],
+        score_wall_s=round(time.perf_counter() - wall_start, 4),
+        score_cpu_s=round(time.process_time() - cpu_start, 4),
+        worker_rss_mb=instrumentation.to_mb(instrumentation.current_rss())
+    )
+    return fit
+
+
+def _fit_and_score(X, k, random_state=RANDOM_STATE, n_init=N_INIT, criterion='silhouette',
+                   sample_idx=None, distances=None):
+    fit = _fit_kmeans(X, k, random_state=random_state, n_init=n_init)
+    return _score_fit(X, fit, criterion, sample_idx, distances)
+
+
+def stratified_sample(n, sample_size, strata=None, random_state=RANDOM_STATE):
+    """Índices ordenados de una muestra estratificada de tamaño ~sample_size
+
+    Cada estrato aporta en proporción a su tamaño y al menos un elemento.
+    Sin estratos se toma una muestra aleatoria simple.
+    """
+    if sample_size is None or sample_size >= n:
+        return np.arange(n)
+    rng = np.random.default_rng(random_state)
+    if strata is None:
+        return np.sort(rng.choice(n, size=sample_size, replace=False))
+
+    strata = np.asarray(strata)
+    fraction = sample_size / n
+    selected = []
+    for value in np.unique(strata):
+        members = np.flatnonzero(strata == value)
+        size = min(len(members), max(1, int(round(len(members) * fraction))))
+        selected.append(rng.choice(members, size=size, replace=False))
+    return np.sort(np.concatenate(selected))
+
+
+def _oriented(scores, criterion):
+    """Puntuaciones orientadas para que un valor mayor sea siempre mejor"""
+    scores = np.asarray(scores, dtype=float)
+    return -scores if criterion == 'davies_bouldin' else scores
+
+
+def elbow_k(k_values, inertias):
+    """Elegir k en el codo de la curva de inercia
+
+    El codo es el punto más alejado de la recta que une el primer y el
+    último valor de la curva normalizada.
+    """
+    k_values = np.asarray(k_values, dtype=float)
+    inertias = np.asarray(inertias, dtype=float)
+    if len(k_values) < 3 or inertias.max() == inertias.min():
+        return int(k_values[0])
+    x = (k_values - k_values[0]) / (k_values[-1] - k_values[0])
+    y = (inertias - inertias.min()) / (inertias.max() - inertias.min())
+    line = y[0] + (y[-1] - y[0]) * x
+    return int(k_values[np.argmax(line - y)])
+
+
+def warm_start_centers(X, centers, k):
+    """Extender los centroides de una solución previa hasta k centroides
+
+    Cada centroide nuevo es el punto más alejado de los centroides actuales
+    (inicialización determinista tipo farthest-first).
+    """
+    centers = np.asarray(centers, dtype=float)[:k]
+    min_dist = np.full(len(X), np.inf)
+    for center in centers:
+        min_dist = np.minimum(min_dist, ((X - center) ** 2).sum(axis=1))
+    while len(centers) < k:
+        new_center = X[np.argmax(min_dist)]
+        centers = np.vstack([centers, new_center])
+        min_dist = np.minimum(min_dist, ((X - new_center) ** 2).sum(axis=1))
+    return centers
+
+
+def _has_peaked(scores, patience):
+    """La curva alcanzó su máximo si las últimas `patience` k no lo mejoran"""
+    if len(scores) <= patience:
+        return False
+    best_pos = int(np.argmax(scores))
+    return len(scores) - 1 - best_pos >= patience
+
+
+def sweep_k(X, k_values=K_RANGE, n_jobs=1, warm_start=False, patience=None,
+            random_state=RANDOM_STATE, n_init=N_INIT, criterion='silhouette',
+            sample_size=None, strata=None, sample_random_state=RANDOM_STATE):
+    """Evaluar los valores candidatos de k y elegir el mejor según `criterion`
+
+    - n_jobs: número de procesos (-1 usa todos los núcleos)
+    - warm_start: ajustar cada k desde los centroides del k anterior; los
+      ajustes se encadenan en orden y el cálculo de la puntuación se reparte
+      en el pool de procesos
+    - patience: detener el barrido cuando `patience` valores consecutivos de
+      k no mejoran la mejor puntuación (None evalúa todos los k; no aplica
+      al criterio de inercia, que necesita la curva completa)
+    - criterion: uno de CRITERIA
+    - sample_size: tamaño de la muestra estratificada (por `strata`) para el
+      Silhouette; la matriz de distancias de la muestra se calcula una vez y
+      se reutiliza para todos los k
+
+    Los k se evalúan en tandas del tamaño del pool para que la parada
+    temprana no desperdicie trabajo. Devuelve un diccionario con best_k,
+    best_score, el criterio y tamaño de muestra usados, las puntuaciones e
+    inercias por k, si hubo parada temprana y los tiempos de ajuste y
+    puntuación de cada k (medidos en el proceso que los ejecutó).
+    """
+    if criterion not in CRITERIA:
+        raise ValueError(f"Criterio desconocido: {criterion}. Opciones: {', '.join(CRITERIA)}")
+
+    X = np.asarray(X, dtype=float)
+    k_values = sorted(k_values)
+    wave_size = max(1, effective_n_jobs(n_jobs))
+    if criterion == 'inertia':
+        patience = None
+    sample_idx, distances = _silhouette_sample(X, criterion, sample_size, strata, sample_random_state)
+
+    results = []
+    stopped_early = False
+    previous_centers = None
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for start in range(0, len(k_values), wave_size):
+            wave = k_values[start:start + wave_size]
+            if warm_start:
+                fits = []
+                for k in wave:
+                    init = None if previous_centers is None else warm_start_centers(X, previous_centers, k)
+                    fit = _fit_kmeans(X, k, init, random_state, n_init)
+                    previous_centers = fit['centers']
+                    fits.append(fit)
+                wave_results = parallel(
+                    delayed(_score_fit)(X, fit, criterion, sample_idx, distances) for fit in fits
+                )
+            else:
+                wave_results = parallel(
+                    delayed(_fit_and_score)(X, k, random_state, n_init, criterion, sample_idx, distances)
+                    for k in wave
+                )
+            results.extend(wave_results)
+
+            oriented = _oriented([r['score'] for r in results], criterion)
+            if patience is not None and _has_peaked(oriented, patience):
+                stopped_early = start + wave_size < len(k_values)
+                break
+
+    return _sweep_result(results, criterion, sample_idx, len(X), stopped_early)
+
+
+def _silhouette_sample(X, criterion, sample_size, strata, random_state):
+    """Muestra compartida para el Silhouette y su matriz de distancias
+    ((None, None) si se puntúa con todos los productos)"""
+    if criterion == 'silhouette' and sample_size is not None and sample_size < len(X):
+        sample_idx = stratified_sample(len(X), sample_size, strata, random_state)
+        return sample_idx, pairwise_distances(X[sample_idx])
+    return None, None
+
+
+def _sweep_result(results, criterion, sample_idx, n_samples, stopped_early=False):
+    """Resumen de un barrido a partir de los ajustes puntuados"""
+    scores = {r['k']: r['score'] for r in results}
+    if criterion == 'inertia':
+        best_k = elbow_k([r['k'] for r in results], [r['score'] for r in results])
+    else:
+        best_k = results[int(np.argmax(_oriented([r['score'] for r in results], criterion)))]['k']
+    return {
+        'best_k': best_k,
+        'best_score': scores[best_k],
+        'criterion': criterion,
+        'sample_size': len(sample_idx) if sample_idx is not None else n_samples,
+        'n_samples': n_samples,
+        'scores': scores,
+        'inertias': {r['k']: r['inertia'] for r in results},
+        'evaluated_k': [r['k'] for r in results],
+        'stopped_early': stopped_early,
+        'timings': {r['k']: r['timing'] for r in results}
+    }
+
+
+def score_solutions(solutions, n_jobs=1, criterion='silhouette', sample_size=None, strata=None,
+                    sample_random_state=RANDOM_STATE):
+    """Barrido de k sobre las soluciones ya ajustadas de un ClusterSolutions
+
+    Igual que sweep_k pero sin reajustar KMeans: puntúa las etiquetas de
+    cada k (esperando a las que el hilo en segundo plano aún no calculó).
+    Devuelve el mismo diccionario que sweep_k.
+    """
+    if criterion not in CRITERIA:
+        raise ValueError(f"Criterio desconocido: {criterion}. Opciones: {', '.join(CRITERIA)}")
+    X = solutions.X_scaled
+    sample_idx, distances = _silhouette_sample(X, criterion, sample_size, strata, sample_random_state)
+    fits = []
+    for k in solutions.k_values:
+        solution = solutions.get(k)
+        fits.append({
+            'k': k,
+            'labels': solution['labels'],
+            'inertia': solution['inertia'],
+            'timing': dict(solutions.timings[k], rows=len(X))
+        })
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_score_fit)(X, fit, criterion, sample_idx, distances) for fit in fits
+    )
+    return _sweep_result(results, criterion, sample_idx, len(X))
+
+
+def describe_sweep(sweep):
+    """Texto con el k elegido, el criterio y la muestra utilizada"""
+    if sweep['criterion'] == 'silhouette' and sweep['sample_size'] < sweep['n_samples']:
+        sample = f"muestra de {sweep['sample_size']:,} de {sweep['n_samples']:,} productos"
+    else:
+        sample = f"{sweep['n_samples']:,} productos"
+    return (f"{sweep['best_k']} ({CRITERIA[sweep['criterion']]}: {sweep['best_score']:.4f}, "
+            f"{sample})")
+
+
+class ClusterSolutions:
+    """Soluciones KMeans precalculadas para todos los k de `k_values`
+
+    El escalado y el PCA no dependen de k, así que se calculan una sola vez.
+    Las etiquetas de cada k se guardan en una matriz int16 (una fila por k)
+    junto con sus centroides y las tablas derivadas que devuelva `derive`
+    (una función de las etiquetas, por ejemplo el análisis por tienda).
+
+    start() lanza el cálculo de todos los k en un hilo en segundo plano;
+    get(k) devuelve la solución de k y la calcula en el momento si el hilo
+    aún no ha llegado a ella. Cada k tiene su propio lock, de modo que nunca
+    se ajusta dos veces y una consulta no espera a otro k.
+
+    load_model(k) y save_model(k, kmeans) permiten reutilizar un KMeans ya
+    ajustado (por ejemplo del registro de modelos) en lugar de reajustarlo.
+    """
+
+    def __init__(self, X, k_values=K_RANGE, derive=None, random_state=RANDOM_STATE,
+                 n_init=N_INIT, n_components=3, load_model=None, save_model=None):
+        self.scaler = StandardScaler()
+        self.X_scaled = self.scaler.fit_transform(X)
+        self.pca = PCA(n_components=n_components)
+        self.pca_coords = self.pca.fit_transform(self.X_scaled)
+        self.k_values = sorted(k_values)
+        self.labels = np.full((len(self.k_values), len(self.X_scaled)), -1, dtype=np.int16)
+        self.centers = {}
+        self.inertias = {}
+        self.derived = {}
+        self.timings = {}
+        self._row = {k: i for i, k in enumerate(self.k_values)}
+        self._locks = {k: threading.Lock() for k in self.k_values}
+        self._derive = derive
+        self._load_model = load_model
+        self._save_model = save_model
+        self._random_state = random_state
+        self._n_init = n_init
+        self._thread = None
+
+    def is_ready(self, k):
+        return k in self.derived
+
+    def get(self, k):
+        """Solución de k: etiquetas, centroides, inercia y tablas derivadas"""
+        if k not in self._row:
+            raise ValueError(f"k={k} fuera del rango precalculado {self.k_values}")
+        with self._locks[k]:
+            if k not in self.derived:
+                wall_start = time.perf_counter()
+                kmeans = self._load_model(k) if self._load_model is not None else None
+                source = 'registry' if kmeans is not None else 'fit'
+                if kmeans is None:
+                    kmeans = _fit_kmeans(self.X_scaled, k, random_state=self._random_state,
+                                         n_init=self._n_init)['model']
+                    if self._save_model is not None:
+                        self._save_model(k, kmeans)
+                self.labels[self._row[k]] = kmeans.labels_
+                self.centers[k] = kmeans.cluster_centers_
+                self.inertias[k] = kmeans.inertia_
+                labels = self.labels[self._row[k]]
+                self.derived[k] = self._derive(labels) if self._derive is not None else None
+                self.timings[k] = {
+                    'source': source,
+                    'wall_s': round(time.perf_counter() - wall_start, 4),
+                    'thread': threading.current_thread().name
+                }
+        return {
+            'k': k,
+            'labels': self.labels[self._row[k]],
+            'centers': self.centers[k],
+            'inertia': self.inertias[k],
+            'derived': self.derived[k]
+        }
+
+    def _compute_all(self, order):
+        for k in order:
+            try:
+                self.get(k)
+            except Exception:
+                # Un fallo en segundo plano no se pierde: get(k) lo repetirá
+                # (y lo lanzará) cuando se consulte ese k
+                continue
+
+    def start(self, first=None):
+        """Calcular todos los k en segundo plano, empezando por `first`"""
+        if self._thread is None:
+            order = list(self.k_values)
+            if first in self._row:
+                order.remove(first)
+                order.insert(0, first)
+            self._thread = threading.Thread(target=self._compute_all, args=(order,), daemon=True)
+            self._thread.start()
+        return self
+
+    def wait(self):
+        """Esperar a que termine el cálculo en segundo plano"""
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,186 @@
+"""
+Cubo OLAP tienda × tipo de producto × cluster para el dashboard
+Se construye una vez por solución de clustering con arrays densos de
+ventas, registros, suma de MRP y productos distintos por celda
+(tienda, Item_Type, cluster_producto). Los atributos de la tienda
+(Outlet_Type, Outlet_Location_Type, Outlet_Size) dependen solo de la tienda,
+así que cualquier agregado por ellos es un roll-up de las tiendas.
+
+Ventas, registros y MRP se suman entre celdas. Los productos distintos se
+suman entre tipos y clusters (cada producto tiene un solo tipo y un solo
+cluster) pero no entre tiendas, por lo que se precalculan también por cada
+atributo de tienda y para el total de tiendas.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Atributos de tienda por los que se puede agregar
+OUTLET_DIMENSIONS = ['Outlet_Type', 'Outlet_Location_Type', 'Outlet_Size']
+PRODUCT_DIMENSIONS = ['Item_Type', 'cluster_producto']
+DIMENSIONS = ['Outlet_Identifier'] + OUTLET_DIMENSIONS + PRODUCT_DIMENSIONS
+
+MEASURES = ['Total_Sales', 'Num_Records', 'Num_Unique_Products', 'Avg_MRP']
+
+
+def product_outlet_pairs(codes):
+    """Pares (producto, tienda) distintos; no dependen del clustering"""
+    n_outlets = len(codes['outlets'])
+    keys = np.unique(codes['item_codes'].astype(np.int64) * n_outlets + codes['outlet_codes'])
+    return keys // n_outlets, keys % n_outlets
+
+
+def _bincount(codes, shape, weights=None):
+    return np.bincount(codes, weights=weights, minlength=int(np.prod(shape))).reshape(shape)
+
+
+def build_cube(df_clean, product_metrics, codes, pairs=None):
+    """Cubo de la solución de clustering de product_metrics['cluster_producto']
+
+    `codes` es la factorización de aggregation.factorize_sales y `pairs` los
+    pares de product_outlet_pairs (se calculan si no se pasan).
+    """
+    if pairs is None:
+        pairs = product_outlet_pairs(codes)
+    n_outlets = len(codes['outlets'])
+
+    # Tipo y cluster de cada producto, en el orden de codes['items']
+    by_item = product_metrics.set_index('Item_Identifier')
+    items = np.asarray(codes['items'], dtype=object)
+    type_codes, item_types = pd.factorize(by_item['Item_Type'].astype(object).reindex(items), sort=True)
+    cluster_codes, clusters = pd.factorize(by_item['cluster_producto'].reindex(items), sort=True)
+    n_types, n_clusters = len(item_types), len(clusters)
+    product_cell = type_codes * n_clusters + cluster_codes
+
+    # Medidas aditivas por celda tienda × tipo × cluster
+    shape = (n_outlets, n_types, n_clusters)
+    row_cells = codes['outlet_codes'] * (n_types * n_clusters) + product_cell[codes['item_codes']]
+    mrp = codes['mrp']
+    mrp_valid = ~np.isnan(mrp)
+    cube = {
+        'shape': shape,
+        'Outlet_Identifier': np.asarray(codes['outlets'], dtype=object),
+        'Item_Type': np.asarray(item_types, dtype=object),
+        'cluster_producto': np.asarray(clusters),
+        'sales': _bincount(row_cells, shape, codes['sales']),
+        'records': _bincount(row_cells, shape),
+        'mrp_sum': _bincount(row_cells[mrp_valid], shape, mrp[mrp_valid]),
+        'mrp_count': _bincount(row_cells[mrp_valid], shape),
+        'outlet_codes': {},
+        'outlet_values': {}
+    }
+
+    # Productos distintos por tienda y por cada atributo de tienda
+    pair_items, pair_outlets = pairs
+    pair_cells = product_cell[pair_items]
+    cube['products'] = _bincount(pair_outlets * (n_types * n_clusters) + pair_cells, shape)
+    cube['products_all'] = _bincount(product_cell[np.unique(pair_items)], (n_types, n_clusters))
+    cube['products_by'] = {}
+    attributes = df_clean.groupby('Outlet_Identifier', observed=True)[OUTLET_DIMENSIONS].first()
+    attributes = attributes.reindex(cube['Outlet_Identifier'])
+    for dim in OUTLET_DIMENSIONS:
+        group_codes, values = pd.factorize(attributes[dim].astype(object), sort=True, use_na_sentinel=False)
+        cube['outlet_codes'][dim] = group_codes
+        cube['outlet_values'][dim] = np.asarray(values, dtype=object)
+        n_values = len(values)
+        keys = np.unique(pair_items.astype(np.int64) * n_values + group_codes[pair_outlets])
+        cube['products_by'][dim] = _bincount(
+            (keys % n_values) * (n_types * n_clusters) + product_cell[keys // n_values],
+            (n_values, n_types, n_clusters)
+        )
+    return cube
+
+
+def _outlet_grouping(cube, outlet_dims):
+    """Códigos de grupo de cada tienda, etiquetas de los grupos y productos distintos por grupo"""
+    n_outlets = cube['shape'][0]
+    if 'Outlet_Identifier' in outlet_dims:
+        labels = {}
+        for dim in outlet_dims:
+            labels[dim] = outlet_attribute(cube, dim)
+        return np.arange(n_outlets), labels, cube['products']
+    if not outlet_dims:
+        return np.zeros(n_outlets, dtype=np.int64), {}, cube['products_all'][None]
+    if len(outlet_dims) > 1:
+        raise ValueError(
+            "Los productos distintos solo están precalculados por tienda o por un atributo de tienda; "
+            f"no se puede agregar por {outlet_dims}"
+        )
+    dim = outlet_dims[0]
+    return cube['outlet_codes'][dim], {dim: cube['outlet_values'][dim]}, cube['products_by'][dim]
+
+
+def rollup(cube, by):
+    """Agregar el cubo por las dimensiones `by`
+
+    Devuelve un DataFrame con una fila por combinación observada (con
+    registros) y las columnas `by` + MEASURES, en el orden de los ejes del
+    cubo (tienda o atributo de tienda, tipo de producto y cluster).
+    """
+    unknown = [dim for dim in by if dim not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Dimensiones desconocidas: {unknown}. Opciones: {', '.join(DIMENSIONS)}")
+    outlet_dims = [dim for dim in by if dim not in PRODUCT_DIMENSIONS]
+    group_codes, group_labels, products = _outlet_grouping(cube, outlet_dims)
+    n_groups = products.shape[0]
+
+    # Sumar los ejes de producto que no se piden
+    axes = tuple(1 + i for i, dim in enumerate(PRODUCT_DIMENSIONS) if dim not in by)
+
+    def reduce(values, grouped):
+        values = values.sum(axis=axes, keepdims=True) if axes else values
+        if grouped:
+            return values
+        result = np.zeros((n_groups,) + values.shape[1:], dtype=values.dtype)
+        np.add.at(result, group_codes, values)
+        return result
+
+    already_grouped = 'Outlet_Identifier' in outlet_dims
+    sales = reduce(cube['sales'], already_grouped)
+    records = reduce(cube['records'], already_grouped)
+    mrp_sum = reduce(cube['mrp_sum'], already_grouped)
+    mrp_count = reduce(cube['mrp_count'], already_grouped)
+    products = reduce(products, True)
+
+    group, type_pos, cluster_pos = np.nonzero(records)
+    result = {}
+    for dim, labels in group_labels.items():
+        result[dim] = labels[group]
+    if 'Item_Type' in by:
+        result['Item_Type'] = cube['Item_Type'][type_pos]
+    if 'cluster_producto' in by:
+        result['cluster_producto'] = cube['cluster_producto'][cluster_pos]
+    cells = (group, type_pos, cluster_pos)
+    result['Total_Sales'] = sales[cells]
+    result['Num_Records'] = records[cells]
+    result['Num_Unique_Products'] = products[cells]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result['Avg_MRP'] = mrp_sum[cells] / mrp_count[cells]
+    return pd.DataFrame(result)[list(by) + MEASURES]
+
+
+def outlet_attribute(cube, dim):
+    """Valor de un atributo para cada tienda, en el orden del cubo"""
+    if dim == 'Outlet_Identifier':
+        return cube['Outlet_Identifier']
+    return cube['outlet_values'][dim][cube['outlet_codes'][dim]]
+
+
+def matrix(cube, measure='sales', by_outlet='Outlet_Identifier'):
+    """Corte tienda (o atributo de tienda) × cluster de una medida aditiva
+
+    Devuelve (matriz densa, etiquetas de filas, etiquetas de columnas).
+    """
+    values = cube[measure].sum(axis=1)
+    if by_outlet == 'Outlet_Identifier':
+        return values, cube['Outlet_Identifier'], cube['cluster_producto']
+    result = np.zeros((len(cube['outlet_values'][by_outlet]), values.shape[1]), dtype=values.dtype)
+    np.add.at(result, cube['outlet_codes'][by_outlet], values)
+    return result, cube['outlet_values'][by_outlet], cube['cluster_producto']
+
+
+def share(values):
+    """Porcentaje de cada columna sobre el total de su fila"""
+    totals = values.sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(totals > 0, values / totals * 100, 0.0)
@@ -0,0 +1,413 @@
+"""
+Pipeline compartido de preparación de datos
+Construye df_clean y product_metrics a partir del CSV de ventas y guarda el
+resultado en una caché columnar (Parquet) para que el dashboard Streamlit y el
+script de Power BI no vuelvan a parsear el CSV en cada ejecución.
+"""
+
+import hashlib
+import os
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import LabelEncoder
+
+import aggregation
+
+# Archivo de datos por defecto
+DATA_PATH = 'train_v9rqX0R.csv'
+
+# Directorio de la caché columnar
+CACHE_DIR = '.cache'
+
+# Registro de las ventas incorporadas con --append (en el directorio de
+# estado de incremental.py): cada lectura completa lo suma al CSV, así que
+# una reconstrucción no pierde los lotes ya aplicados
+DELTA_LOG_FILE = 'sales_delta_log.csv'
+DELTA_LOG_PATH = os.path.join('powerbi_state', DELTA_LOG_FILE)
+
+# Versión del pipeline: incrementar cuando cambie la lógica de limpieza o
+# agregación para invalidar las cachés existentes
+PIPELINE_VERSION = '4'
+
+# Filas por bloque en la lectura por bloques del CSV
+DEFAULT_CHUNKSIZE = 500_000
+
+# Esquema explícito del CSV de ventas: categóricas para los textos repetidos,
+# float32 para las medidas y entero pequeño para el año
+SALES_DTYPES = {
+    'Item_Identifier': 'category',
+    'Item_Weight': 'float32',
+    'Item_Fat_Content': 'category',
+    'Item_Visibility': 'float32',
+    'Item_Type': 'category',
+    'Item_MRP': 'float32',
+    'Outlet_Identifier': 'category',
+    'Outlet_Establishment_Year': 'int16',
+    'Outlet_Size': 'category',
+    'Outlet_Location_Type': 'category',
+    'Outlet_Type': 'category',
+    'Item_Outlet_Sales': 'float32'
+}
+
+# Medidas a nivel fila
+SALES_MEASURE_COLUMNS = ['Item_Weight', 'Item_Visibility', 'Item_MRP', 'Item_Outlet_Sales']
+
+# Medidas a nivel producto que se guardan en float64
+PRODUCT_MEASURE_COLUMNS = [
+    'Total_Sales', 'Avg_Sales_Per_Store', 'Std_Sales', 'Avg_MRP', 'Avg_Weight', 'Avg_Visibility'
+]
+
+# Normalización de las variantes de Item_Fat_Content
+FAT_CONTENT_MAP = {
+    'low fat': 'Low Fat',
+    'LF': 'Low Fat',
+    'reg': 'Regular'
+}
+
+# Columnas del dataset a nivel producto
+PRODUCT_METRICS_COLUMNS = [
+    'Item_Identifier',
+    'Total_Sales',
+    'Avg_Sales_Per_Store',
+    'Std_Sales',
+    'Num_Store_Records',
+    'Avg_MRP',
+    'Avg_Weight',
+    'Avg_Visibility',
+    'Num_Stores',
+    'Item_Type',
+    'Item_Fat_Content'
+]
+
+# Variables utilizadas para el clustering de productos
+CLUSTERING_FEATURES = [
+    'Total_Sales', 'Avg_Sales_Per_Store', 'Num_Stores', 'Avg_MRP',
+    'Avg_Weight', 'Avg_Visibility', 'Item_Type_Encoded',
+    'Item_Fat_Content_Encoded', 'Sales_Stability', 'Price_Per_Unit_Weight'
+]
+
+
+def file_hash(path, block_size=1 << 20):
+    """Calcular el hash SHA-256 del contenido de un archivo"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _sales_files(path, delta_log):
+    """CSV de ventas y, si existe, el registro de deltas"""
+    if delta_log is not None and os.path.exists(delta_log):
+        return [path, delta_log]
+    return [path]
+
+
+def _concat_sales(frames):
+    """Concatenar bloques de ventas conservando las columnas categóricas"""
+    if len(frames) == 1:
+        return frames[0]
+    categorical = [col for col, dtype in SALES_DTYPES.items() if dtype == 'category']
+    for col in categorical:
+        categories = pd.api.types.union_categoricals(
+            [frame[col] for frame in frames], sort_categories=True
+        ).categories
+        frames = [frame.assign(**{col: frame[col].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_raw_data(path=DATA_PATH, delta_log=DELTA_LOG_PATH):
+    """Cargar el CSV de ventas con el esquema tipado, más las ventas del
+    registro de deltas si existe (delta_log=None lee solo `path`)"""
+    return _concat_sales([pd.read_csv(f, dtype=SALES_DTYPES) for f in _sales_files(path, delta_log)])
+
+
+def normalize_fat_content(values):
+    """Unificar las variantes de Item_Fat_Content
+
+    Con dtype categórico la normalización se hace sobre las categorías y se
+    traduce a los códigos de cada fila sin tocar los textos fila a fila.
+    """
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        return values.replace(FAT_CONTENT_MAP)
+    mapped = values.cat.categories.map(lambda c: FAT_CONTENT_MAP.get(c, c))
+    categories = mapped.unique().sort_values()
+    remap = categories.get_indexer(mapped)
+    codes = values.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, remap[codes], -1)
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes, categories),
+        index=values.index,
+        name=values.name
+    )
+
+
+def clean_data(df):
+    """Normalizar las variantes de Item_Fat_Content"""
+    df_clean = df.copy()
+    df_clean['Item_Fat_Content'] = normalize_fat_content(df_clean['Item_Fat_Content'])
+    return df_clean
+
+
+def memory_report(df):
+    """Memoria del DataFrame tipado y la que ocuparía con los dtypes por defecto
+
+    Devuelve (bytes_sin_esquema, bytes_con_esquema). La estimación sin
+    esquema convierte las categóricas a objetos de texto y las medidas a
+    float64/int64, que es lo que produce pd.read_csv sin dtype.
+    """
+    default = {}
+    for col, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            default[col] = object
+        elif pd.api.types.is_float_dtype(dtype):
+            default[col] = 'float64'
+        elif pd.api.types.is_integer_dtype(dtype):
+            default[col] = 'int64'
+    before = df.astype(default).memory_usage(deep=True).sum()
+    after = df.memory_usage(deep=True).sum()
+    return int(before), int(after)
+
+
+def aggregate_product_metrics(df_clean, codes=None):
+    """Agregar las ventas a nivel producto
+
+    Usa el motor factorizado de aggregation.py; `codes` permite reutilizar
+    la factorización de las filas ya calculada.
+    """
+    product_metrics = aggregation.product_table(df_clean, codes)
+    return product_metrics.astype({col: 'float64' for col in PRODUCT_MEASURE_COLUMNS})
+
+
+def finalize_product_metrics(product_metrics):
+    """Imputar faltantes, codificar categóricas y crear variables adicionales"""
+    # Tratar valores faltantes
+    product_metrics['Avg_Weight'] = product_metrics['Avg_Weight'].fillna(
+        product_metrics.groupby('Item_Type', observed=True)['Avg_Weight'].transform('median')
+    )
+    product_metrics['Avg_Weight'] = product_metrics['Avg_Weight'].fillna(product_metrics['Avg_Weight'].median())
+    product_metrics['Std_Sales'] = product_metrics['Std_Sales'].fillna(0)
+
+    # Codificar variables categóricas
+    le_item_type = LabelEncoder()
+    le_fat_content = LabelEncoder()
+    product_metrics['Item_Type_Encoded'] = le_item_type.fit_transform(product_metrics['Item_Type'])
+    product_metrics['Item_Fat_Content_Encoded'] = le_fat_content.fit_transform(product_metrics['Item_Fat_Content'])
+
+    # Crear variables adicionales
+    product_metrics['Sales_Stability'] = product_metrics['Std_Sales'] / (product_metrics['Avg_Sales_Per_Store'] + 1)
+    product_metrics['Price_Per_Unit_Weight'] = product_metrics['Avg_MRP'] / (product_metrics['Avg_Weight'] + 1)
+
+    return product_metrics, le_item_type, le_fat_content
+
+
+def fit_encoders(product_metrics):
+    """Reconstruir los LabelEncoder a partir de product_metrics"""
+    # LabelEncoder ordena las clases, por lo que el resultado es idéntico
+    # al obtenido durante finalize_product_metrics
+    le_item_type = LabelEncoder().fit(product_metrics['Item_Type'])
+    le_fat_content = LabelEncoder().fit(product_metrics['Item_Fat_Content'])
+    return le_item_type, le_fat_content
+
+
+def build_datasets(path=DATA_PATH, delta_log=DELTA_LOG_PATH):
+    """Construir df_clean y product_metrics desde el CSV sin usar caché"""
+    df_clean = clean_data(load_raw_data(path, delta_log))
+    product_metrics, le_item_type, le_fat_content = finalize_product_metrics(
+        aggregate_product_metrics(df_clean)
+    )
+    return df_clean, product_metrics, le_item_type, le_fat_content
+
+
+def read_sales_chunks(path=DATA_PATH, chunksize=DEFAULT_CHUNKSIZE, delta_log=DELTA_LOG_PATH):
+    """Bloques de filas del CSV de ventas y, a continuación, del registro de deltas"""
+    for f in _sales_files(path, delta_log):
+        yield from pd.read_csv(f, chunksize=chunksize, dtype=SALES_DTYPES)
+
+
+def stream_product_metrics(path=DATA_PATH, chunksize=DEFAULT_CHUNKSIZE, delta_log=DELTA_LOG_PATH):
+    """Agregar el CSV a nivel producto leyéndolo por bloques
+
+    Cada bloque se reduce a agregados parciales combinables (suma y conteo,
+    media y M2 de Welford para Item_Outlet_Sales, pares producto-tienda
+    distintos y primer tipo/contenido de grasa visto) que se combinan con
+    el acumulado, por lo que la memoria depende del número de productos y
+    no del número de filas. Devuelve las mismas columnas que
+    aggregate_product_metrics. El registro de deltas se lee a continuación
+    del CSV, por los mismos bloques.
+    """
+    partials = None
+    outlet_pairs = None
+    for chunk in read_sales_chunks(path, chunksize, delta_log):
+        chunk = clean_data(chunk)
+        partials = merge_partials(partials, partial_aggregates(chunk))
+        pairs = chunk[['Item_Identifier', 'Outlet_Identifier']].drop_duplicates()
+        outlet_pairs = pairs if outlet_pairs is None else (
+            pd.concat([outlet_pairs, pairs], ignore_index=True).drop_duplicates()
+        )
+
+    return product_metrics_from_partials(partials, outlet_pairs)
+
+
+def partial_aggregates(chunk):
+    """Agregados parciales combinables de un bloque de filas"""
+    # Acumular en float64 aunque las filas se lean en float32
+    chunk = chunk.astype({col: 'float64' for col in SALES_MEASURE_COLUMNS})
+    grouped = chunk.groupby('Item_Identifier', sort=False, observed=True)
+    sales = grouped['Item_Outlet_Sales']
+    partial = pd.DataFrame({
+        'sales_sum': sales.sum(),
+        'sales_count': sales.count(),
+        'sales_mean': sales.mean(),
+        'sales_m2': sales.var(ddof=0) * sales.count(),
+        'mrp_sum': grouped['Item_MRP'].sum(),
+        'mrp_count': grouped['Item_MRP'].count(),
+        'weight_sum': grouped['Item_Weight'].sum(),
+        'weight_count': grouped['Item_Weight'].count(),
+        'visibility_sum': grouped['Item_Visibility'].sum(),
+        'visibility_count': grouped['Item_Visibility'].count(),
+        'Item_Type': grouped['Item_Type'].first(),
+        'Item_Fat_Content': grouped['Item_Fat_Content'].first()
+    })
+    partial['sales_m2'] = partial['sales_m2'].fillna(0)
+    return partial
+
+
+def merge_partials(accumulated, partial):
+    """Combinar agregados parciales (fórmula paralela de Chan para la varianza)"""
+    if accumulated is None:
+        return partial
+    stacked = pd.concat([accumulated, partial])
+    grouped = stacked.groupby(level=0, sort=False)
+
+    merged = grouped[[
+        'sales_sum', 'sales_count', 'mrp_sum', 'mrp_count', 'weight_sum', 'weight_count',
+        'visibility_sum', 'visibility_count'
+    ]].sum()
+    mean = merged['sales_sum'] / merged['sales_count']
+    deviation = stacked['sales_mean'] - mean.reindex(stacked.index).to_numpy()
+    between = (stacked['sales_count'] * deviation ** 2).fillna(0)
+    merged.insert(2, 'sales_mean', mean)
+    merged.insert(3, 'sales_m2', (stacked['sales_m2'] + between).groupby(level=0, sort=False).sum())
+    # El acumulado va primero, así que first conserva el primer valor visto
+    merged['Item_Type'] = grouped['Item_Type'].first()
+    merged['Item_Fat_Content'] = grouped['Item_Fat_Content'].first()
+    return merged
+
+
+def product_metrics_from_partials(partials, outlet_pairs):
+    """Convertir los agregados parciales en las columnas de product_metrics"""
+    partials = partials.sort_index()
+    count = partials['sales_count']
+    product_metrics = pd.DataFrame({
+        'Item_Identifier': partials.index,
+        'Total_Sales': partials['sales_sum'].to_numpy(),
+        'Avg_Sales_Per_Store': partials['sales_mean'].to_numpy(),
+        # Desviación estándar muestral (NaN con un solo registro, como pandas)
+        'Std_Sales': (partials['sales_m2'] / (count - 1)).where(count > 1).pow(0.5).to_numpy(),
+        'Num_Store_Records': count.to_numpy(),
+        'Avg_MRP': (partials['mrp_sum'] / partials['mrp_count']).to_numpy(),
+        'Avg_Weight': (partials['weight_sum'] / partials['weight_count']).to_numpy(),
+        'Avg_Visibility': (partials['visibility_sum'] / partials['visibility_count']).to_numpy(),
+        'Num_Stores': outlet_pairs.groupby('Item_Identifier', observed=True).size().reindex(partials.index).to_numpy(),
+        'Item_Type': partials['Item_Type'].to_numpy(),
+        'Item_Fat_Content': partials['Item_Fat_Content'].to_numpy()
+    })
+    # Mismos dtypes que aggregate_product_metrics sobre el esquema tipado
+    dtypes = {col: 'float64' for col in PRODUCT_MEASURE_COLUMNS}
+    dtypes.update({col: 'category' for col in ['Item_Identifier', 'Item_Type', 'Item_Fat_Content']})
+    return product_metrics[PRODUCT_METRICS_COLUMNS].astype(dtypes)
+
+
+def cache_key(path, delta_log=DELTA_LOG_PATH):
+    """Clave de caché: hash del archivo de entrada (y del registro de
+    deltas, si existe) y versión del pipeline"""
+    files = _sales_files(path, delta_log)
+    digest = file_hash(path)
+    if len(files) > 1:
+        digest = hashlib.sha256(''.join(file_hash(f) for f in files).encode()).hexdigest()
+    return f'{digest[:16]}-v{PIPELINE_VERSION}'
+
+
+def _read_cached_table(cache_dir, key, name):
+    """Leer una tabla de la caché, o None si no existe"""
+    table_path = os.path.join(cache_dir, key, f'{name}.parquet')
+    if not os.path.exists(table_path):
+        return None
+    return pd.read_parquet(table_path)
+
+
+def _write_cached_table(cache_dir, key, name, df):
+    """Guardar una tabla en la caché"""
+    entry_dir = os.path.join(cache_dir, key)
+    os.makedirs(entry_dir, exist_ok=True)
+    # Escribir en un archivo temporal y renombrar para que una escritura
+    # interrumpida nunca deje una tabla incompleta en la caché
+    fd, tmp_path = tempfile.mkstemp(dir=entry_dir, prefix=f'.{name}-', suffix='.tmp')
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, os.path.join(entry_dir, f'{name}.parquet'))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _cached(cache_dir, key, name, build):
+    """Devolver la tabla cacheada o construirla y guardarla"""
+    try:
+        df = _read_cached_table(cache_dir, key, name)
+        if df is not None:
+            return df
+        df = build()
+        _write_cached_table(cache_dir, key, name, df)
+        return df
+    except ImportError:
+        warnings.warn('pyarrow no está instalado: se omite la caché Parquet')
+        return build()
+
+
+def load_and_process_data(path=DATA_PATH, use_cache=True, cache_dir=CACHE_DIR, delta_log=DELTA_LOG_PATH):
+    """Cargar y procesar los datos, reutilizando la caché Parquet si existe
+
+    Devuelve df_clean, product_metrics, le_item_type y le_fat_content.
+    """
+    if not use_cache:
+        return build_datasets(path, delta_log)
+
+    key = cache_key(path, delta_log)
+    df_clean = _cached(cache_dir, key, 'df_clean', lambda: clean_data(load_raw_data(path, delta_log)))
+    product_metrics = _cached(
+        cache_dir, key, 'product_metrics',
+        lambda: finalize_product_metrics(aggregate_product_metrics(df_clean))[0]
+    )
+    le_item_type, le_fat_content = fit_encoders(product_metrics)
+    return df_clean, product_metrics, le_item_type, le_fat_content
+
+
+def load_clean_data(path=DATA_PATH, use_cache=True, cache_dir=CACHE_DIR, delta_log=DELTA_LOG_PATH):
+    """Cargar solo df_clean, reutilizando la caché Parquet si existe"""
+    if not use_cache:
+        return clean_data(load_raw_data(path, delta_log))
+    return _cached(cache_dir, cache_key(path, delta_log), 'df_clean',
+                   lambda: clean_data(load_raw_data(path, delta_log)))
+
+
+def load_product_metrics(path=DATA_PATH, chunksize=DEFAULT_CHUNKSIZE, use_cache=True, cache_dir=CACHE_DIR,
+                         delta_log=DELTA_LOG_PATH):
+    """Construir solo product_metrics leyendo el CSV por bloques
+
+    Comparte la entrada de caché con load_and_process_data. Devuelve
+    product_metrics, le_item_type y le_fat_content.
+    """
+    def build():
+        return finalize_product_metrics(stream_product_metrics(path, chunksize, delta_log))[0]
+
+    product_metrics = (
+        _cached(cache_dir, cache_key(path, delta_log), 'product_metrics', build) if use_cache else build()
+    )
+    le_item_type, le_fat_content = fit_encoders(product_metrics)
+    return product_metrics, le_item_type, le_fat_content
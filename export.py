@@ -0,0 +1,344 @@
+"""
+Exportación de las tablas de Power BI en CSV o Parquet
+Las tablas se escriben en paralelo (un hilo por tabla) en el directorio de
+salida. En formato Parquet se usa compresión por columnas y la tabla a nivel
+fila (original_data_with_clusters) puede particionarse por tienda o por
+cluster, con un subdirectorio por valor (Outlet_Identifier=OUT010/...).
+
+También genera la exportación en esquema en estrella: una tabla de hechos
+estrecha con claves enteras y dimensiones de producto, tienda y cluster.
+
+Para descargas desde el dashboard, stream_table difiere la generación del
+CSV o Parquet hasta que se lee y convierte los datos por bloques; quien lo
+consume (st.download_button) lee el archivo entero, así que el pico de
+memoria sigue siendo el tamaño del archivo.
+"""
+
+import io
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import aggregation
+
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+# flat: las cuatro tablas desnormalizadas; star: esquema en estrella
+SCHEMAS = ('flat', 'star')
+
+# Columnas por las que se puede particionar la tabla a nivel fila
+PARTITION_COLUMNS = ('Outlet_Identifier', 'cluster_producto')
+
+# Tabla que se particiona (las demás tienen pocas filas)
+PARTITIONED_TABLE = 'original_data_with_clusters'
+
+# Clave del esquema en estrella que corresponde a cada columna de partición
+STAR_PARTITION_KEYS = {
+    'Outlet_Identifier': 'Outlet_Key',
+    'cluster_producto': 'Cluster_Key'
+}
+
+# Tabla de hechos del esquema en estrella (la que se particiona)
+STAR_FACT_TABLE = 'fact_sales'
+
+# Medidas por fila de la tabla de hechos
+FACT_MEASURES = ['Item_Outlet_Sales', 'Item_MRP', 'Item_Visibility']
+
+DEFAULT_COMPRESSION = 'snappy'
+DEFAULT_WRITE_JOBS = 4
+
+# Filas por bloque en las descargas por streaming
+STREAM_CHUNKSIZE = 100_000
+
+MIME_TYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet'
+}
+
+
+def table_path(output_dir, name, fmt='csv'):
+    """Ruta de una tabla exportada (archivo, o directorio si está particionada)"""
+    return os.path.join(output_dir, f'{name}.{fmt}')
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def write_table(df, output_dir, name, fmt='csv', partition_by=None, compression=DEFAULT_COMPRESSION):
+    """Escribir una tabla y devolver su ruta"""
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Formato desconocido: {fmt}. Opciones: {', '.join(OUTPUT_FORMATS)}")
+    path = table_path(output_dir, name, fmt)
+    # Una exportación previa particionada (directorio) o sin particionar
+    # (archivo) con el mismo nombre no debe mezclarse con la nueva
+    _remove(path)
+    if fmt == 'csv':
+        df.to_csv(path, index=False)
+    elif partition_by is not None:
+        df.to_parquet(path, index=False, compression=compression, partition_cols=[partition_by])
+    else:
+        df.to_parquet(path, index=False, compression=compression)
+    return path
+
+
+def _plain_categories(chunk):
+    """Categóricas como texto: cada bloque leído por separado tiene sus
+    propias categorías, y el esquema Parquet debe ser el mismo en todos"""
+    categorical = chunk.select_dtypes('category').columns
+    return chunk.astype({col: object for col in categorical})
+
+
+def write_table_chunks(chunks, output_dir, name, fmt='csv', compression=DEFAULT_COMPRESSION):
+    """Escribir una tabla bloque a bloque (sin tenerla entera en memoria) y
+    devolver su ruta y su número de filas"""
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Formato desconocido: {fmt}. Opciones: {', '.join(OUTPUT_FORMATS)}")
+    path = table_path(output_dir, name, fmt)
+    _remove(path)
+    os.makedirs(output_dir, exist_ok=True)
+    rows = 0
+
+    def counted(chunks):
+        nonlocal rows
+        for chunk in chunks:
+            rows += len(chunk)
+            yield chunk
+
+    if fmt == 'csv':
+        parts = _csv_bytes(counted(chunks))
+    else:
+        parts = _parquet_bytes((_plain_categories(c) for c in counted(chunks)), compression)
+    with open(path, 'wb') as f:
+        for part in parts:
+            f.write(part)
+    return path, rows
+
+
+def write_tables(tables, output_dir='.', fmt='csv', partition_by=None,
+                 compression=DEFAULT_COMPRESSION, n_jobs=DEFAULT_WRITE_JOBS,
+                 partitioned_table=PARTITIONED_TABLE):
+    """Escribir en paralelo un diccionario nombre -> DataFrame
+
+    partition_by solo se aplica a `partitioned_table` (la tabla a nivel
+    fila) y solo en Parquet. Devuelve un diccionario nombre -> ruta en el
+    mismo orden.
+    """
+    if partition_by is not None:
+        if fmt != 'parquet':
+            raise ValueError("El particionado solo está disponible en formato parquet")
+        if partition_by not in tables[partitioned_table].columns:
+            raise ValueError(f"Columna de partición no válida para {partitioned_table}: {partition_by}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        futures = {
+            name: pool.submit(
+                write_table, df, output_dir, name, fmt,
+                partition_by if name == partitioned_table else None,
+                compression
+            )
+            for name, df in tables.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def _keys(n):
+    """Claves sustitutas enteras 1..n"""
+    return np.arange(1, n + 1, dtype=np.int32)
+
+
+def star_schema(df_clean, product_metrics, store_cluster_analysis, store_analysis, codes=None):
+    """Tablas del esquema en estrella para Power BI
+
+    - fact_sales: una fila por venta con Product_Key, Outlet_Key,
+      Cluster_Key y las medidas por fila (sin atributos repetidos)
+    - fact_store_cluster: métricas tienda×cluster por Outlet_Key y Cluster_Key
+    - dim_product, dim_outlet, dim_cluster: atributos y métricas de cada
+      producto, tienda y cluster
+
+    Product_Key y Outlet_Key son enteros 1..n en el orden de los
+    identificadores; Cluster_Key es el propio número de cluster.
+    """
+    if codes is None:
+        codes = aggregation.factorize_sales(df_clean)
+    product_keys = pd.Series(_keys(len(codes['items'])), index=codes['items'])
+    outlet_keys = pd.Series(_keys(len(codes['outlets'])), index=codes['outlets'])
+
+    def lookup(keys, identifiers):
+        return keys.reindex(np.asarray(identifiers, dtype=object)).to_numpy()
+
+    fact_sales = pd.DataFrame({
+        'Product_Key': product_keys.to_numpy()[codes['item_codes']],
+        'Outlet_Key': outlet_keys.to_numpy()[codes['outlet_codes']],
+        'Cluster_Key': aggregation.row_clusters(product_metrics, codes).astype(np.int32)
+    })
+    for col in FACT_MEASURES:
+        fact_sales[col] = df_clean[col].to_numpy()
+
+    dim_product = product_metrics.drop(columns=['PC1', 'PC2', 'PC3'], errors='ignore').rename(
+        columns={'cluster_producto': 'Cluster_Key'}
+    )
+    dim_product.insert(0, 'Product_Key', lookup(product_keys, dim_product['Item_Identifier']).astype(np.int32))
+    dim_product['Cluster_Key'] = dim_product['Cluster_Key'].astype(np.int32)
+
+    dim_outlet = store_analysis.copy()
+    dim_outlet.insert(0, 'Outlet_Key', lookup(outlet_keys, dim_outlet['Outlet_Identifier']).astype(np.int32))
+
+    dim_cluster = product_metrics.groupby('cluster_producto').agg(
+        Num_Products=('Item_Identifier', 'size'),
+        Total_Sales=('Total_Sales', 'sum'),
+        Avg_Total_Sales=('Total_Sales', 'mean'),
+        Avg_MRP=('Avg_MRP', 'mean'),
+        Avg_Num_Stores=('Num_Stores', 'mean')
+    ).reset_index().rename(columns={'cluster_producto': 'Cluster_Key'})
+    dim_cluster['Cluster_Key'] = dim_cluster['Cluster_Key'].astype(np.int32)
+    dim_cluster['Cluster_Name'] = 'Cluster ' + dim_cluster['Cluster_Key'].astype(str)
+
+    fact_store_cluster = store_cluster_analysis.drop(columns=['Store_Total_Sales'])
+    fact_store_cluster.insert(0, 'Outlet_Key', lookup(outlet_keys, fact_store_cluster['Outlet_Identifier']).astype(np.int32))
+    fact_store_cluster.insert(1, 'Cluster_Key', fact_store_cluster['cluster_producto'].astype(np.int32))
+    fact_store_cluster = fact_store_cluster.drop(columns=['Outlet_Identifier', 'cluster_producto'])
+
+    return {
+        STAR_FACT_TABLE: fact_sales,
+        'fact_store_cluster': fact_store_cluster,
+        'dim_product': dim_product,
+        'dim_outlet': dim_outlet,
+        'dim_cluster': dim_cluster
+    }
+
+
+def disk_size(path):
+    """Tamaño en bytes de un archivo o de un directorio particionado"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+def frame_chunks(df, chunksize=STREAM_CHUNKSIZE):
+    """Bloques consecutivos de filas de df"""
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+
+def row_chunks(df_clean, product_metrics, codes, chunksize=STREAM_CHUNKSIZE):
+    """Filas de ventas de los productos de product_metrics, con su cluster, por bloques
+
+    `product_metrics` puede estar filtrada: solo se incluyen las filas de sus
+    productos. `codes` es la factorización de aggregation.factorize_sales.
+    """
+    clusters = aggregation.row_clusters(product_metrics, codes)
+    # Los productos que no están en product_metrics quedan sin cluster (NaN)
+    positions = np.flatnonzero(~pd.isna(clusters))
+    for start in range(0, len(positions), chunksize):
+        block = positions[start:start + chunksize]
+        yield df_clean.take(block).assign(
+            cluster_producto=clusters[block].astype(product_metrics['cluster_producto'].dtype)
+        )
+
+
+def cluster_row_chunks(chunks, product_metrics):
+    """Bloques de ventas limpios con el cluster de su producto (para escribir
+    la tabla a nivel fila con write_table_chunks)"""
+    for chunk in chunks:
+        yield chunk.assign(
+            cluster_producto=aggregation.row_clusters(product_metrics, aggregation.factorize_sales(chunk))
+        )
+
+
+class _ByteSink:
+    """Destino de pyarrow que acumula los bytes escritos hasta que se recogen"""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def _csv_bytes(chunks):
+    for i, chunk in enumerate(chunks):
+        yield chunk.to_csv(index=False, header=i == 0).encode()
+
+
+def _parquet_bytes(chunks, compression):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    sink = _ByteSink()
+    writer = None
+    for chunk in chunks:
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema, compression=compression)
+        # Un row group por bloque
+        writer.write_table(table)
+        yield sink.take()
+    if writer is not None:
+        writer.close()
+        yield sink.take()
+
+
+class ChunkStream(io.RawIOBase):
+    """Archivo de solo lectura sobre un iterador de bloques de bytes"""
+
+    def __init__(self, parts):
+        self._parts = iter(parts)
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            try:
+                self._pending = next(self._parts)
+            except StopIteration:
+                return 0
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def stream_table(chunks, fmt='csv', compression=DEFAULT_COMPRESSION):
+    """Archivo CSV o Parquet de generación diferida a partir de `chunks`
+
+    `chunks` es un iterable de DataFrames con las mismas columnas (por
+    ejemplo frame_chunks o row_chunks); cada bloque se convierte cuando se
+    lee, así que nada se genera hasta que alguien consume el archivo. No
+    reduce el pico de memoria si quien lo consume lo lee entero con read(),
+    como hace st.download_button.
+    """
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Formato desconocido: {fmt}. Opciones: {', '.join(OUTPUT_FORMATS)}")
+    parts = _csv_bytes(chunks) if fmt == 'csv' else _parquet_bytes(chunks, compression)
+    return io.BufferedReader(ChunkStream(parts))
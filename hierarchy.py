@@ -0,0 +1,187 @@
+"""
+Clustering jerárquico con el árbol de fusiones en caché
+El árbol (Ward con restricción de conectividad de k vecinos, para que escale
+a catálogos grandes) se calcula una sola vez sobre X_scaled y se guarda en
+.cache/. Las etiquetas de cualquier k salen de cortar el árbol: cada nodo
+cubre un tramo contiguo del orden de hojas del dendrograma, así que un corte
+es asignar k tramos (tiempo lineal, sin reajustar nada).
+
+Uso:
+    tree = hierarchy.load_or_build_tree(X_scaled, key)
+    labels = hierarchy.cut(tree, k=4)
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+import joblib
+import numpy as np
+from scipy.cluster.hierarchy import dendrogram
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.neighbors import kneighbors_graph
+
+import data_pipeline
+
+# Vecinos del grafo de conectividad
+N_NEIGHBORS = 10
+
+LINKAGE = 'ward'
+
+# Hojas del dendrograma truncado que se dibuja
+DENDROGRAM_LEAVES = 40
+
+
+def build_tree(X, n_neighbors=N_NEIGHBORS, linkage=LINKAGE):
+    """Árbol de fusiones completo sobre X
+
+    Devuelve un diccionario con children (fusión i: nodos que une; los nodos
+    >= n son fusiones anteriores), distances, el tamaño y la posición de
+    cada nodo en el orden de hojas (size, start, leaf_order) y los tiempos.
+    """
+    wall_start = time.perf_counter()
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    n = len(X)
+    connectivity = kneighbors_graph(X, n_neighbors=min(n_neighbors, n - 1), include_self=False)
+    model = AgglomerativeClustering(
+        n_clusters=1, linkage=linkage, connectivity=connectivity,
+        compute_full_tree=True, compute_distances=True
+    ).fit(X)
+    children = model.children_.astype(np.int64)
+    fit_s = time.perf_counter() - wall_start
+
+    # Tamaño de cada nodo (hojas 0..n-1, fusiones n..2n-2)
+    size = np.ones(2 * n - 1, dtype=np.int64)
+    for i, (left, right) in enumerate(children):
+        size[n + i] = size[left] + size[right]
+    # Posición de cada nodo en el orden de hojas, de la raíz hacia abajo
+    start = np.zeros(2 * n - 1, dtype=np.int64)
+    for i in range(n - 2, -1, -1):
+        left, right = children[i]
+        start[left] = start[n + i]
+        start[right] = start[n + i] + size[left]
+    leaf_order = np.empty(n, dtype=np.int64)
+    leaf_order[start[:n]] = np.arange(n)
+
+    return {
+        'n_samples': n,
+        'linkage': linkage,
+        'n_neighbors': n_neighbors,
+        'children': children,
+        'distances': model.distances_,
+        'size': size,
+        'start': start,
+        'leaf_order': leaf_order,
+        'timing': {
+            'fit_wall_s': round(fit_s, 4),
+            'wall_s': round(time.perf_counter() - wall_start, 4),
+            'rows': n
+        }
+    }
+
+
+def cut(tree, k):
+    """Etiquetas 0..k-1 de cortar el árbol en k clusters (de izquierda a
+    derecha en el dendrograma)"""
+    n = tree['n_samples']
+    if not 1 <= k <= n:
+        raise ValueError(f"k debe estar entre 1 y {n}")
+    # Las k-1 últimas fusiones se deshacen; sus hijos que no son una de
+    # ellas son los clusters
+    first_undone = 2 * n - k
+    children = tree['children'][n - k:].ravel()
+    nodes = children[children < first_undone] if k > 1 else np.array([2 * n - 2])
+    nodes = nodes[np.argsort(tree['start'][nodes])]
+    labels = np.empty(n, dtype=np.int16)
+    for cluster, node in enumerate(nodes):
+        start = tree['start'][node]
+        labels[tree['leaf_order'][start:start + tree['size'][node]]] = cluster
+    return labels
+
+
+def linkage_matrix(tree):
+    """Matriz de enlace de scipy; con restricción de conectividad las
+    distancias pueden no ser monótonas, así que se usa su máximo acumulado"""
+    n = tree['n_samples']
+    heights = np.maximum.accumulate(tree['distances'])
+    return np.column_stack([
+        tree['children'].astype(np.float64),
+        heights,
+        tree['size'][n:].astype(np.float64)
+    ])
+
+
+def cut_height(tree, k):
+    """Altura del dendrograma a la que el corte deja k clusters"""
+    heights = np.maximum.accumulate(tree['distances'])
+    n = tree['n_samples']
+    below = heights[n - k - 1] if k < n else 0.0
+    above = heights[n - k] if k > 1 else heights[-1]
+    return (below + above) / 2
+
+
+def dendrogram_coords(tree, leaves=DENDROGRAM_LEAVES):
+    """Segmentos del dendrograma truncado a las últimas `leaves` fusiones"""
+    data = dendrogram(linkage_matrix(tree), truncate_mode='lastp', p=leaves, no_plot=True)
+    return {'icoord': data['icoord'], 'dcoord': data['dcoord'], 'labels': data['ivl']}
+
+
+def tree_path(key, n_neighbors=N_NEIGHBORS, linkage=LINKAGE, cache_dir=data_pipeline.CACHE_DIR):
+    return os.path.join(cache_dir, f'hierarchy-{linkage}-{n_neighbors}nn-{key}.joblib')
+
+
+def load_or_build_tree(X, key, n_neighbors=N_NEIGHBORS, linkage=LINKAGE, cache_dir=data_pipeline.CACHE_DIR):
+    """Árbol guardado en caché para `key` (por ejemplo data_pipeline.cache_key)
+    o calculado y guardado (archivo temporal y renombrado)"""
+    path = tree_path(key, n_neighbors, linkage, cache_dir)
+    if os.path.exists(path):
+        try:
+            tree = joblib.load(path)
+            if tree['n_samples'] == len(X):
+                return dict(tree, source='cache')
+        except (OSError, EOFError, ValueError, KeyError):
+            pass
+    tree = build_tree(X, n_neighbors, linkage)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.hierarchy-', suffix='.tmp')
+    os.close(fd)
+    try:
+        joblib.dump(tree, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return dict(tree, source='fit')
+
+
+class TreeSolutions:
+    """Soluciones de todos los k por cortes de un árbol, con la misma
+    interfaz get(k) que clustering.ClusterSolutions"""
+
+    def __init__(self, tree, k_values, derive=None):
+        self.tree = tree
+        self.k_values = sorted(k_values)
+        self.derived = {}
+        self.labels = {}
+        self.timings = {}
+        self._derive = derive
+        self._lock = threading.Lock()
+
+    def is_ready(self, k):
+        return k in self.derived
+
+    def get(self, k):
+        """Solución de k: etiquetas del corte y tablas derivadas"""
+        with self._lock:
+            if k not in self.derived:
+                wall_start = time.perf_counter()
+                self.labels[k] = cut(self.tree, k)
+                cut_s = time.perf_counter() - wall_start
+                self.derived[k] = self._derive(self.labels[k]) if self._derive is not None else None
+                self.timings[k] = {
+                    'source': 'cut',
+                    'cut_wall_s': round(cut_s, 4),
+                    'wall_s': round(time.perf_counter() - wall_start, 4)
+                }
+        return {'k': k, 'labels': self.labels[k], 'derived': self.derived[k]}
@@ -0,0 +1,438 @@
+"""
+Actualización incremental de los datos de Power BI a partir de un lote de ventas
+Mantiene un estado persistente con agregados combinables por producto y por
+par producto-tienda, de modo que un archivo delta con nuevas filas de
+Item_Outlet_Sales solo actualiza los productos y tiendas afectados. Los
+productos nuevos o modificados se asignan a los centroides existentes y solo
+se reajusta el clustering completo cuando la deriva supera un umbral.
+Cada lote aplicado se añade al registro de deltas del estado, que
+data_pipeline suma al CSV en las ejecuciones completas.
+"""
+
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+
+import data_pipeline
+
+# Directorio del estado persistente (incluye el registro de deltas)
+STATE_DIR = os.path.dirname(data_pipeline.DELTA_LOG_PATH)
+
+# Fracción de productos nuevos o reasignados que provoca un reajuste completo
+DRIFT_THRESHOLD = 0.05
+
+OUTLET_ATTRIBUTES = [
+    'Outlet_Type',
+    'Outlet_Size',
+    'Outlet_Location_Type',
+    'Outlet_Establishment_Year'
+]
+
+STORE_CLUSTER_COLUMNS = [
+    'Outlet_Identifier',
+    'cluster_producto',
+    'Total_Sales_Cluster',
+    'Avg_Sales_Per_Product',
+    'Num_Records',
+    'Num_Unique_Products',
+    'Avg_MRP',
+    'Store_Total_Sales',
+    'Pct_Sales_From_Cluster'
+]
+
+STORE_COLUMNS = [
+    'Outlet_Identifier',
+    'Total_Sales',
+    'Outlet_Type',
+    'Outlet_Size',
+    'Outlet_Location_Type',
+    'Outlet_Establishment_Year',
+    'Num_Unique_Products'
+]
+
+# Confianza bootstrap de la asignación (stability.py) y marca de los
+# productos cuya confianza quedó desactualizada tras un --append
+CONFIDENCE_COLUMN = 'Assignment_Confidence'
+STALE_COLUMN = 'Confidence_Stale'
+
+# Archivos de salida para Power BI
+PRODUCT_FILE = 'product_metrics_with_clusters.csv'
+STORE_FILE = 'store_analysis_with_clusters.csv'
+STORE_CLUSTER_FILE = 'store_cluster_analysis.csv'
+ROWS_FILE = 'original_data_with_clusters.csv'
+
+
+def pair_aggregates(df):
+    """Agregados combinables por par producto-tienda"""
+    # Acumular en float64 aunque las filas se lean en float32 (como
+    # data_pipeline.partial_aggregates)
+    df = df.astype({'Item_Outlet_Sales': 'float64', 'Item_MRP': 'float64'})
+    return df.groupby(['Item_Identifier', 'Outlet_Identifier'], observed=True).agg(
+        sales_sum=('Item_Outlet_Sales', 'sum'),
+        sales_count=('Item_Outlet_Sales', 'count'),
+        mrp_sum=('Item_MRP', 'sum'),
+        mrp_count=('Item_MRP', 'count')
+    )
+
+
+def outlet_attributes(df):
+    """Atributos de cada tienda (primer valor visto)"""
+    return df.groupby('Outlet_Identifier', observed=True)[OUTLET_ATTRIBUTES].first()
+
+
+def _lookup(mapping, keys):
+    """Valores de `mapping` para cada clave (NaN si no existe)
+
+    Equivale a keys.map(mapping) pero devuelve siempre un array de valores,
+    también cuando las claves son categóricas.
+    """
+    return mapping.reindex(np.asarray(keys, dtype=object)).to_numpy()
+
+
+def store_tables_from_pairs(pairs, outlets, clusters):
+    """Construir store_cluster_analysis y store_analysis desde los pares
+
+    `clusters` es una Series Item_Identifier -> cluster_producto. El
+    resultado coincide con los groupby a nivel fila del script completo.
+    """
+    pairs = pairs.reset_index()
+    pairs['cluster_producto'] = _lookup(clusters, pairs['Item_Identifier'])
+
+    store_cluster_analysis = pairs.groupby(['Outlet_Identifier', 'cluster_producto'], observed=True).agg(
+        Total_Sales_Cluster=('sales_sum', 'sum'),
+        Num_Records=('sales_count', 'sum'),
+        Num_Unique_Products=('Item_Identifier', 'size'),
+        mrp_sum=('mrp_sum', 'sum'),
+        mrp_count=('mrp_count', 'sum')
+    ).reset_index()
+    store_cluster_analysis['Avg_Sales_Per_Product'] = (
+        store_cluster_analysis['Total_Sales_Cluster'] / store_cluster_analysis['Num_Records']
+    )
+    store_cluster_analysis['Avg_MRP'] = store_cluster_analysis['mrp_sum'] / store_cluster_analysis['mrp_count']
+
+    store_totals = pairs.groupby('Outlet_Identifier', observed=True).agg(
+        Total_Sales=('sales_sum', 'sum'),
+        Num_Unique_Products=('Item_Identifier', 'size')
+    )
+    store_cluster_analysis['Store_Total_Sales'] = (
+        _lookup(store_totals['Total_Sales'], store_cluster_analysis['Outlet_Identifier'])
+    )
+    store_cluster_analysis['Pct_Sales_From_Cluster'] = (
+        store_cluster_analysis['Total_Sales_Cluster'] /
+        store_cluster_analysis['Store_Total_Sales'] * 100
+    )
+    store_cluster_analysis = store_cluster_analysis[STORE_CLUSTER_COLUMNS]
+
+    store_analysis = store_totals.join(outlets).reset_index()[STORE_COLUMNS]
+    store_analysis = add_cluster_pct_columns(store_analysis, store_cluster_analysis)
+    return store_cluster_analysis, store_analysis
+
+
+def add_cluster_pct_columns(store_analysis, store_cluster_analysis):
+    """Agregar las columnas Pct_Cluster_<k> a store_analysis"""
+    cluster_pct_by_store = store_cluster_analysis.pivot_table(
+        index='Outlet_Identifier',
+        columns='cluster_producto',
+        values='Pct_Sales_From_Cluster',
+        fill_value=0,
+        observed=True
+    )
+    cluster_pct_by_store.columns = [f'Pct_Cluster_{int(col)}' for col in cluster_pct_by_store.columns]
+    return store_analysis.merge(cluster_pct_by_store, left_on='Outlet_Identifier', right_index=True)
+
+
+def frozen_imputation(product_metrics):
+    """Medianas de Avg_Weight por tipo usadas para imputar productos nuevos"""
+    return {
+        'by_type': product_metrics.groupby('Item_Type', observed=True)['Avg_Weight'].median().to_dict(),
+        'overall': float(product_metrics['Avg_Weight'].median())
+    }
+
+
+def sales_aggregates(df_clean):
+    """Agregados combinables de un conjunto de filas: por producto
+    (partials), por par producto-tienda (pairs) y atributos de tienda"""
+    return {
+        'partials': data_pipeline.partial_aggregates(df_clean),
+        'pairs': pair_aggregates(df_clean),
+        'outlets': outlet_attributes(df_clean)
+    }
+
+
+def stream_sales_aggregates(chunks):
+    """sales_aggregates de todas las filas leyéndolas por bloques
+
+    La memoria depende del número de productos y de pares producto-tienda,
+    no del número de filas.
+    """
+    aggregates = None
+    for chunk in chunks:
+        chunk = sales_aggregates(data_pipeline.clean_data(chunk))
+        if aggregates is None:
+            aggregates = chunk
+            continue
+        aggregates = {
+            'partials': data_pipeline.merge_partials(aggregates['partials'], chunk['partials']),
+            'pairs': _merge_pairs(aggregates['pairs'], chunk['pairs']),
+            'outlets': aggregates['outlets'].combine_first(chunk['outlets'])
+        }
+    return aggregates
+
+
+def save_state(aggregates, product_metrics, scaler, kmeans, le_item_type, le_fat_content,
+               state_dir=STATE_DIR):
+    """Guardar el estado necesario para actualizaciones incrementales
+
+    `aggregates` es el resultado de sales_aggregates o stream_sales_aggregates.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    save_aggregates(
+        state_dir,
+        aggregates['partials'],
+        aggregates['pairs'],
+        aggregates['outlets'],
+        product_metrics
+    )
+    save_model(state_dir, scaler, kmeans, le_item_type, le_fat_content, frozen_imputation(product_metrics))
+
+
+def save_aggregates(state_dir, partials, pairs, outlets, product_metrics):
+    partials.to_parquet(os.path.join(state_dir, 'product_partials.parquet'))
+    pairs.to_parquet(os.path.join(state_dir, 'outlet_pairs.parquet'))
+    outlets.to_parquet(os.path.join(state_dir, 'outlets.parquet'))
+    product_metrics.to_parquet(os.path.join(state_dir, 'product_metrics.parquet'), index=False)
+
+
+def save_model(state_dir, scaler, kmeans, le_item_type, le_fat_content, imputation):
+    joblib.dump({
+        'scaler': scaler,
+        'kmeans': kmeans,
+        'le_item_type': le_item_type,
+        'le_fat_content': le_fat_content,
+        'imputation': imputation,
+        'clustering_features': data_pipeline.CLUSTERING_FEATURES
+    }, os.path.join(state_dir, 'model.joblib'))
+
+
+def delta_log_path(state_dir=STATE_DIR):
+    """Registro de las ventas incorporadas con apply_delta"""
+    return os.path.join(state_dir, data_pipeline.DELTA_LOG_FILE)
+
+
+def append_delta_log(delta_path, state_dir=STATE_DIR):
+    """Añadir las filas de un delta al registro, tal como están en el archivo
+
+    Se copian como texto (sin pasar por el esquema tipado) para que la
+    lectura completa obtenga exactamente los mismos valores.
+    """
+    path = delta_log_path(state_dir)
+    rows = pd.read_csv(delta_path, dtype=str, keep_default_na=False)
+    if os.path.exists(path):
+        rows = rows[pd.read_csv(path, nrows=0).columns]
+        rows.to_csv(path, mode='a', header=False, index=False)
+    else:
+        rows.to_csv(path, index=False)
+
+
+def load_state(state_dir=STATE_DIR):
+    """Cargar el estado guardado por save_state"""
+    model_path = os.path.join(state_dir, 'model.joblib')
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(
+            f"No existe estado incremental en '{state_dir}'. "
+            "Ejecute primero prepare_powerbi_data.py sin --append."
+        )
+    return {
+        'partials': pd.read_parquet(os.path.join(state_dir, 'product_partials.parquet')),
+        'pairs': pd.read_parquet(os.path.join(state_dir, 'outlet_pairs.parquet')),
+        'outlets': pd.read_parquet(os.path.join(state_dir, 'outlets.parquet')),
+        'product_metrics': pd.read_parquet(os.path.join(state_dir, 'product_metrics.parquet')),
+        'model': joblib.load(model_path)
+    }
+
+
+def finalize_with_model(product_rows, model):
+    """Versión de finalize_product_metrics con imputación y codificación congeladas"""
+    imputation = model['imputation']
+    product_rows['Avg_Weight'] = product_rows['Avg_Weight'].fillna(
+        pd.Series(_lookup(pd.Series(imputation['by_type']), product_rows['Item_Type']), index=product_rows.index)
+    ).fillna(imputation['overall'])
+    product_rows['Std_Sales'] = product_rows['Std_Sales'].fillna(0)
+    product_rows['Item_Type_Encoded'] = model['le_item_type'].transform(product_rows['Item_Type'])
+    product_rows['Item_Fat_Content_Encoded'] = model['le_fat_content'].transform(product_rows['Item_Fat_Content'])
+    product_rows['Sales_Stability'] = product_rows['Std_Sales'] / (product_rows['Avg_Sales_Per_Store'] + 1)
+    product_rows['Price_Per_Unit_Weight'] = product_rows['Avg_MRP'] / (product_rows['Avg_Weight'] + 1)
+    return product_rows
+
+
+def _has_unseen_categories(product_rows, model):
+    return (
+        not product_rows['Item_Type'].isin(model['le_item_type'].classes_).all() or
+        not product_rows['Item_Fat_Content'].isin(model['le_fat_content'].classes_).all()
+    )
+
+
+def _assign(product_rows, model):
+    X = model['scaler'].transform(product_rows[model['clustering_features']])
+    return model['kmeans'].predict(X)
+
+
+def _mark_stale_confidence(product_metrics, refit):
+    """Vaciar y marcar la confianza de los productos recalculados
+
+    Sin reajuste, las filas de los productos afectados llegan sin confianza;
+    tras un reajuste ninguna confianza corresponde a los clusters nuevos. La
+    siguiente ejecución completa la recalcula.
+    """
+    if refit:
+        product_metrics[CONFIDENCE_COLUMN] = np.nan
+    product_metrics[STALE_COLUMN] = product_metrics[CONFIDENCE_COLUMN].isna()
+    return product_metrics
+
+
+def _merge_pairs(pairs, delta_pairs):
+    existing = delta_pairs.index.intersection(pairs.index)
+    updated = pd.concat([pairs.loc[existing], delta_pairs]).groupby(level=[0, 1], observed=True).sum()
+    return pd.concat([pairs.drop(existing), updated])
+
+
+def _replace_outlet_rows(path, new_rows, outlets, sort_by):
+    """Reemplazar en un CSV de salida las filas de las tiendas indicadas"""
+    current = pd.read_csv(path)
+    kept = current[~current['Outlet_Identifier'].isin(outlets)]
+    combined = pd.concat([kept, new_rows], ignore_index=True)
+    # Un cluster puede aparecer por primera vez en una tienda
+    pct_cols = sorted(
+        [col for col in combined.columns if col.startswith('Pct_Cluster_')],
+        key=lambda col: int(col.rsplit('_', 1)[1])
+    )
+    if pct_cols:
+        combined[pct_cols] = combined[pct_cols].fillna(0)
+        combined = combined[[col for col in combined.columns if col not in pct_cols] + pct_cols]
+    combined.sort_values(sort_by).to_csv(path, index=False)
+
+
+def _rewrite_rows(output_dir, delta, clusters, rewrite):
+    """Actualizar el archivo a nivel fila con las filas del delta
+
+    Si ningún producto existente cambió de cluster basta con añadir las
+    filas nuevas al final; en caso contrario se reescribe la columna de
+    cluster de todo el archivo.
+    """
+    path = os.path.join(output_dir, ROWS_FILE)
+    columns = pd.read_csv(path, nrows=0).columns
+    delta_rows = delta.assign(cluster_producto=_lookup(clusters, delta['Item_Identifier']))
+    delta_rows = delta_rows[columns]
+    if not rewrite:
+        delta_rows.to_csv(path, mode='a', header=False, index=False)
+        return
+    rows = pd.concat([pd.read_csv(path), delta_rows], ignore_index=True)
+    rows['cluster_producto'] = _lookup(clusters, rows['Item_Identifier'])
+    rows.to_csv(path, index=False)
+
+
+def apply_delta(delta_path, refit, state_dir=STATE_DIR, output_dir='.', drift_threshold=DRIFT_THRESHOLD):
+    """Incorporar un archivo delta de ventas al estado y a los CSV de salida
+
+    - refit: función product_metrics -> (scaler, kmeans) usada cuando la
+      deriva supera `drift_threshold` o aparecen categorías nuevas
+    - drift_threshold: fracción de productos nuevos o reasignados a otro
+      cluster que provoca el reajuste completo
+
+    Devuelve un diccionario con el resumen de la actualización.
+    """
+    state = load_state(state_dir)
+    model = state['model']
+    delta = data_pipeline.clean_data(data_pipeline.load_raw_data(delta_path, delta_log=None))
+
+    # Actualizar los agregados por producto y por par producto-tienda
+    delta_partials = data_pipeline.partial_aggregates(delta)
+    affected = delta_partials.index
+    partials = state['partials']
+    existing = affected.intersection(partials.index)
+    updated = data_pipeline.merge_partials(partials.loc[existing], delta_partials)
+    partials = pd.concat([partials.drop(existing), updated])
+
+    pairs = _merge_pairs(state['pairs'], pair_aggregates(delta))
+    outlets = state['outlets'].combine_first(outlet_attributes(delta))
+
+    # Recalcular las métricas solo de los productos afectados
+    affected_pairs = pairs[pairs.index.get_level_values('Item_Identifier').isin(affected)].reset_index()
+    product_rows = data_pipeline.product_metrics_from_partials(partials.loc[affected], affected_pairs)
+
+    product_metrics = state['product_metrics'].set_index('Item_Identifier')
+    has_confidence = CONFIDENCE_COLUMN in product_metrics.columns
+    previous_clusters = product_metrics['cluster_producto']
+
+    unseen = _has_unseen_categories(product_rows, model)
+    n_changed = 0
+    n_new = int((~product_rows['Item_Identifier'].isin(previous_clusters.index)).sum())
+    if not unseen:
+        product_rows = finalize_with_model(product_rows, model)
+        product_rows['cluster_producto'] = _assign(product_rows, model)
+        previous = pd.Series(_lookup(previous_clusters, product_rows['Item_Identifier']), index=product_rows.index)
+        changed = previous.notna() & (previous != product_rows['cluster_producto'])
+        n_changed = int(changed.sum())
+    drift = (n_new + n_changed) / (len(previous_clusters) + n_new)
+
+    summary = {
+        'delta_rows': len(delta),
+        'affected_products': len(affected),
+        'new_products': n_new,
+        'reassigned_products': n_changed,
+        'drift': drift,
+        'unseen_categories': unseen,
+        'refit': unseen or drift > drift_threshold
+    }
+
+    if summary['refit']:
+        # Reajuste completo a partir de los agregados (sin releer el historial)
+        product_metrics, le_item_type, le_fat_content = data_pipeline.finalize_product_metrics(
+            data_pipeline.product_metrics_from_partials(partials, pairs.reset_index())
+        )
+        scaler, kmeans = refit(product_metrics)
+        product_metrics['cluster_producto'] = kmeans.predict(
+            scaler.transform(product_metrics[data_pipeline.CLUSTERING_FEATURES])
+        )
+        clusters = product_metrics.set_index('Item_Identifier')['cluster_producto']
+        store_cluster_analysis, store_analysis = store_tables_from_pairs(pairs, outlets, clusters)
+        store_cluster_analysis.to_csv(os.path.join(output_dir, STORE_CLUSTER_FILE), index=False)
+        store_analysis.to_csv(os.path.join(output_dir, STORE_FILE), index=False)
+        _rewrite_rows(output_dir, delta, clusters, rewrite=True)
+        save_model(state_dir, scaler, kmeans, le_item_type, le_fat_content, frozen_imputation(product_metrics))
+        summary['affected_outlets'] = len(outlets)
+    else:
+        # Reemplazar solo las filas de los productos afectados
+        product_metrics = pd.concat([
+            product_metrics.drop(product_rows['Item_Identifier'], errors='ignore'),
+            product_rows.set_index('Item_Identifier')
+        ]).sort_index().reset_index()
+        clusters = product_metrics.set_index('Item_Identifier')['cluster_producto']
+
+        # Tiendas afectadas: las del delta y las que venden productos reasignados
+        changed_items = product_rows.loc[changed, 'Item_Identifier']
+        item_level = pairs.index.get_level_values('Item_Identifier')
+        outlet_level = pairs.index.get_level_values('Outlet_Identifier')
+        affected_outlets = pd.Index(delta['Outlet_Identifier'].unique()).union(
+            outlet_level[item_level.isin(changed_items)].unique()
+        )
+        store_cluster_rows, store_rows = store_tables_from_pairs(
+            pairs[outlet_level.isin(affected_outlets)], outlets, clusters
+        )
+        _replace_outlet_rows(os.path.join(output_dir, STORE_CLUSTER_FILE), store_cluster_rows,
+                             affected_outlets, ['Outlet_Identifier', 'cluster_producto'])
+        _replace_outlet_rows(os.path.join(output_dir, STORE_FILE), store_rows,
+                             affected_outlets, ['Outlet_Identifier'])
+        _rewrite_rows(output_dir, delta, clusters, rewrite=n_changed > 0)
+        summary['affected_outlets'] = len(affected_outlets)
+
+    product_metrics['cluster_producto'] = product_metrics['cluster_producto'].astype(np.int32)
+    if has_confidence:
+        product_metrics = _mark_stale_confidence(product_metrics, summary['refit'])
+    product_metrics.to_csv(os.path.join(output_dir, PRODUCT_FILE), index=False)
+    save_aggregates(state_dir, partials, pairs, outlets, product_metrics)
+    # Las ejecuciones completas posteriores leen también estas filas
+    append_delta_log(delta_path, state_dir)
+    return summary
@@ -0,0 +1,133 @@
+"""
+Instrumentación por etapas del pipeline
+Recorder mide cada etapa (tiempo de reloj, tiempo de CPU del proceso, pico
+de memoria residente y filas procesadas) y guarda un registro por etapa.
+Los registros se pueden escribir como JSON lines (una línea por etapa) para
+comparar ejecuciones y detectar qué etapa empeoró.
+
+Uso:
+    recorder = Recorder('pipeline_metrics.jsonl')
+    with recorder.stage('load') as record:
+        df = load()
+        record['rows'] = len(df)
+"""
+
+import json
+import os
+import platform
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows: sin /proc ni resource no hay medida de memoria
+    resource = None
+
+# Intervalo de muestreo del RSS durante una etapa (segundos)
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def current_rss():
+    """Memoria residente actual del proceso en bytes (None si no se puede
+    medir)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        if resource is None:
+            return None
+        # Sin /proc (macOS): el máximo histórico es la mejor aproximación
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if platform.system() == 'Darwin' else maxrss * 1024
+
+
+def to_mb(nbytes):
+    """Bytes a MB con un decimal (None se conserva)"""
+    return None if nbytes is None else round(nbytes / 1e6, 1)
+
+
+class Recorder:
+    """Registro de métricas por etapa
+
+    - path: archivo JSON lines al que se añade cada registro al terminar su
+      etapa (None solo los guarda en memoria, en `records`)
+    - run_id: identificador común a todos los registros de la ejecución
+    """
+
+    def __init__(self, path=None, run_id=None, sample_interval=RSS_SAMPLE_INTERVAL):
+        self.path = path
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.sample_interval = sample_interval
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, rows=None, **fields):
+        """Medir el bloque `with`; el registro se puede completar dentro
+
+        El pico de RSS se obtiene muestreando la memoria en un hilo mientras
+        dura la etapa. El tiempo de CPU es el de este proceso (no incluye
+        procesos hijos, como los del pool del barrido de k).
+        """
+        record = {'stage': name, 'rows': rows, **fields}
+        rss_start = current_rss()
+        peak = [rss_start]
+        done = threading.Event()
+
+        def sample():
+            if rss_start is None:
+                return
+            while not done.wait(self.sample_interval):
+                peak[0] = max(peak[0], current_rss())
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        except BaseException as exc:
+            record['error'] = type(exc).__name__
+            raise
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            done.set()
+            sampler.join()
+            rss_peak = None if rss_start is None else max(peak[0], current_rss())
+            record.update({
+                'wall_s': round(wall, 4),
+                'cpu_s': round(cpu, 4),
+                'rss_start_mb': to_mb(rss_start),
+                'rss_peak_mb': to_mb(rss_peak),
+                'rss_delta_mb': None if rss_peak is None else to_mb(rss_peak - rss_start)
+            })
+            self._emit(record)
+
+    def record(self, name, **fields):
+        """Añadir un registro ya medido (por ejemplo, el de cada k del barrido)"""
+        record = {'stage': name, **fields}
+        self._emit(record)
+        return record
+
+    def _emit(self, record):
+        record['run_id'] = self.run_id
+        record['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with self._lock:
+            self.records.append(record)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+    def stages(self, prefix=None):
+        """Registros cuyo nombre de etapa empieza por `prefix`"""
+        return [r for r in self.records if prefix is None or r['stage'].startswith(prefix)]
+
+
+def record_sweep(recorder, sweep, stage='k_sweep.k'):
+    """Añadir un registro por cada k evaluado en un barrido de clustering.sweep_k"""
+    for k, timing in sweep['timings'].items():
+        recorder.record(stage, k=k, score=sweep['scores'][k], inertia=sweep['inertias'][k], **timing)
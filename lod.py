@@ -0,0 +1,85 @@
+"""
+Nivel de detalle (LOD) para los gráficos de dispersión de productos
+Cuando hay más productos que el presupuesto de puntos, se envía al navegador
+una muestra estratificada por cluster que conserva siempre los productos
+atípicos; el conjunto completo solo se dibuja cuando el filtro o el zoom
+dejan menos puntos que el presupuesto.
+"""
+
+import numpy as np
+
+# Presupuesto de puntos por gráfico (los 3D pesan más en el navegador)
+POINT_BUDGET_2D = 20_000
+POINT_BUDGET_3D = 5_000
+
+# Fracción del presupuesto reservada para los atípicos
+OUTLIER_FRACTION = 0.1
+
+RANDOM_STATE = 42
+
+
+def outlier_scores(df, columns):
+    """Distancia robusta a la mediana (en rangos intercuartílicos) de cada fila
+
+    La puntuación de una fila es la mayor de sus columnas.
+    """
+    values = df[columns].to_numpy(dtype='float64', na_value=np.nan)
+    median = np.nanmedian(values, axis=0)
+    q1, q3 = np.nanpercentile(values, [25, 75], axis=0)
+    spread = q3 - q1
+    # Columnas sin dispersión intercuartílica: usar la desviación estándar
+    spread = np.where(spread > 0, spread, np.nanstd(values, axis=0))
+    spread = np.where(spread > 0, spread, 1.0)
+    scores = np.abs(values - median) / spread
+    return np.nan_to_num(scores, nan=0.0).max(axis=1)
+
+
+def _stratified_positions(strata, size, rng):
+    """Posiciones de una muestra de tamaño ~size repartida por estrato
+
+    Cada estrato aporta en proporción a su tamaño y al menos un punto.
+    """
+    codes = np.unique(strata, return_inverse=True)[1]
+    counts = np.bincount(codes)
+    quota = np.minimum(counts, np.maximum(1, np.floor(counts * size / len(strata)).astype(int)))
+    selected = []
+    for code, n in enumerate(quota):
+        members = np.flatnonzero(codes == code)
+        selected.append(rng.choice(members, size=n, replace=False))
+    return np.concatenate(selected) if selected else np.array([], dtype=int)
+
+
+def downsample(df, budget, strata='cluster_producto', outlier_columns=None,
+               outlier_fraction=OUTLIER_FRACTION, random_state=RANDOM_STATE):
+    """Reducir df a unas `budget` filas para dibujarlo
+
+    Conserva primero los `budget * outlier_fraction` productos más atípicos
+    en `outlier_columns` y completa con una muestra estratificada por
+    `strata` del resto. La semilla fija hace que la muestra no cambie entre
+    reruns. Devuelve (filas a dibujar, True si se muestreó).
+    """
+    if len(df) <= budget:
+        return df, False
+
+    rng = np.random.default_rng(random_state)
+    keep = np.zeros(len(df), dtype=bool)
+    if outlier_columns:
+        n_outliers = int(budget * outlier_fraction)
+        if n_outliers > 0:
+            scores = outlier_scores(df, outlier_columns)
+            keep[np.argpartition(-scores, n_outliers - 1)[:n_outliers]] = True
+
+    rest = np.flatnonzero(~keep)
+    remaining = budget - int(keep.sum())
+    strata_values = df[strata].to_numpy()[rest] if strata is not None else np.zeros(len(rest))
+    positions = _stratified_positions(strata_values, remaining, rng)
+    keep[rest[positions]] = True
+    return df.iloc[np.flatnonzero(keep)], True
+
+
+def describe_lod(n_shown, n_total):
+    """Texto para indicar cuántos puntos se están dibujando"""
+    if n_shown >= n_total:
+        return f"Mostrando los {n_total:,} productos"
+    return (f"Mostrando {n_shown:,} de {n_total:,} productos (muestra estratificada por "
+            f"cluster que conserva los atípicos); filtra o acota el rango para ver todos")
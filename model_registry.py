@@ -0,0 +1,145 @@
+"""
+Registro versionado de los modelos de clustering de productos
+Cada versión guarda en models/vNNNN/ los objetos ajustados (StandardScaler,
+KMeans, PCA, los LabelEncoder y, desde el script de Power BI, el índice de
+productos similares) en model.joblib y, en metadata.json, los datos con los
+que se entrenó: hash del CSV y versión del pipeline, variables de
+clustering, k, parámetros de selección de k y métricas. El dashboard y el
+script de Power BI buscan aquí un modelo entrenado con las mismas entradas
+antes de reajustar, de modo que ambos muestran las mismas etiquetas.
+"""
+
+import json
+import os
+import time
+
+import joblib
+
+# Directorio del registro de modelos
+REGISTRY_DIR = 'models'
+
+MODEL_FILE = 'model.joblib'
+METADATA_FILE = 'metadata.json'
+
+# Papel del modelo en metadata.json: el que selecciona el script de Power BI
+# es el de producción; los ajustes exploratorios del dashboard (uno por k) se
+# marcan para que las búsquedas por defecto no los devuelvan
+PRODUCTION_ROLE = 'production'
+DASHBOARD_ROLE = 'dashboard'
+
+
+def _normalized(value):
+    """Valor tal como queda tras guardarlo en JSON (para comparar)"""
+    return json.loads(json.dumps(value))
+
+
+def _version_dirs(registry_dir):
+    """Versiones completas del registro (con metadata.json), de la más nueva a la más antigua"""
+    if not os.path.isdir(registry_dir):
+        return []
+    versions = []
+    for name in os.listdir(registry_dir):
+        if name.startswith('v') and name[1:].isdigit():
+            if os.path.exists(os.path.join(registry_dir, name, METADATA_FILE)):
+                versions.append(int(name[1:]))
+    return sorted(versions, reverse=True)
+
+
+def _version_path(registry_dir, version):
+    return os.path.join(registry_dir, f'v{version:04d}')
+
+
+def list_models(registry_dir=REGISTRY_DIR):
+    """Metadatos de todas las versiones, de la más nueva a la más antigua"""
+    models = []
+    for version in _version_dirs(registry_dir):
+        with open(os.path.join(_version_path(registry_dir, version), METADATA_FILE)) as f:
+            models.append(json.load(f))
+    return models
+
+
+def find_model(registry_dir=REGISTRY_DIR, **criteria):
+    """Cargar la versión más reciente cuyos metadatos coinciden con `criteria`
+
+    Por ejemplo find_model(data_hash=..., clustering_features=..., k=4).
+    Los modelos del dashboard solo se devuelven si se pide role=DASHBOARD_ROLE.
+    Devuelve el diccionario del artefacto (objetos y metadatos) o None.
+    """
+    criteria = _normalized(criteria)
+    for metadata in list_models(registry_dir):
+        if 'role' not in criteria and metadata.get('role') == DASHBOARD_ROLE:
+            continue
+        if all(metadata.get(key) == value for key, value in criteria.items()):
+            return load_model(metadata['version'], registry_dir)
+    return None
+
+
+def production_version(registry_dir=REGISTRY_DIR, **criteria):
+    """Versión más reciente con role=PRODUCTION_ROLE que cumple `criteria`
+
+    Lanza FileNotFoundError si no hay ninguna (no se recurre a otro modelo).
+    """
+    criteria = _normalized(dict(criteria, role=PRODUCTION_ROLE))
+    for metadata in list_models(registry_dir):
+        if all(metadata.get(key) == value for key, value in criteria.items()):
+            return metadata['version']
+    raise FileNotFoundError(
+        f"No hay un modelo de producción en el registro '{registry_dir}' para estos datos. "
+        "Ejecute primero prepare_powerbi_data.py."
+    )
+
+
+def load_model(version=None, registry_dir=REGISTRY_DIR):
+    """Cargar una versión del registro (por defecto la de producción más reciente)"""
+    if version is None:
+        version = production_version(registry_dir)
+    path = _version_path(registry_dir, version)
+    with open(os.path.join(path, METADATA_FILE)) as f:
+        metadata = json.load(f)
+    artifact = joblib.load(os.path.join(path, MODEL_FILE))
+    artifact.update(metadata)
+    return artifact
+
+
+def save_model(objects, data_hash, clustering_features, k, metrics=None, selection=None,
+               role=None, registry_dir=REGISTRY_DIR):
+    """Guardar una nueva versión y devolver su número
+
+    - objects: diccionario con los objetos ajustados (scaler, kmeans, pca,
+      le_item_type, le_fat_content, ...)
+    - data_hash: huella de los datos de entrenamiento
+    - selection: parámetros con los que se eligió k (None si k se fijó a mano)
+    - role: papel del modelo (PRODUCTION_ROLE para el del script de Power BI,
+      DASHBOARD_ROLE para los ajustes exploratorios)
+
+    El número de versión se reserva creando su directorio, así que dos
+    procesos que guardan a la vez no se pisan; metadata.json se escribe al
+    final y marca la versión como completa.
+    """
+    os.makedirs(registry_dir, exist_ok=True)
+    versions = _version_dirs(registry_dir)
+    version = versions[0] + 1 if versions else 1
+    while True:
+        path = _version_path(registry_dir, version)
+        try:
+            os.makedirs(path)
+            break
+        except FileExistsError:
+            version += 1
+
+    joblib.dump(objects, os.path.join(path, MODEL_FILE))
+    metadata = _normalized({
+        'version': version,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'data_hash': data_hash,
+        'clustering_features': list(clustering_features),
+        'k': int(k),
+        'selection': selection,
+        'role': role,
+        'metrics': metrics or {}
+    })
+    tmp_path = os.path.join(path, METADATA_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(tmp_path, os.path.join(path, METADATA_FILE))
+    return version
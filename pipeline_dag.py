@@ -0,0 +1,235 @@
+"""
+Ejecución del pipeline por etapas con caché de resultados
+Cada etapa declara sus etapas de entrada y sus parámetros; su huella
+(fingerprint) combina el nombre, los parámetros, la versión del pipeline y
+las huellas de sus entradas, de modo que se conoce antes de ejecutar nada.
+El resultado de cada etapa se guarda en .cache/stages/<etapa>-<huella>.joblib:
+en la siguiente ejecución las etapas cuya huella no cambió se saltan y el
+pipeline se reanuda desde la primera etapa invalidada (o desde la que falló).
+
+Uso:
+    stages = [
+        stage('load', load),
+        stage('clean', clean, inputs=['load']),
+        ...
+    ]
+    results = run_stages(stages, recorder=recorder)
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import joblib
+
+import data_pipeline
+
+# Directorio de los resultados cacheados de cada etapa
+STAGE_CACHE_DIR = os.path.join(data_pipeline.CACHE_DIR, 'stages')
+
+
+class ChangedOutputsError(Exception):
+    """Los archivos escritos por una etapa cacheada cambiaron en disco"""
+
+
+def stage(name, run, inputs=(), params=None, title=None, persist=True, check=None):
+    """Definir una etapa
+
+    - run: función que recibe los resultados de `inputs` (en ese orden) y
+      devuelve el resultado de la etapa
+    - params: parámetros que, si cambian, invalidan la etapa (deben poder
+      serializarse en JSON)
+    - persist: False para etapas baratas de repetir cuyo resultado no vale
+      la pena guardar (por ejemplo, la lectura del CSV si se cachea la limpieza)
+    - check: función que recibe el resultado cacheado y devuelve False si
+      hay que volver a ejecutar la etapa (por ejemplo, outputs_check)
+    """
+    return {
+        'name': name,
+        'run': run,
+        'inputs': list(inputs),
+        'params': params or {},
+        'title': title or name,
+        'persist': persist,
+        'check': check
+    }
+
+
+def fingerprints(stages):
+    """Huella de cada etapa (las etapas deben venir en orden topológico)"""
+    result = {}
+    for s in stages:
+        payload = {
+            'stage': s['name'],
+            'pipeline_version': data_pipeline.PIPELINE_VERSION,
+            'params': s['params'],
+            'inputs': [result[name] for name in s['inputs']]
+        }
+        encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+        result[s['name']] = hashlib.sha256(encoded).hexdigest()[:16]
+    return result
+
+
+def _entry_path(cache_dir, name, fingerprint):
+    return os.path.join(cache_dir, f'{name}-{fingerprint}.joblib')
+
+
+def _load_entry(path):
+    try:
+        return joblib.load(path)
+    except (OSError, EOFError, ValueError):
+        return None
+
+
+def _save_entry(path, value):
+    """Guardar un resultado (archivo temporal y renombrado, como en data_pipeline)"""
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.stage-', suffix='.tmp')
+    os.close(fd)
+    try:
+        joblib.dump(value, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def plan(stages, cache_dir=STAGE_CACHE_DIR, force=()):
+    """Decidir qué etapas se ejecutan
+
+    Devuelve (huellas, etapas a ejecutar, resultados cacheados ya leídos).
+    Se ejecutan las etapas forzadas y todas las que dependen de ellas, las
+    que no tienen resultado válido en la caché y las entradas no
+    persistidas que estas necesitan.
+    """
+    prints = fingerprints(stages)
+    by_name = {s['name']: s for s in stages}
+    loaded = {}
+
+    dirty = set()
+    for s in stages:
+        if s['name'] in force or any(name in dirty for name in s['inputs']):
+            dirty.add(s['name'])
+
+    def cached(s):
+        if not s['persist']:
+            return False
+        path = _entry_path(cache_dir, s['name'], prints[s['name']])
+        if not os.path.exists(path):
+            return False
+        if s['check'] is not None:
+            value = _load_entry(path)
+            if value is None or not s['check'](value):
+                return False
+            loaded[s['name']] = value
+        return True
+
+    to_run = {
+        s['name'] for s in stages
+        if s['name'] in dirty or (s['persist'] and not cached(s))
+    }
+    # Las entradas no persistidas solo se ejecutan si las necesita otra etapa
+    pending = list(to_run)
+    while pending:
+        for name in by_name[pending.pop()]['inputs']:
+            if name not in to_run and not by_name[name]['persist']:
+                to_run.add(name)
+                pending.append(name)
+    return prints, to_run, loaded
+
+
+def run_stages(stages, cache_dir=STAGE_CACHE_DIR, force=(), recorder=None, use_cache=True, verbose=True):
+    """Ejecutar las etapas necesarias y devolver los resultados disponibles
+
+    Los resultados de las etapas saltadas solo se leen de la caché si los
+    necesita alguna etapa que se ejecuta (o al final, si se piden con
+    load_result). Cada resultado nuevo se guarda en cuanto termina su
+    etapa, así que una ejecución interrumpida conserva lo ya calculado.
+    """
+    if use_cache:
+        prints, to_run, results = plan(stages, cache_dir, force)
+    else:
+        prints, to_run, results = fingerprints(stages), {s['name'] for s in stages}, {}
+
+    for i, s in enumerate(stages, start=1):
+        name = s['name']
+        fingerprint = prints[name]
+        if verbose:
+            print(f"\n{i}. {s['title']}...")
+        if name not in to_run:
+            if verbose and s['persist']:
+                print(f"   ✓ Resultado en caché (etapa '{name}', huella {fingerprint}), sin recalcular")
+            elif verbose:
+                print("   ✓ Sin ejecutar: las etapas que la usan están en caché")
+            if recorder is not None:
+                recorder.record(name, cached=True, fingerprint=fingerprint)
+            continue
+
+        inputs = [load_result(stages, results, dep, prints, cache_dir) for dep in s['inputs']]
+        if recorder is not None:
+            with recorder.stage(name, cached=False, fingerprint=fingerprint) as record:
+                value = s['run'](*inputs)
+                if hasattr(value, 'shape'):
+                    record['rows'] = len(value)
+        else:
+            value = s['run'](*inputs)
+        results[name] = value
+        if use_cache and s['persist']:
+            _save_entry(_entry_path(cache_dir, name, fingerprint), value)
+    return results
+
+
+def load_result(stages, results, name, prints=None, cache_dir=STAGE_CACHE_DIR):
+    """Resultado de una etapa: de esta ejecución o leído de la caché"""
+    if name not in results:
+        prints = prints or fingerprints(stages)
+        value = _load_entry(_entry_path(cache_dir, name, prints[name]))
+        if value is None:
+            raise FileNotFoundError(f"No hay resultado cacheado para la etapa '{name}'")
+        results[name] = value
+    return results[name]
+
+
+def path_signature(paths):
+    """Tamaño y fecha de modificación de archivos o directorios exportados"""
+    signature = {}
+    for path in paths:
+        if not os.path.exists(path):
+            signature[path] = None
+        elif os.path.isdir(path):
+            stats = [
+                os.stat(os.path.join(root, f))
+                for root, _, files in os.walk(path)
+                for f in files
+            ]
+            signature[path] = [len(stats), sum(st.st_size for st in stats),
+                               max((st.st_mtime_ns for st in stats), default=0)]
+        else:
+            st = os.stat(path)
+            signature[path] = [st.st_size, st.st_mtime_ns]
+    return signature
+
+
+def outputs_check(name):
+    """check= para etapas que escriben archivos (resultado con 'signature')
+
+    Si faltan archivos se vuelven a escribir. Si existen pero cambiaron,
+    regenerarlos desde los resultados cacheados podría pisar datos más
+    nuevos (por ejemplo, de otra herramienta), así que se lanza
+    ChangedOutputsError en lugar de decidirlo en silencio.
+    """
+    def check(result):
+        signature = result['signature']
+        current = path_signature(signature)
+        if any(value is None for value in current.values()):
+            return False
+        if current != signature:
+            raise ChangedOutputsError(
+                f"Los archivos de la etapa '{name}' cambiaron desde que se generaron "
+                f"({', '.join(signature)}). Use --rerun {name} para volver a escribirlos "
+                "a partir de la caché, o --rerun load para recalcular todo desde los datos."
+            )
+        return True
+    return check
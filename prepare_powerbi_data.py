@@ -3,214 +3,583 @@ Script para preparar datos para Power BI Dashboard
 Este script genera los archivos CSV necesarios para crear el dashboard en Power BI
 """
 
-import pandas as pd
+import argparse
+import os
+import sys
+
 import numpy as np
-from sklearn.preprocessing import StandardScaler, LabelEncoder
+from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA
 import warnings
 warnings.filterwarnings('ignore')
 
-print("="*80)
-print("PREPARACIÓN DE DATOS PARA POWER BI")
-print("="*80)
-
-# Cargar datos originales
-print("\n1. Cargando datos originales...")
-df = pd.read_csv('train_v9rqX0R.csv')
-print(f"   ✓ Dataset cargado: {df.shape[0]:,} registros")
-
-# Limpiar datos
-df_clean = df.copy()
-df_clean['Item_Fat_Content'] = df_clean['Item_Fat_Content'].replace({
-    'low fat': 'Low Fat',
-    'LF': 'Low Fat',
-    'reg': 'Regular'
-})
-
-# Construir dataset a nivel producto
-print("\n2. Construyendo dataset a nivel producto...")
-product_metrics = df_clean.groupby('Item_Identifier').agg({
-    'Item_Outlet_Sales': ['sum', 'mean', 'std', 'count'],
-    'Item_MRP': 'mean',
-    'Item_Weight': 'mean',
-    'Item_Visibility': 'mean',
-    'Outlet_Identifier': 'nunique',
-    'Item_Type': 'first',
-    'Item_Fat_Content': 'first'
-}).reset_index()
-
-product_metrics.columns = [
-    'Item_Identifier',
-    'Total_Sales',
-    'Avg_Sales_Per_Store',
-    'Std_Sales',
-    'Num_Store_Records',
-    'Avg_MRP',
-    'Avg_Weight',
-    'Avg_Visibility',
-    'Num_Stores',
-    'Item_Type',
-    'Item_Fat_Content'
-]
-
-# Tratar valores faltantes
-product_metrics['Avg_Weight'] = product_metrics.groupby('Item_Type')['Avg_Weight'].transform(
-    lambda x: x.fillna(x.median())
-)
-product_metrics['Avg_Weight'] = product_metrics['Avg_Weight'].fillna(product_metrics['Avg_Weight'].median())
-product_metrics['Std_Sales'] = product_metrics['Std_Sales'].fillna(0)
-
-# Codificar variables categóricas
-le_item_type = LabelEncoder()
-le_fat_content = LabelEncoder()
-product_metrics['Item_Type_Encoded'] = le_item_type.fit_transform(product_metrics['Item_Type'])
-product_metrics['Item_Fat_Content_Encoded'] = le_fat_content.fit_transform(product_metrics['Item_Fat_Content'])
-
-# Crear variables adicionales
-product_metrics['Sales_Stability'] = product_metrics['Std_Sales'] / (product_metrics['Avg_Sales_Per_Store'] + 1)
-product_metrics['Price_Per_Unit_Weight'] = product_metrics['Avg_MRP'] / (product_metrics['Avg_Weight'] + 1)
-
-# Clustering
-print("\n3. Aplicando clustering de productos...")
-clustering_features = [
-    'Total_Sales', 'Avg_Sales_Per_Store', 'Num_Stores', 'Avg_MRP',
-    'Avg_Weight', 'Avg_Visibility', 'Item_Type_Encoded',
-    'Item_Fat_Content_Encoded', 'Sales_Stability', 'Price_Per_Unit_Weight'
-]
-
-X_clustering = product_metrics[clustering_features].copy()
-scaler = StandardScaler()
-X_scaled = scaler.fit_transform(X_clustering)
-
-# Determinar número óptimo de clusters
-from sklearn.metrics import silhouette_score
-best_k = 2
-best_score = -1
-for k in range(2, 11):
-    kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
-    labels = kmeans.fit_predict(X_scaled)
-    score = silhouette_score(X_scaled, labels)
-    if score > best_score:
-        best_score = score
-        best_k = k
-
-print(f"   ✓ Número óptimo de clusters: {best_k} (Silhouette Score: {best_score:.4f})")
-
-# Aplicar clustering final
-kmeans_final = KMeans(n_clusters=best_k, random_state=42, n_init=10)
-product_metrics['cluster_producto'] = kmeans_final.fit_predict(X_scaled)
-print(f"   ✓ Clustering completado")
-
-# Incorporar clusters al dataset original
-print("\n4. Incorporando clusters al dataset original...")
-df_with_clusters = df_clean.merge(
-    product_metrics[['Item_Identifier', 'cluster_producto']],
-    on='Item_Identifier',
-    how='left'
-)
-print(f"   ✓ Dataset original con clusters: {df_with_clusters.shape}")
-
-# Análisis por tienda y cluster
-print("\n5. Calculando métricas por tienda y cluster...")
-store_cluster_analysis = df_with_clusters.groupby(['Outlet_Identifier', 'cluster_producto']).agg({
-    'Item_Outlet_Sales': ['sum', 'mean', 'count'],
-    'Item_Identifier': 'nunique',
-    'Item_MRP': 'mean'
-}).reset_index()
-
-store_cluster_analysis.columns = [
-    'Outlet_Identifier',
-    'cluster_producto',
-    'Total_Sales_Cluster',
-    'Avg_Sales_Per_Product',
-    'Num_Records',
-    'Num_Unique_Products',
-    'Avg_MRP'
-]
-
-store_total_sales = df_with_clusters.groupby('Outlet_Identifier')['Item_Outlet_Sales'].sum().reset_index()
-store_total_sales.columns = ['Outlet_Identifier', 'Store_Total_Sales']
-
-store_cluster_analysis = store_cluster_analysis.merge(store_total_sales, on='Outlet_Identifier')
-store_cluster_analysis['Pct_Sales_From_Cluster'] = (
-    store_cluster_analysis['Total_Sales_Cluster'] / 
-    store_cluster_analysis['Store_Total_Sales'] * 100
-)
-print(f"   ✓ Análisis tienda-cluster completado")
-
-# Dataset a nivel tienda
-print("\n6. Creando dataset a nivel tienda...")
-store_analysis = df_with_clusters.groupby('Outlet_Identifier').agg({
-    'Item_Outlet_Sales': 'sum',
-    'Outlet_Type': 'first',
-    'Outlet_Size': 'first',
-    'Outlet_Location_Type': 'first',
-    'Outlet_Establishment_Year': 'first',
-    'Item_Identifier': 'nunique'
-}).reset_index()
-
-store_analysis.columns = [
-    'Outlet_Identifier',
-    'Total_Sales',
-    'Outlet_Type',
-    'Outlet_Size',
-    'Outlet_Location_Type',
-    'Outlet_Establishment_Year',
-    'Num_Unique_Products'
-]
-
-cluster_pct_by_store = store_cluster_analysis.pivot_table(
-    index='Outlet_Identifier',
-    columns='cluster_producto',
-    values='Pct_Sales_From_Cluster',
-    fill_value=0
-)
-cluster_pct_by_store.columns = [f'Pct_Cluster_{int(col)}' for col in cluster_pct_by_store.columns]
-store_analysis = store_analysis.merge(cluster_pct_by_store, left_on='Outlet_Identifier', right_index=True)
-print(f"   ✓ Dataset a nivel tienda creado")
-
-# Guardar archivos
-print("\n7. Guardando archivos CSV para Power BI...")
-product_metrics.to_csv('product_metrics_with_clusters.csv', index=False)
-store_analysis.to_csv('store_analysis_with_clusters.csv', index=False)
-store_cluster_analysis.to_csv('store_cluster_analysis.csv', index=False)
-df_with_clusters.to_csv('original_data_with_clusters.csv', index=False)
-
-print("\n" + "="*80)
-print("ARCHIVOS GENERADOS PARA POWER BI:")
-print("="*80)
-print("1. product_metrics_with_clusters.csv")
-print("   - Dataset a nivel producto con clusters asignados")
-print("   - Usar para: Vista de Clusters de Productos")
-print(f"   - Registros: {len(product_metrics):,}")
-print()
-print("2. store_analysis_with_clusters.csv")
-print("   - Dataset a nivel tienda con mezcla de clusters")
-print("   - Usar para: Vista de Mezcla de Clusters por Tienda")
-print(f"   - Registros: {len(store_analysis)}")
-print()
-print("3. store_cluster_analysis.csv")
-print("   - Análisis detallado tienda-cluster")
-print("   - Usar para: Análisis cruzado tienda-cluster")
-print(f"   - Registros: {len(store_cluster_analysis)}")
-print()
-print("4. original_data_with_clusters.csv")
-print("   - Dataset original con clusters asignados")
-print("   - Usar para: Análisis detallado y drill-down")
-print(f"   - Registros: {len(df_with_clusters):,}")
-print()
-print("="*80)
-print("INSTRUCCIONES PARA POWER BI:")
-print("="*80)
-print("1. Abrir Power BI Desktop")
-print("2. Importar los 4 archivos CSV como fuentes de datos")
-print("3. Crear relaciones:")
-print("   - product_metrics_with_clusters[Item_Identifier] <-> original_data_with_clusters[Item_Identifier]")
-print("   - store_analysis_with_clusters[Outlet_Identifier] <-> original_data_with_clusters[Outlet_Identifier]")
-print("   - store_cluster_analysis[Outlet_Identifier] <-> store_analysis_with_clusters[Outlet_Identifier]")
-print("4. Crear medidas DAX según sea necesario")
-print("5. Diseñar las dos vistas del dashboard:")
-print("   - Vista 1: Clusters de Productos")
-print("   - Vista 2: Mezcla de Clusters por Tienda")
-print("="*80)
+import aggregation
+import clustering
+import data_pipeline
+import export
+import incremental
+import instrumentation
+import model_registry
+import pipeline_dag
+import similarity
+import stability
+
+# Etapas del pipeline (ver build_stages)
+STAGES = ['load', 'clean', 'product_metrics', 'sweep', 'fit', 'stability', 'merge', 'store_tables', 'export', 'save_state']
+
+
+def parse_args():
+    """Leer las opciones de línea de comandos"""
+    parser = argparse.ArgumentParser(description="Preparar datos para Power BI")
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help="Procesos para el barrido de k (-1 usa todos los núcleos)")
+    parser.add_argument('--warm-start', action='store_true',
+                        help="Ajustar cada k desde los centroides del k anterior")
+    parser.add_argument('--patience', type=int, default=None,
+                        help="Detener el barrido tras N valores de k sin mejora")
+    parser.add_argument('--criterion', default='silhouette', choices=list(clustering.CRITERIA),
+                        help="Criterio para elegir el número de clusters")
+    parser.add_argument('--sample-size', type=int, default=None,
+                        help="Productos en la muestra estratificada del Silhouette (por defecto todos)")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="Leer el CSV en bloques de N filas sin cargarlo entero: los agregados por "
+                             "producto y tienda se combinan bloque a bloque y la tabla a nivel fila se "
+                             "escribe por bloques (no admite --schema star, --partition-by ni --memory-report)")
+    parser.add_argument('--append', metavar='DELTA_CSV', default=None,
+                        help="Incorporar un archivo con ventas nuevas al resultado de la última ejecución")
+    parser.add_argument('--state-dir', default=incremental.STATE_DIR,
+                        help="Directorio del estado para actualizaciones incrementales")
+    parser.add_argument('--drift-threshold', type=float, default=incremental.DRIFT_THRESHOLD,
+                        help="Fracción de productos nuevos o reasignados que provoca un reajuste completo")
+    parser.add_argument('--memory-report', action='store_true',
+                        help="Mostrar la memoria del dataset con y sin el esquema tipado")
+    parser.add_argument('--k-min', type=int, default=2, help="Menor k evaluado")
+    parser.add_argument('--k-max', type=int, default=10, help="Mayor k evaluado")
+    parser.add_argument('--model-dir', default=model_registry.REGISTRY_DIR,
+                        help="Directorio del registro de modelos de clustering")
+    parser.add_argument('--refit', action='store_true',
+                        help="Reajustar el clustering aunque exista un modelo con las mismas entradas")
+    parser.add_argument('--stability-resamples', type=int, default=stability.N_BOOTSTRAP,
+                        help="Remuestras bootstrap para medir la estabilidad de los clusters (0 la desactiva)")
+    parser.add_argument('--stability-max-samples', type=int, default=stability.MAX_SAMPLES,
+                        help="Productos por remuestra bootstrap como máximo")
+    parser.add_argument('--output-dir', default='.', help="Directorio de los archivos para Power BI")
+    parser.add_argument('--format', default='csv', choices=export.OUTPUT_FORMATS,
+                        help="Formato de los archivos para Power BI")
+    parser.add_argument('--partition-by', default=None, choices=export.PARTITION_COLUMNS,
+                        help="Particionar la tabla a nivel fila por esta columna (solo parquet)")
+    parser.add_argument('--compression', default=export.DEFAULT_COMPRESSION,
+                        help="Compresión de los archivos Parquet (snappy, gzip, zstd, none)")
+    parser.add_argument('--schema', default='flat', choices=export.SCHEMAS,
+                        help="flat: tablas desnormalizadas; star: hechos con claves enteras y dimensiones")
+    parser.add_argument('--metrics-log', default=None,
+                        help="Añadir las métricas de cada etapa (tiempo, CPU, memoria, filas) a este archivo JSON lines")
+    parser.add_argument('--write-jobs', type=int, default=export.DEFAULT_WRITE_JOBS,
+                        help="Tablas que se escriben a la vez")
+    parser.add_argument('--store-jobs', type=int, default=1,
+                        help="Procesos para el análisis por tienda, repartiendo las filas por tienda (-1 usa todos los núcleos)")
+    parser.add_argument('--stage-cache-dir', default=pipeline_dag.STAGE_CACHE_DIR,
+                        help="Directorio de los resultados cacheados de cada etapa")
+    parser.add_argument('--rerun', nargs='+', default=None, choices=STAGES, metavar='ETAPA',
+                        help=f"Recalcular estas etapas y las que dependen de ellas ({', '.join(STAGES)})")
+    parser.add_argument('--no-stage-cache', action='store_true',
+                        help="Ejecutar todas las etapas sin leer ni guardar la caché de etapas")
+    args = parser.parse_args()
+    if args.partition_by and args.format != 'parquet':
+        parser.error("--partition-by requiere --format parquet")
+    if args.append and (args.format != 'csv' or args.schema != 'flat'):
+        parser.error("--append actualiza los archivos CSV desnormalizados; "
+                     "no se puede combinar con --format parquet ni --schema star")
+    if args.chunksize and (args.schema != 'flat' or args.partition_by or args.memory_report):
+        parser.error("--chunksize escribe las tablas desnormalizadas sin cargar el CSV entero; "
+                     "no se puede combinar con --schema star, --partition-by ni --memory-report")
+    if args.chunksize and args.rerun and 'clean' in args.rerun:
+        parser.error("con --chunksize la limpieza forma parte de la etapa load; use --rerun load")
+    if args.compression == 'none':
+        args.compression = None
+    return args
+
+
+def selection_params(args):
+    """Parámetros que determinan el k elegido por el barrido"""
+    return {
+        'criterion': args.criterion,
+        'k_min': args.k_min,
+        'k_max': args.k_max,
+        'sample_size': args.sample_size,
+        'warm_start': args.warm_start,
+        'patience': args.patience
+    }
+
+
+def scale_features(product_metrics):
+    """Escalar las variables de clustering"""
+    X_clustering = product_metrics[data_pipeline.CLUSTERING_FEATURES].copy()
+    scaler = StandardScaler()
+    return scaler, scaler.fit_transform(X_clustering)
+
+
+def choose_k(X_scaled, product_metrics, args):
+    """Barrido de k para elegir el número de clusters"""
+    sweep = clustering.sweep_k(
+        X_scaled,
+        k_values=range(args.k_min, args.k_max + 1),
+        n_jobs=args.n_jobs,
+        warm_start=args.warm_start,
+        patience=args.patience,
+        criterion=args.criterion,
+        sample_size=args.sample_size,
+        strata=product_metrics['Item_Type_Encoded']
+    )
+    if sweep['stopped_early']:
+        print(f"   ✓ Barrido detenido tras evaluar k={sweep['evaluated_k'][0]}..{sweep['evaluated_k'][-1]}")
+
+    print(f"   ✓ Número óptimo de clusters: {clustering.describe_sweep(sweep)}")
+    return sweep
+
+
+def fit_kmeans(X_scaled, k):
+    """Ajustar el KMeans final"""
+    return KMeans(n_clusters=k, random_state=42, n_init=10).fit(X_scaled)
+
+
+def fit_product_clusters(product_metrics, args):
+    """Escalar las variables, elegir k y ajustar el KMeans final"""
+    scaler, X_scaled = scale_features(product_metrics)
+    sweep = choose_k(X_scaled, product_metrics, args)
+    return scaler, fit_kmeans(X_scaled, sweep['best_k']), sweep
+
+
+def run_incremental(args, recorder):
+    """Incorporar un archivo delta de ventas sin reprocesar todo el historial"""
+    print("="*80)
+    print("ACTUALIZACIÓN INCREMENTAL DE DATOS PARA POWER BI")
+    print("="*80)
+
+    print(f"\nIncorporando ventas nuevas desde {args.append}...")
+    with recorder.stage('apply_delta') as record:
+        summary = incremental.apply_delta(
+            args.append,
+            refit=lambda product_metrics: fit_product_clusters(product_metrics, args)[:2],
+            state_dir=args.state_dir,
+            output_dir=args.output_dir,
+            drift_threshold=args.drift_threshold
+        )
+        record['rows'] = summary['delta_rows']
+    print(f"   ✓ Registros nuevos: {summary['delta_rows']:,}")
+    print(f"   ✓ Productos afectados: {summary['affected_products']:,} "
+          f"({summary['new_products']:,} nuevos, {summary['reassigned_products']:,} reasignados)")
+    print(f"   ✓ Deriva: {summary['drift']:.2%} (umbral {args.drift_threshold:.2%})")
+    if summary['unseen_categories']:
+        print("   ✓ Categorías nuevas de producto: se reajustó el clustering completo")
+    elif summary['refit']:
+        print("   ✓ Deriva sobre el umbral: se reajustó el clustering completo")
+    print(f"   ✓ Tiendas actualizadas: {summary['affected_outlets']:,}")
+
+
+def print_star_summary(paths, rows, args):
+    """Archivos del esquema en estrella y relaciones a crear en Power BI"""
+    print("\n" + "="*80)
+    print("ARCHIVOS GENERADOS PARA POWER BI (ESQUEMA EN ESTRELLA):")
+    print("="*80)
+    for name, path in paths.items():
+        print(f"- {path}: {rows[name]:,} registros")
+    print()
+    print("="*80)
+    print("INSTRUCCIONES PARA POWER BI:")
+    print("="*80)
+    print("1. Abrir Power BI Desktop")
+    print(f"2. Importar los {len(paths)} archivos {args.format.upper()} como fuentes de datos")
+    print("3. Crear relaciones (muchos a uno, sobre claves enteras):")
+    print("   - fact_sales[Product_Key] -> dim_product[Product_Key]")
+    print("   - fact_sales[Outlet_Key] -> dim_outlet[Outlet_Key]")
+    print("   - fact_sales[Cluster_Key] -> dim_cluster[Cluster_Key]")
+    print("   - fact_store_cluster[Outlet_Key] -> dim_outlet[Outlet_Key]")
+    print("   - fact_store_cluster[Cluster_Key] -> dim_cluster[Cluster_Key]")
+    print("4. Ocultar las claves y crear las medidas DAX sobre las tablas de hechos")
+    print("5. Diseñar las dos vistas del dashboard:")
+    print("   - Vista 1: Clusters de Productos (dim_product, dim_cluster)")
+    print("   - Vista 2: Mezcla de Clusters por Tienda (fact_store_cluster, dim_outlet)")
+    print("="*80)
+
+
+def build_stages(args, recorder):
+    """Etapas del pipeline de Power BI, en orden de ejecución
+
+    Los parámetros de cada etapa son los que cambian su resultado; las
+    opciones de rendimiento (--n-jobs, --store-jobs, --write-jobs) no
+    invalidan la caché.
+    """
+    clustering_features = data_pipeline.CLUSTERING_FEATURES
+    # Las ventas incorporadas con --append forman parte de los datos (y de su huella)
+    delta_log = incremental.delta_log_path(args.state_dir)
+    data_hash = data_pipeline.cache_key(data_pipeline.DATA_PATH, delta_log)
+    source = {'path': data_pipeline.DATA_PATH, 'data_hash': data_hash}
+    selection = selection_params(args)
+
+    def load():
+        raw = data_pipeline.load_raw_data(delta_log=delta_log)
+        print(f"   ✓ Dataset cargado: {raw.shape[0]:,} registros")
+        return raw
+
+    def clean(raw):
+        df_clean = data_pipeline.clean_data(raw)
+        print(f"   ✓ Variantes de Item_Fat_Content unificadas: {', '.join(df_clean['Item_Fat_Content'].cat.categories)}")
+        if args.memory_report:
+            before, after = data_pipeline.memory_report(df_clean)
+            print(f"   ✓ Memoria: {before / 1e6:,.1f} MB sin esquema -> {after / 1e6:,.1f} MB con esquema tipado")
+        return df_clean
+
+    def clean_chunks():
+        chunks = data_pipeline.read_sales_chunks(chunksize=args.chunksize, delta_log=delta_log)
+        return (data_pipeline.clean_data(chunk) for chunk in chunks)
+
+    def load_aggregates():
+        # Modo por bloques: una pasada que reduce las ventas a agregados
+        # combinables por producto, por par producto-tienda y por tienda
+        print(f"   ✓ Lectura por bloques de {args.chunksize:,} filas")
+        aggregates = incremental.stream_sales_aggregates(clean_chunks())
+        print(f"   ✓ Pares producto-tienda: {len(aggregates['pairs']):,}")
+        return aggregates
+
+    def product_metrics(df_clean):
+        result = data_pipeline.finalize_product_metrics(
+            data_pipeline.aggregate_product_metrics(df_clean)
+        )
+        print(f"   ✓ Productos únicos: {len(result[0]):,}")
+        return result
+
+    def product_metrics_from_aggregates(aggregates):
+        result = data_pipeline.finalize_product_metrics(
+            data_pipeline.product_metrics_from_partials(
+                aggregates['partials'], aggregates['pairs'].reset_index()
+            )
+        )
+        print(f"   ✓ Productos únicos: {len(result[0]):,}")
+        return result
+
+    def sweep(product_result):
+        # Un modelo registrado con las mismas entradas evita el barrido
+        if not args.refit:
+            artifact = model_registry.find_model(
+                args.model_dir, data_hash=data_hash, clustering_features=clustering_features,
+                selection=selection, role=model_registry.PRODUCTION_ROLE
+            )
+            if artifact is not None:
+                print(f"   ✓ Modelo v{artifact['version']} del registro reutilizado (k={artifact['k']}), sin reajustar")
+                return {'k': artifact['k'], 'version': artifact['version'], 'sweep': None}
+        product_metrics = product_result[0]
+        _, X_scaled = scale_features(product_metrics)
+        result = choose_k(X_scaled, product_metrics, args)
+        instrumentation.record_sweep(recorder, result)
+        return {'k': result['best_k'], 'version': None, 'sweep': result}
+
+    def fit(product_result, selected):
+        if selected['version'] is not None:
+            artifact = model_registry.load_model(selected['version'], args.model_dir)
+            return {'scaler': artifact['scaler'], 'kmeans': artifact['kmeans']}
+        product_metrics, le_item_type, le_fat_content = product_result
+        scaler, X_scaled = scale_features(product_metrics)
+        kmeans_final = fit_kmeans(X_scaled, selected['k'])
+        pca = PCA(n_components=3).fit(X_scaled)
+        result = selected['sweep']
+        version = model_registry.save_model(
+            {
+                'scaler': scaler,
+                'kmeans': kmeans_final,
+                'pca': pca,
+                'le_item_type': le_item_type,
+                'le_fat_content': le_fat_content,
+                # Imputación congelada de Avg_Weight para asignar productos nuevos (scoring.py)
+                'imputation': incremental.frozen_imputation(product_metrics),
+                similarity.REGISTRY_KEY: similarity.build_index(X_scaled, product_metrics['Item_Identifier'])
+            },
+            data_hash=data_hash,
+            clustering_features=clustering_features,
+            k=kmeans_final.n_clusters,
+            metrics={
+                'criterion': result['criterion'],
+                'score': float(result['best_score']),
+                'scores': {str(k): float(v) for k, v in result['scores'].items()},
+                'inertia': float(kmeans_final.inertia_)
+            },
+            selection=selection,
+            role=model_registry.PRODUCTION_ROLE,
+            registry_dir=args.model_dir
+        )
+        print(f"   ✓ Modelo guardado en el registro como v{version}")
+        return {'scaler': scaler, 'kmeans': kmeans_final}
+
+    def cluster_stability(product_result, model):
+        if args.stability_resamples <= 0:
+            print("   ✓ Desactivada (--stability-resamples 0)")
+            return None
+        product_metrics = product_result[0]
+        X_scaled = model['scaler'].transform(product_metrics[clustering_features])
+        labels = model['kmeans'].labels_
+        result = stability.bootstrap_stability(
+            X_scaled, labels,
+            n_bootstrap=args.stability_resamples,
+            max_samples=args.stability_max_samples,
+            n_jobs=args.n_jobs
+        )
+        print(f"   ✓ {stability.describe_stability(result)}")
+        for row in stability.cluster_table(result, labels).itertuples():
+            print(f"     Cluster {row.cluster_producto}: Jaccard {row.Jaccard_Mean:.2f}, "
+                  f"confianza media {row.Avg_Confidence:.0%} ({row.Num_Products:,} productos)")
+        return result
+
+    def merge(product_result, model, stability_result):
+        print(f"   ✓ Clustering completado")
+        product_metrics = product_result[0].assign(cluster_producto=model['kmeans'].labels_)
+        if stability_result is not None:
+            # Fracción de remuestras bootstrap que mantienen al producto en su cluster
+            product_metrics[incremental.CONFIDENCE_COLUMN] = stability_result['confidence']
+            product_metrics[incremental.STALE_COLUMN] = False
+        return product_metrics
+
+    def store_tables(df_clean, product_metrics):
+        # Tablas por tienda en una sola pasada sobre los códigos de
+        # producto, tienda y cluster (las filas con cluster se arman al exportar)
+        _, store_cluster_analysis, store_analysis = aggregation.store_tables(
+            df_clean, product_metrics, include_rows=False, n_jobs=args.store_jobs
+        )
+        print(f"   ✓ Análisis tienda-cluster completado")
+        print(f"   ✓ Dataset a nivel tienda creado")
+        return {'store_cluster_analysis': store_cluster_analysis, 'store_analysis': store_analysis}
+
+    def store_tables_from_aggregates(aggregates, product_metrics):
+        store_cluster_analysis, store_analysis = incremental.store_tables_from_pairs(
+            aggregates['pairs'], aggregates['outlets'],
+            product_metrics.set_index('Item_Identifier')['cluster_producto']
+        )
+        print(f"   ✓ Análisis tienda-cluster completado")
+        print(f"   ✓ Dataset a nivel tienda creado")
+        return {'store_cluster_analysis': store_cluster_analysis, 'store_analysis': store_analysis}
+
+    def export_tables(df_clean, product_metrics, stores):
+        sales_codes = aggregation.factorize_sales(df_clean)
+        if args.schema == 'star':
+            tables = export.star_schema(
+                df_clean, product_metrics, stores['store_cluster_analysis'], stores['store_analysis'],
+                sales_codes
+            )
+            partitioned_table = export.STAR_FACT_TABLE
+            partition_by = export.STAR_PARTITION_KEYS.get(args.partition_by)
+        else:
+            df_with_clusters = df_clean.assign(
+                cluster_producto=aggregation.row_clusters(product_metrics, sales_codes)
+            )
+            print(f"   ✓ Dataset original con clusters: {df_with_clusters.shape}")
+            tables = {
+                'product_metrics_with_clusters': product_metrics,
+                'store_analysis_with_clusters': stores['store_analysis'],
+                'store_cluster_analysis': stores['store_cluster_analysis'],
+                'original_data_with_clusters': df_with_clusters
+            }
+            partitioned_table = export.PARTITIONED_TABLE
+            partition_by = args.partition_by
+        paths = export.write_tables(
+            tables,
+            output_dir=args.output_dir,
+            fmt=args.format,
+            partition_by=partition_by,
+            compression=args.compression,
+            n_jobs=args.write_jobs,
+            partitioned_table=partitioned_table
+        )
+        return exported(paths, {name: len(table) for name, table in tables.items()})
+
+    def export_chunks(product_metrics, stores):
+        # Modo por bloques: las tablas agregadas se escriben enteras y la
+        # tabla a nivel fila con una segunda lectura del CSV por bloques
+        tables = {
+            'product_metrics_with_clusters': product_metrics,
+            'store_analysis_with_clusters': stores['store_analysis'],
+            'store_cluster_analysis': stores['store_cluster_analysis']
+        }
+        paths = export.write_tables(
+            tables,
+            output_dir=args.output_dir,
+            fmt=args.format,
+            compression=args.compression,
+            n_jobs=args.write_jobs
+        )
+        rows = {name: len(table) for name, table in tables.items()}
+        paths[export.PARTITIONED_TABLE], rows[export.PARTITIONED_TABLE] = export.write_table_chunks(
+            export.cluster_row_chunks(clean_chunks(), product_metrics),
+            args.output_dir, export.PARTITIONED_TABLE, fmt=args.format, compression=args.compression
+        )
+        print(f"   ✓ Dataset original con clusters: {rows[export.PARTITIONED_TABLE]:,} registros escritos por bloques")
+        return exported(paths, rows)
+
+    def exported(paths, rows):
+        for path in paths.values():
+            print(f"   ✓ {path} ({export.disk_size(path) / 1e6:,.2f} MB)")
+        return {
+            'paths': paths,
+            'rows': rows,
+            'signature': pipeline_dag.path_signature(paths.values())
+        }
+
+    def save_state(aggregates, product_result, product_metrics, model):
+        # Estado para actualizaciones incrementales (--append)
+        _, le_item_type, le_fat_content = product_result
+        incremental.save_state(
+            aggregates, product_metrics, model['scaler'], model['kmeans'], le_item_type, le_fat_content,
+            state_dir=args.state_dir
+        )
+        paths = [os.path.join(args.state_dir, name) for name in sorted(os.listdir(args.state_dir))]
+        return {'signature': pipeline_dag.path_signature(paths)}
+
+    def save_state_from_clean(df_clean, product_result, product_metrics, model):
+        return save_state(incremental.sales_aggregates(df_clean), product_result, product_metrics, model)
+
+    if args.chunksize:
+        # En modo por bloques el CSV nunca se carga entero: 'load' guarda los
+        # agregados de una pasada y la exportación relee las filas por bloques
+        sales = [
+            pipeline_dag.stage('load', load_aggregates, params=source,
+                               title="Leyendo y agregando las ventas por bloques")
+        ]
+        run = {
+            'product_metrics': product_metrics_from_aggregates,
+            'store_tables': store_tables_from_aggregates,
+            'export': export_chunks,
+            'save_state': save_state
+        }
+        export_inputs = ['merge', 'store_tables']
+    else:
+        sales = [
+            pipeline_dag.stage('load', load, params=source, title="Cargando datos originales", persist=False),
+            pipeline_dag.stage('clean', clean, inputs=['load'], title="Limpiando datos")
+        ]
+        run = {
+            'product_metrics': product_metrics,
+            'store_tables': store_tables,
+            'export': export_tables,
+            'save_state': save_state_from_clean
+        }
+        export_inputs = ['clean', 'merge', 'store_tables']
+    # Etapa con las ventas: filas limpias, o sus agregados en modo por bloques
+    rows = sales[-1]['name']
+    products = [
+        pipeline_dag.stage('product_metrics', run['product_metrics'], inputs=[rows],
+                           title="Construyendo dataset a nivel producto"),
+        pipeline_dag.stage('sweep', sweep, inputs=['product_metrics'],
+                           params={'selection': selection, 'model_dir': os.path.abspath(args.model_dir)},
+                           title="Eligiendo el número de clusters"),
+        pipeline_dag.stage('fit', fit, inputs=['product_metrics', 'sweep'],
+                           title="Aplicando clustering de productos"),
+        pipeline_dag.stage('stability', cluster_stability, inputs=['product_metrics', 'fit'],
+                           params={
+                               'resamples': args.stability_resamples,
+                               'max_samples': args.stability_max_samples
+                           },
+                           title="Midiendo la estabilidad de los clusters (bootstrap)"),
+        pipeline_dag.stage('merge', merge, inputs=['product_metrics', 'fit', 'stability'],
+                           title="Incorporando clusters a los productos")
+    ]
+    stores = [
+        pipeline_dag.stage('store_tables', run['store_tables'], inputs=[rows, 'merge'],
+                           title="Calculando métricas por tienda"),
+        pipeline_dag.stage('export', run['export'], inputs=export_inputs,
+                           params={
+                               'format': args.format,
+                               'schema': args.schema,
+                               'partition_by': args.partition_by,
+                               'compression': args.compression,
+                               'output_dir': os.path.abspath(args.output_dir)
+                           },
+                           title=f"Guardando archivos {args.format.upper()} para Power BI",
+                           check=pipeline_dag.outputs_check('export')),
+        pipeline_dag.stage('save_state', run['save_state'], inputs=[rows, 'product_metrics', 'merge', 'fit'],
+                           params={'state_dir': os.path.abspath(args.state_dir)},
+                           title="Guardando el estado para actualizaciones incrementales",
+                           check=pipeline_dag.outputs_check('save_state'))
+    ]
+    return sales + products + stores
+
+
+def main():
+    args = parse_args()
+    # Métricas por etapa; con --metrics-log se añaden al archivo JSON lines
+    recorder = instrumentation.Recorder(args.metrics_log)
+    if args.append:
+        run_incremental(args, recorder)
+        return
+
+    print("="*80)
+    print("PREPARACIÓN DE DATOS PARA POWER BI")
+    print("="*80)
+
+    # Las etapas con la misma huella que en una ejecución anterior se leen
+    # de la caché; --rerun fuerza una etapa y todas las que dependen de ella
+    stages = build_stages(args, recorder)
+    force = set(args.rerun or [])
+    if args.refit:
+        force.add('sweep')
+    try:
+        results = pipeline_dag.run_stages(
+            stages,
+            cache_dir=args.stage_cache_dir,
+            force=force,
+            recorder=recorder,
+            use_cache=not args.no_stage_cache
+        )
+    except pipeline_dag.ChangedOutputsError as exc:
+        print(f"\n⚠ {exc}")
+        sys.exit(1)
+    exported = pipeline_dag.load_result(stages, results, 'export', cache_dir=args.stage_cache_dir)
+    paths, rows = exported['paths'], exported['rows']
+
+    if args.schema == 'star':
+        print_star_summary(paths, rows, args)
+        return
+
+    print("\n" + "="*80)
+    print("ARCHIVOS GENERADOS PARA POWER BI:")
+    print("="*80)
+    print(f"1. {paths['product_metrics_with_clusters']}")
+    print("   - Dataset a nivel producto con clusters asignados")
+    print("   - Usar para: Vista de Clusters de Productos")
+    print(f"   - Registros: {rows['product_metrics_with_clusters']:,}")
+    print()
+    print(f"2. {paths['store_analysis_with_clusters']}")
+    print("   - Dataset a nivel tienda con mezcla de clusters")
+    print("   - Usar para: Vista de Mezcla de Clusters por Tienda")
+    print(f"   - Registros: {rows['store_analysis_with_clusters']}")
+    print()
+    print(f"3. {paths['store_cluster_analysis']}")
+    print("   - Análisis detallado tienda-cluster")
+    print("   - Usar para: Análisis cruzado tienda-cluster")
+    print(f"   - Registros: {rows['store_cluster_analysis']}")
+    print()
+    print(f"4. {paths['original_data_with_clusters']}")
+    print("   - Dataset original con clusters asignados")
+    print("   - Usar para: Análisis detallado y drill-down")
+    print(f"   - Registros: {rows['original_data_with_clusters']:,}")
+    print()
+    print("="*80)
+    print("INSTRUCCIONES PARA POWER BI:")
+    print("="*80)
+    print("1. Abrir Power BI Desktop")
+    if args.format == 'parquet':
+        print("2. Importar los 4 archivos Parquet como fuentes de datos (Obtener datos > Parquet;")
+        print("   las tablas particionadas se importan como carpeta)")
+    else:
+        print("2. Importar los 4 archivos CSV como fuentes de datos")
+    print("3. Crear relaciones:")
+    print("   - product_metrics_with_clusters[Item_Identifier] <-> original_data_with_clusters[Item_Identifier]")
+    print("   - store_analysis_with_clusters[Outlet_Identifier] <-> original_data_with_clusters[Outlet_Identifier]")
+    print("   - store_cluster_analysis[Outlet_Identifier] <-> store_analysis_with_clusters[Outlet_Identifier]")
+    print("4. Crear medidas DAX según sea necesario")
+    print("5. Diseñar las dos vistas del dashboard:")
+    print("   - Vista 1: Clusters de Productos")
+    print("   - Vista 2: Mezcla de Clusters por Tienda")
+    print("="*80)
+
 
+if __name__ == '__main__':
+    main()
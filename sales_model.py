@@ -0,0 +1,289 @@
+"""
+Modelo de predicción de Item_Outlet_Sales
+Entrena un HistGradientBoostingRegressor sobre las variables a nivel fila
+(atributos del producto, cluster_producto y atributos de la tienda) y
+predice en bloques de tamaño fijo, de modo que la memoria no depende del
+número de filas. La predicción del surtido completo genera todas las
+combinaciones producto×tienda por bloques, sin materializar el producto
+cartesiano, y escribe el resultado en Parquet o CSV.
+
+Uso:
+    python sales_model.py train
+    python sales_model.py forecast --output forecast.parquet
+"""
+
+import argparse
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.model_selection import train_test_split
+
+import data_pipeline
+import incremental
+import instrumentation
+import model_registry
+import scoring
+
+TARGET = 'Item_Outlet_Sales'
+
+# Variables del producto y de la tienda (las de texto son categóricas)
+PRODUCT_FEATURES = ['Item_Weight', 'Item_Fat_Content', 'Item_Visibility', 'Item_Type', 'Item_MRP', 'cluster_producto']
+OUTLET_FEATURES = ['Outlet_Identifier', 'Outlet_Establishment_Year', 'Outlet_Size', 'Outlet_Location_Type', 'Outlet_Type']
+FEATURES = PRODUCT_FEATURES + OUTLET_FEATURES
+CATEGORICAL_FEATURES = [
+    'Item_Fat_Content', 'Item_Type', 'cluster_producto',
+    'Outlet_Identifier', 'Outlet_Size', 'Outlet_Location_Type', 'Outlet_Type'
+]
+
+# Columnas de product_metrics con el valor de cada variable del producto
+PRODUCT_COLUMNS = {
+    'Item_Weight': 'Avg_Weight',
+    'Item_Visibility': 'Avg_Visibility',
+    'Item_MRP': 'Avg_MRP'
+}
+
+# Categorías por encima de este número se tratan como variable ordinal
+# (el learner admite como mucho max_bins categorías por variable)
+MAX_CATEGORIES = 255
+
+MODEL_PATH = os.path.join(model_registry.REGISTRY_DIR, 'sales_model.joblib')
+DEFAULT_CHUNKSIZE = 500_000
+TEST_SIZE = 0.2
+RANDOM_STATE = 42
+
+
+def encode(df, model, columns=FEATURES):
+    """Matriz float64 de las variables `columns` (por defecto FEATURES, en ese orden)
+
+    Las categóricas se convierten a los códigos de las categorías vistas al
+    entrenar; los valores nuevos o faltantes quedan como NaN, que el
+    learner trata como faltantes.
+    """
+    X = np.empty((len(df), len(columns)))
+    for j, col in enumerate(columns):
+        if col in model['categories']:
+            codes = pd.Categorical(np.asarray(df[col], dtype=object), categories=model['categories'][col]).codes
+            X[:, j] = np.where(codes >= 0, codes, np.nan)
+        else:
+            X[:, j] = pd.to_numeric(df[col], errors='coerce')
+    return X
+
+
+def _categories(df):
+    """Categorías observadas de cada variable categórica"""
+    categories = {}
+    for col in CATEGORICAL_FEATURES:
+        values = pd.Series(np.asarray(df[col], dtype=object)).dropna().unique()
+        categories[col] = sorted(values, key=str)
+    return categories
+
+
+def train(df_with_clusters, test_size=TEST_SIZE, random_state=RANDOM_STATE, **params):
+    """Entrenar el modelo sobre las filas con cluster_producto
+
+    Reserva `test_size` de las filas para medir RMSE y R². Devuelve un
+    diccionario con el learner, las categorías y las métricas de
+    entrenamiento (filas, tiempo y filas por segundo).
+    """
+    model = {'categories': _categories(df_with_clusters)}
+    categorical = [
+        col in model['categories'] and len(model['categories'][col]) <= MAX_CATEGORIES
+        for col in FEATURES
+    ]
+    X = encode(df_with_clusters, model)
+    y = df_with_clusters[TARGET].to_numpy(dtype=np.float64)
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=test_size, random_state=random_state
+    )
+
+    settings = {'max_iter': 300, 'learning_rate': 0.05, 'early_stopping': True, 'random_state': random_state}
+    settings.update(params)
+    learner = HistGradientBoostingRegressor(categorical_features=np.array(categorical), **settings)
+    start = time.perf_counter()
+    learner.fit(X_train, y_train)
+    train_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predicted = learner.predict(X_test)
+    predict_s = time.perf_counter() - start
+
+    model.update({
+        'learner': learner,
+        'features': FEATURES,
+        'metrics': {
+            'rmse': float(np.sqrt(mean_squared_error(y_test, predicted))),
+            'r2': float(r2_score(y_test, predicted)),
+            'train_rows': len(X_train),
+            'test_rows': len(X_test),
+            'n_iter': int(learner.n_iter_),
+            'train_s': round(train_s, 4),
+            'train_rows_per_s': round(len(X_train) / train_s),
+            'predict_rows_per_s': round(len(X_test) / predict_s) if predict_s > 0 else None
+        }
+    })
+    return model
+
+
+def predict(model, df, chunksize=DEFAULT_CHUNKSIZE):
+    """Predicción por bloques de `chunksize` filas"""
+    predictions = np.empty(len(df))
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start:start + chunksize]
+        predictions[start:start + len(chunk)] = model['learner'].predict(encode(chunk, model))
+    return predictions
+
+
+def assortment_inputs(product_metrics, outlets):
+    """Variables por producto y por tienda para predecir el surtido completo
+
+    - product_metrics: una fila por producto con cluster_producto
+    - outlets: atributos de cada tienda indexados por Outlet_Identifier
+      (como incremental.outlet_attributes)
+    """
+    products = pd.DataFrame({
+        col: product_metrics[PRODUCT_COLUMNS.get(col, col)].to_numpy()
+        for col in PRODUCT_FEATURES
+    })
+    products.insert(0, 'Item_Identifier', product_metrics['Item_Identifier'].to_numpy())
+    outlets = outlets.reset_index()[OUTLET_FEATURES]
+    return products, outlets
+
+
+def forecast_assortment(model, products, outlets, chunksize=DEFAULT_CHUNKSIZE):
+    """Predecir todas las combinaciones producto×tienda por bloques
+
+    Codifica una sola vez las variables de productos y tiendas; cada bloque
+    de `chunksize` filas se arma indexando esas matrices, así que la
+    memoria depende del tamaño del bloque y no de productos×tiendas.
+    Devuelve un generador de DataFrames (Item_Identifier,
+    Outlet_Identifier, Predicted_Sales) ordenados por tienda.
+    """
+    product_cols = [FEATURES.index(col) for col in PRODUCT_FEATURES]
+    outlet_cols = [FEATURES.index(col) for col in OUTLET_FEATURES]
+    product_X = encode(products, model, PRODUCT_FEATURES)
+    outlet_X = encode(outlets, model, OUTLET_FEATURES)
+    item_ids = products['Item_Identifier'].to_numpy()
+    outlet_ids = outlets['Outlet_Identifier'].to_numpy()
+
+    n_products = len(products)
+    total = n_products * len(outlets)
+    X = np.empty((min(chunksize, total), len(FEATURES)))
+    for start in range(0, total, chunksize):
+        rows = np.arange(start, min(start + chunksize, total))
+        product_pos = rows % n_products
+        outlet_pos = rows // n_products
+        block = X[:len(rows)]
+        block[:, product_cols] = product_X[product_pos]
+        block[:, outlet_cols] = outlet_X[outlet_pos]
+        yield pd.DataFrame({
+            'Item_Identifier': item_ids[product_pos],
+            'Outlet_Identifier': outlet_ids[outlet_pos],
+            'Predicted_Sales': model['learner'].predict(block)
+        })
+
+
+def save(model, path=MODEL_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    joblib.dump(model, path)
+    return path
+
+
+def load(path=MODEL_PATH):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No existe el modelo de ventas '{path}'. Ejecute primero: python sales_model.py train")
+    return joblib.load(path)
+
+
+def clustered_data(registry_dir=model_registry.REGISTRY_DIR):
+    """df_clean y product_metrics con el cluster del modelo de producción
+    registrado para el CSV actual"""
+    df_clean, product_metrics, _, _ = data_pipeline.load_and_process_data()
+    version = model_registry.production_version(
+        registry_dir,
+        data_hash=data_pipeline.cache_key(data_pipeline.DATA_PATH),
+        clustering_features=data_pipeline.CLUSTERING_FEATURES
+    )
+    scorer = scoring.load_scorer(version, registry_dir)
+    clusters = scoring.assign_clusters(product_metrics, scorer)['cluster_producto'].to_numpy()
+    product_metrics = product_metrics.assign(cluster_producto=clusters)
+    clusters_by_item = pd.Series(clusters, index=np.asarray(product_metrics['Item_Identifier'], dtype=object))
+    row_clusters = clusters_by_item.reindex(np.asarray(df_clean['Item_Identifier'], dtype=object)).to_numpy()
+    return df_clean.assign(cluster_producto=row_clusters), product_metrics, version
+
+
+def _write_chunks(chunks, path):
+    """Escribir los bloques a medida que se generan; devuelve el número de filas"""
+    rows = 0
+    if path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            rows += len(chunk)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Modelo de predicción de Item_Outlet_Sales")
+    parser.add_argument('command', choices=['train', 'forecast'],
+                        help="train: entrenar y guardar; forecast: predecir el surtido completo por tienda")
+    parser.add_argument('--model-path', default=MODEL_PATH, help="Archivo del modelo de ventas")
+    parser.add_argument('--model-dir', default=model_registry.REGISTRY_DIR,
+                        help="Registro de modelos de clustering (para cluster_producto)")
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help="Filas por bloque de predicción")
+    parser.add_argument('--output', default='sales_forecast.parquet',
+                        help="Archivo de predicciones (.parquet o .csv)")
+    parser.add_argument('--metrics-log', default=None,
+                        help="Añadir las métricas de cada etapa a este archivo JSON lines")
+    args = parser.parse_args()
+    recorder = instrumentation.Recorder(args.metrics_log)
+
+    with recorder.stage('load') as record:
+        df_with_clusters, product_metrics, cluster_version = clustered_data(args.model_dir)
+        record['rows'] = len(df_with_clusters)
+    print(f"✓ {len(df_with_clusters):,} filas con clusters del modelo v{cluster_version}")
+
+    if args.command == 'train':
+        with recorder.stage('train', rows=len(df_with_clusters)):
+            model = train(df_with_clusters)
+        model['cluster_version'] = cluster_version
+        metrics = model['metrics']
+        print(f"✓ Entrenado en {metrics['train_s']:.2f} s ({metrics['train_rows_per_s']:,} filas/s, "
+              f"{metrics['n_iter']} iteraciones)")
+        print(f"✓ Validación ({metrics['test_rows']:,} filas): RMSE {metrics['rmse']:,.1f}, R² {metrics['r2']:.3f}")
+        print(f"✓ Modelo guardado en {save(model, args.model_path)}")
+        return
+
+    model = load(args.model_path)
+    if model.get('cluster_version') != cluster_version:
+        print(f"⚠ El modelo de ventas se entrenó con los clusters de v{model.get('cluster_version')}, "
+              f"no con los de v{cluster_version}: conviene reentrenarlo")
+    products, outlets = assortment_inputs(product_metrics, incremental.outlet_attributes(df_with_clusters))
+    total = len(products) * len(outlets)
+    with recorder.stage('forecast', rows=total, chunksize=args.chunksize) as record:
+        rows = _write_chunks(forecast_assortment(model, products, outlets, args.chunksize), args.output)
+    memory = '' if record['rss_peak_mb'] is None else f", pico de memoria {record['rss_peak_mb']:,.0f} MB"
+    print(f"✓ {rows:,} predicciones producto×tienda en {record['wall_s']:.2f} s "
+          f"({rows / record['wall_s']:,.0f} filas/s{memory})")
+    print(f"✓ Escritas en {args.output}")
+
+
+if __name__ == '__main__':
+    main()
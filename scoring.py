@@ -0,0 +1,237 @@
+"""
+Asignación de cluster a productos nuevos sin reajustar el clustering
+Carga del registro de modelos el StandardScaler, los LabelEncoder y los
+centroides del KMeans y asigna cluster_producto a lotes de productos con
+transformaciones vectorizadas (una sola multiplicación de matrices por lote).
+Los valores de Item_Type o Item_Fat_Content que el modelo no vio al
+entrenarse no provocan un error: esa variable se imputa con su media de
+entrenamiento (0 tras el escalado) y el producto se marca como Unseen_Category.
+
+Incluye un servicio HTTP local (solo biblioteca estándar):
+    python scoring.py --port 8765
+    curl -X POST localhost:8765/assign -d '{"records": [{"Item_Type": "Dairy", ...}]}'
+"""
+
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import data_pipeline
+import model_registry
+
+# Campos que debe tener cada producto
+REQUIRED_FIELDS = [
+    'Total_Sales', 'Avg_Sales_Per_Store', 'Num_Stores', 'Avg_MRP',
+    'Avg_Visibility', 'Item_Type', 'Item_Fat_Content'
+]
+
+# Campos opcionales: Avg_Weight se imputa como en el pipeline y Std_Sales
+# ausente equivale a un producto vendido en una sola tienda
+OPTIONAL_FIELDS = ['Avg_Weight', 'Std_Sales']
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Productos por petición HTTP como máximo
+MAX_BATCH = 100_000
+
+
+def load_scorer(version=None, registry_dir=model_registry.REGISTRY_DIR):
+    """Objetos del registro necesarios para asignar clusters
+
+    Sin `version` se usa el modelo de producción más reciente (el que
+    seleccionó el script de Power BI). Los centroides se pasan a
+    float64 y se precalcula su norma para la asignación vectorizada.
+    """
+    artifact = model_registry.load_model(version, registry_dir)
+    scaler = artifact['scaler']
+    features = list(artifact['clustering_features'])
+    centers = np.asarray(artifact['kmeans'].cluster_centers_, dtype=np.float64)
+    imputation = artifact.get('imputation')
+    if imputation is None:
+        # Modelos guardados sin la imputación congelada: la media de
+        # entrenamiento de Avg_Weight (0 tras el escalado)
+        imputation = {'by_type': {}, 'overall': float(scaler.mean_[features.index('Avg_Weight')])}
+    return {
+        'version': artifact['version'],
+        'k': artifact['k'],
+        'clustering_features': features,
+        'scaler': scaler,
+        'le_item_type': artifact['le_item_type'],
+        'le_fat_content': artifact['le_fat_content'],
+        'imputation': imputation,
+        'centers': centers,
+        'center_norms': (centers ** 2).sum(axis=1)
+    }
+
+
+def _encode(values, encoder):
+    """Códigos del LabelEncoder sin error para categorías no vistas (-1)"""
+    return pd.Categorical(values, categories=encoder.classes_).codes
+
+
+def prepare_features(records, scorer):
+    """Variables de clustering escaladas de un lote de productos
+
+    `records` es un DataFrame o una lista de diccionarios con
+    REQUIRED_FIELDS (y opcionalmente OPTIONAL_FIELDS). Devuelve
+    (X_scaled, unseen), donde unseen marca los productos con alguna
+    categoría desconocida para el modelo.
+    """
+    products = pd.DataFrame(records)
+    missing = [field for field in REQUIRED_FIELDS if field not in products.columns]
+    if missing:
+        raise ValueError(f"Faltan campos obligatorios: {', '.join(missing)}")
+    n = len(products)
+
+    item_type = products['Item_Type'].astype(object).to_numpy()
+    fat_content = data_pipeline.normalize_fat_content(products['Item_Fat_Content'].astype(object)).to_numpy()
+    type_codes = _encode(item_type, scorer['le_item_type'])
+    fat_codes = _encode(fat_content, scorer['le_fat_content'])
+
+    def numeric(field, default=np.nan):
+        if field not in products.columns:
+            return np.full(n, default)
+        return pd.to_numeric(products[field], errors='coerce').to_numpy(dtype=np.float64)
+
+    imputation = scorer['imputation']
+    weight = numeric('Avg_Weight')
+    by_type = pd.Series(imputation['by_type'], dtype=np.float64).reindex(item_type).to_numpy()
+    weight = np.where(np.isnan(weight), by_type, weight)
+    weight = np.where(np.isnan(weight), imputation['overall'], weight)
+    std_sales = np.nan_to_num(numeric('Std_Sales', 0.0), nan=0.0)
+
+    columns = {
+        'Total_Sales': numeric('Total_Sales'),
+        'Avg_Sales_Per_Store': numeric('Avg_Sales_Per_Store'),
+        'Num_Stores': numeric('Num_Stores'),
+        'Avg_MRP': numeric('Avg_MRP'),
+        'Avg_Weight': weight,
+        'Avg_Visibility': numeric('Avg_Visibility'),
+        'Item_Type_Encoded': type_codes.astype(np.float64),
+        'Item_Fat_Content_Encoded': fat_codes.astype(np.float64)
+    }
+    columns['Sales_Stability'] = std_sales / (columns['Avg_Sales_Per_Store'] + 1)
+    columns['Price_Per_Unit_Weight'] = columns['Avg_MRP'] / (weight + 1)
+
+    X = np.column_stack([columns[feature] for feature in scorer['clustering_features']])
+    if np.isnan(X).any():
+        bad = np.flatnonzero(np.isnan(X).any(axis=1))
+        raise ValueError(f"Valores no numéricos o vacíos en los productos {bad[:10].tolist()}")
+
+    scaler = scorer['scaler']
+    X_scaled = (X - scaler.mean_) / scaler.scale_
+    # Categoría no vista: la variable codificada queda en su media (0)
+    features = scorer['clustering_features']
+    X_scaled[type_codes < 0, features.index('Item_Type_Encoded')] = 0.0
+    X_scaled[fat_codes < 0, features.index('Item_Fat_Content_Encoded')] = 0.0
+    return X_scaled, (type_codes < 0) | (fat_codes < 0)
+
+
+def assign_clusters(records, scorer):
+    """Asignar cluster_producto a un lote de productos
+
+    Devuelve un DataFrame con cluster_producto, Distance (distancia euclídea
+    al centroide en el espacio escalado) y Unseen_Category, en el orden de
+    `records`.
+    """
+    X_scaled, unseen = prepare_features(records, scorer)
+    # ||x - c||² = ||x||² - 2 x·c + ||c||², para todos los centroides a la vez
+    distances = (
+        (X_scaled ** 2).sum(axis=1)[:, None]
+        - 2 * X_scaled @ scorer['centers'].T
+        + scorer['center_norms']
+    )
+    clusters = distances.argmin(axis=1)
+    nearest = np.sqrt(np.maximum(distances[np.arange(len(clusters)), clusters], 0))
+    return pd.DataFrame({
+        'cluster_producto': clusters,
+        'Distance': nearest,
+        'Unseen_Category': unseen
+    })
+
+
+def _handler(scorer):
+    """Clase de manejador HTTP ligada a un scorer"""
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                self._send(404, {'error': f'Ruta desconocida: {self.path}'})
+                return
+            self._send(200, {
+                'model_version': scorer['version'],
+                'k': scorer['k'],
+                'required_fields': REQUIRED_FIELDS,
+                'optional_fields': OPTIONAL_FIELDS
+            })
+
+        def do_POST(self):
+            if self.path != '/assign':
+                self._send(404, {'error': f'Ruta desconocida: {self.path}'})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                records = payload['records'] if isinstance(payload, dict) else payload
+                if len(records) > MAX_BATCH:
+                    raise ValueError(f"Como máximo {MAX_BATCH:,} productos por petición")
+                start = time.perf_counter()
+                result = assign_clusters(records, scorer)
+                elapsed = time.perf_counter() - start
+            except (ValueError, KeyError, TypeError) as exc:
+                self._send(400, {'error': str(exc)})
+                return
+            self._send(200, {
+                'model_version': scorer['version'],
+                'cluster_producto': result['cluster_producto'].tolist(),
+                'distance': result['Distance'].round(6).tolist(),
+                'unseen_category': result['Unseen_Category'].tolist(),
+                'elapsed_ms': round(elapsed * 1000, 3)
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+def make_server(scorer, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Servidor HTTP (un hilo por petición) con las rutas /assign y /health"""
+    return ThreadingHTTPServer((host, port), _handler(scorer))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servicio de asignación de clusters a productos nuevos")
+    parser.add_argument('--model-dir', default=model_registry.REGISTRY_DIR,
+                        help="Directorio del registro de modelos")
+    parser.add_argument('--model-version', type=int, default=None,
+                        help="Versión del registro (por defecto la de producción)")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="Dirección en la que escuchar")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Puerto")
+    args = parser.parse_args()
+
+    scorer = load_scorer(args.model_version, args.model_dir)
+    server = make_server(scorer, args.host, args.port)
+    print(f"✓ Modelo v{scorer['version']} (k={scorer['k']}) en http://{args.host}:{args.port}/assign")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
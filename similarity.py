@@ -0,0 +1,83 @@
+"""
+Índice de vecinos más cercanos para buscar productos similares
+Se construye una sola vez un KD-tree sobre las variables de clustering
+escaladas (X_scaled) y se guarda junto al modelo en el registro, de modo que
+buscar los N productos más parecidos a un Item_Identifier es una consulta al
+árbol (fracciones de milisegundo) en lugar de calcular las distancias contra
+todo el catálogo.
+
+Uso:
+    index = similarity.load_index()
+    similarity.similar_products(index, 'FDA15', n=10)
+"""
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+import model_registry
+
+# Número de productos similares por defecto
+DEFAULT_N = 10
+
+# Puntos por hoja del KD-tree
+LEAF_SIZE = 40
+
+# Clave del índice dentro de los objetos de un modelo del registro
+REGISTRY_KEY = 'neighbors'
+
+
+def build_index(X_scaled, identifiers, leaf_size=LEAF_SIZE):
+    """KD-tree sobre X_scaled con la posición de cada Item_Identifier"""
+    identifiers = pd.Index(np.asarray(identifiers, dtype=object))
+    if not identifiers.is_unique:
+        raise ValueError("Los identificadores de producto del índice deben ser únicos")
+    X_scaled = np.ascontiguousarray(X_scaled, dtype=np.float64)
+    return {
+        'tree': KDTree(X_scaled, leaf_size=leaf_size),
+        'identifiers': identifiers
+    }
+
+
+def similar_products(index, item_identifier, n=DEFAULT_N):
+    """Los n productos más cercanos a `item_identifier` (sin incluirlo)
+
+    Devuelve un DataFrame con Rank, Item_Identifier y Distance (distancia
+    euclídea en el espacio escalado), ordenado de más a menos parecido.
+    """
+    identifiers = index['identifiers']
+    try:
+        position = identifiers.get_loc(item_identifier)
+    except KeyError:
+        raise KeyError(f"Producto no encontrado en el índice: {item_identifier}") from None
+
+    tree = index['tree']
+    point = np.asarray(tree.data[position]).reshape(1, -1)
+    k = min(n + 1, len(identifiers))
+    distances, positions = tree.query(point, k=k)
+    distances, positions = distances[0], positions[0]
+    # El propio producto puede no salir primero si hay duplicados exactos
+    keep = positions != position
+    distances, positions = distances[keep][:n], positions[keep][:n]
+    return pd.DataFrame({
+        'Rank': np.arange(1, len(positions) + 1),
+        'Item_Identifier': identifiers[positions],
+        'Distance': distances
+    })
+
+
+def load_index(version=None, registry_dir=model_registry.REGISTRY_DIR):
+    """Índice guardado con una versión del registro
+
+    Sin `version`, el de la versión más reciente que lo incluya (los modelos
+    que guarda el dashboard para cada k no llevan índice).
+    """
+    if version is not None:
+        versions = [version]
+    else:
+        versions = [metadata['version'] for metadata in model_registry.list_models(registry_dir)]
+    for v in versions:
+        artifact = model_registry.load_model(v, registry_dir)
+        if REGISTRY_KEY in artifact:
+            return artifact[REGISTRY_KEY]
+    raise KeyError(f"No hay ningún modelo con índice de productos similares en '{registry_dir}'")
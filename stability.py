@@ -0,0 +1,149 @@
+"""
+Estabilidad de los clusters por bootstrap
+Reajusta KMeans sobre remuestras bootstrap de X_scaled en un pool de procesos
+y compara cada ajuste con las etiquetas de referencia (las del modelo en
+producción):
+
+- Los clusters de cada remuestra se emparejan con los de referencia con el
+  algoritmo húngaro sobre la matriz de Jaccard (calculada con los productos
+  de la remuestra).
+- Estabilidad por cluster: Jaccard medio de su pareja en las remuestras
+  (> 0.75 estable, < 0.5 el cluster se disuelve, según Hennig).
+- Confianza por producto: fracción de remuestras en las que el producto,
+  asignado al centroide más cercano del ajuste, cae en la pareja de su
+  cluster de referencia.
+
+Cada remuestra tiene como mucho `max_samples` productos y los procesos
+devuelven un vector booleano por remuestra que se acumula a medida que llega,
+así que la memoria no crece con el número de remuestras.
+"""
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import KMeans
+
+import clustering
+
+N_BOOTSTRAP = 30
+
+# Tamaño máximo de cada remuestra (acota el tiempo con catálogos grandes)
+MAX_SAMPLES = 20_000
+
+# Inicializaciones de KMeans por remuestra
+N_INIT = 3
+
+# Umbrales de Jaccard (Hennig, 2007)
+STABLE_JACCARD = 0.75
+DISSOLVED_JACCARD = 0.5
+
+
+def match_clusters(reference, labels, k):
+    """Emparejar los clusters de `labels` con los de `reference`
+
+    Devuelve (mapping, jaccard): mapping[j] es el cluster de referencia
+    asignado al cluster j de `labels` y jaccard[i] el índice de Jaccard del
+    cluster de referencia i con su pareja.
+    """
+    contingency = np.bincount(reference * k + labels, minlength=k * k).reshape(k, k)
+    sizes_ref = contingency.sum(axis=1)
+    sizes_new = contingency.sum(axis=0)
+    union = sizes_ref[:, None] + sizes_new[None, :] - contingency
+    with np.errstate(invalid='ignore', divide='ignore'):
+        jaccard = np.where(union > 0, contingency / union, 0.0)
+    rows, cols = linear_sum_assignment(jaccard, maximize=True)
+    mapping = np.empty(k, dtype=np.int64)
+    mapping[cols] = rows
+    matched = np.zeros(k)
+    matched[rows] = jaccard[rows, cols]
+    return mapping, matched
+
+
+def _bootstrap_fit(X, reference, k, sample_size, seed, n_init):
+    """Ajuste de una remuestra: Jaccard por cluster y aciertos por producto"""
+    wall_start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    sample = rng.integers(0, len(X), size=sample_size)
+    kmeans = KMeans(n_clusters=k, random_state=seed, n_init=n_init).fit(X[sample])
+    # Jaccard con los productos distintos de la remuestra
+    in_bag = np.unique(sample)
+    mapping, jaccard = match_clusters(reference[in_bag], kmeans.predict(X[in_bag]), k)
+    agrees = mapping[kmeans.predict(X)] == reference
+    return {
+        'jaccard': jaccard,
+        'agrees': agrees,
+        'timing': {
+            'wall_s': round(time.perf_counter() - wall_start, 4),
+            'n_iter': int(kmeans.n_iter_),
+            'worker_pid': os.getpid()
+        }
+    }
+
+
+def bootstrap_stability(X, labels, n_bootstrap=N_BOOTSTRAP, max_samples=MAX_SAMPLES,
+                        n_jobs=1, random_state=clustering.RANDOM_STATE, n_init=N_INIT):
+    """Estabilidad de las etiquetas `labels` (0..k-1) de los productos de X
+
+    Devuelve un diccionario con la confianza por producto (confidence), el
+    Jaccard de cada cluster en cada remuestra (jaccard, remuestras×k), su
+    media (cluster_jaccard), el tamaño de remuestra y los tiempos de cada
+    ajuste.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    reference = np.asarray(labels, dtype=np.int64)
+    k = int(reference.max()) + 1
+    sample_size = len(X) if max_samples is None else min(len(X), max_samples)
+    seeds = np.random.default_rng(random_state).integers(0, 2**31 - 1, size=n_bootstrap)
+
+    agreements = np.zeros(len(X), dtype=np.int32)
+    jaccard = []
+    timings = []
+    parallel = Parallel(n_jobs=n_jobs, return_as='generator_unordered')
+    for result in parallel(
+        delayed(_bootstrap_fit)(X, reference, k, sample_size, int(seed), n_init) for seed in seeds
+    ):
+        agreements += result['agrees']
+        jaccard.append(result['jaccard'])
+        timings.append(result['timing'])
+
+    jaccard = np.array(jaccard).reshape(-1, k)
+    return {
+        'k': k,
+        'n_bootstrap': n_bootstrap,
+        'sample_size': sample_size,
+        'confidence': agreements / max(n_bootstrap, 1),
+        'jaccard': jaccard,
+        'cluster_jaccard': jaccard.mean(axis=0),
+        'timings': timings
+    }
+
+
+def cluster_table(stability, labels):
+    """Resumen por cluster: productos, Jaccard medio y mínimo, fracción de
+    remuestras en que se disuelve y confianza media de sus productos"""
+    labels = np.asarray(labels)
+    jaccard = stability['jaccard']
+    confidence = pd.Series(stability['confidence']).groupby(labels)
+    return pd.DataFrame({
+        'cluster_producto': np.arange(stability['k']),
+        'Num_Products': np.bincount(labels, minlength=stability['k']),
+        'Jaccard_Mean': jaccard.mean(axis=0),
+        'Jaccard_Min': jaccard.min(axis=0),
+        'Pct_Dissolved': (jaccard < DISSOLVED_JACCARD).mean(axis=0) * 100,
+        'Avg_Confidence': confidence.mean().reindex(np.arange(stability['k'])).to_numpy()
+    })
+
+
+def describe_stability(stability):
+    """Resumen de una línea"""
+    scores = stability['cluster_jaccard']
+    stable = int((scores >= STABLE_JACCARD).sum())
+    return (
+        f"{stability['n_bootstrap']} remuestras de {stability['sample_size']:,} productos; "
+        f"{stable}/{stability['k']} clusters estables (Jaccard ≥ {STABLE_JACCARD}), "
+        f"confianza media {stability['confidence'].mean():.0%}"
+    )
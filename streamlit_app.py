@@ -3,19 +3,30 @@ Dashboard Streamlit para Segmentación de Productos y Análisis por Tienda
 Big Mart Sales Prediction - Business Intelligence con Clustering
 """
 
+import time
+
 import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from sklearn.preprocessing import StandardScaler, LabelEncoder
-from sklearn.cluster import KMeans, AgglomerativeClustering
-from sklearn.metrics import silhouette_score
-from sklearn.decomposition import PCA
 import warnings
 warnings.filterwarnings('ignore')
 
+import aggregation
+import bitmap_index
+import clustering
+import cube
+import data_pipeline
+import export
+import hierarchy
+import lod
+import instrumentation
+import model_registry
+import similarity
+import stability
+
 # Configuración de la página
 st.set_page_config(
     page_title="Product Segmentation & Store Analysis",
@@ -28,184 +39,225 @@ st.set_page_config(
 st.title("Product Segmentation and Store Analysis Dashboard")
 st.markdown("### Big Mart Sales Prediction - Business Intelligence with Clustering")
 
-# Cache para cargar y procesar datos
-@st.cache_data
+# Cache para cargar y procesar datos: cache_resource devuelve los mismos
+# objetos en cada rerun (sin copiarlos); el dashboard no los modifica
+@st.cache_resource
 def load_and_process_data():
     """Cargar y procesar los datos"""
-    # Cargar datos originales
-    df = pd.read_csv('train_v9rqX0R.csv')
-    
-    # Limpiar datos
-    df_clean = df.copy()
-    df_clean['Item_Fat_Content'] = df_clean['Item_Fat_Content'].replace({
-        'low fat': 'Low Fat',
-        'LF': 'Low Fat',
-        'reg': 'Regular'
-    })
-    
-    # Construir dataset a nivel producto
-    product_metrics = df_clean.groupby('Item_Identifier').agg({
-        'Item_Outlet_Sales': ['sum', 'mean', 'std', 'count'],
-        'Item_MRP': 'mean',
-        'Item_Weight': 'mean',
-        'Item_Visibility': 'mean',
-        'Outlet_Identifier': 'nunique',
-        'Item_Type': 'first',
-        'Item_Fat_Content': 'first'
-    }).reset_index()
-    
-    product_metrics.columns = [
-        'Item_Identifier',
-        'Total_Sales',
-        'Avg_Sales_Per_Store',
-        'Std_Sales',
-        'Num_Store_Records',
-        'Avg_MRP',
-        'Avg_Weight',
-        'Avg_Visibility',
-        'Num_Stores',
-        'Item_Type',
-        'Item_Fat_Content'
-    ]
-    
-    # Tratar valores faltantes
-    product_metrics['Avg_Weight'] = product_metrics.groupby('Item_Type')['Avg_Weight'].transform(
-        lambda x: x.fillna(x.median())
+    # El pipeline compartido reutiliza la caché Parquet si el CSV no cambió
+    return data_pipeline.load_and_process_data()
+
+@st.cache_resource
+def get_sales_codes(_df_clean):
+    """Factorizar una sola vez los identificadores de producto y tienda"""
+    return aggregation.factorize_sales(_df_clean)
+
+# Métodos de clustering del dashboard
+CLUSTER_METHODS = {
+    'kmeans': 'K-Means',
+    'hierarchical': 'Jerárquico (Ward)'
+}
+
+def make_derive(df_clean, product_metrics, sales_codes):
+    """Función etiquetas -> cubo de ventas y bitmaps de cluster de una solución"""
+    # Los pares producto×tienda no dependen del k: se calculan una vez
+    pairs = cube.product_outlet_pairs(sales_codes)
+
+    def build_sales_cube(labels):
+        # Cubo tienda × tipo de producto × cluster de cada k (Vista 2 y Tab 3)
+        # y bitmaps de cluster para los filtros de productos
+        return {
+            'cube': cube.build_cube(
+                df_clean, product_metrics.assign(cluster_producto=labels), sales_codes, pairs
+            ),
+            'cluster_index': bitmap_index.build_index(labels)
+        }
+    return build_sales_cube
+
+@st.cache_resource
+def get_cluster_solutions(_df_clean, _product_metrics, _sales_codes, _encoders, _first_k):
+    """Precalcular en segundo plano las soluciones de clustering para k=2..10"""
+    clustering_features = data_pipeline.CLUSTERING_FEATURES
+    data_hash = data_pipeline.cache_key(data_pipeline.DATA_PATH)
+
+    def load_model(k):
+        # Reutilizar el KMeans del registro: el del script de Power BI o, si
+        # no, un ajuste anterior del dashboard
+        criteria = {'data_hash': data_hash, 'clustering_features': clustering_features, 'k': k}
+        artifact = (
+            model_registry.find_model(**criteria) or
+            model_registry.find_model(role=model_registry.DASHBOARD_ROLE, **criteria)
+        )
+        return artifact['kmeans'] if artifact is not None else None
+
+    def save_model(k, kmeans):
+        le_item_type, le_fat_content = _encoders
+        model_registry.save_model(
+            {
+                'scaler': solutions.scaler,
+                'kmeans': kmeans,
+                'pca': solutions.pca,
+                'le_item_type': le_item_type,
+                'le_fat_content': le_fat_content
+            },
+            data_hash=data_hash,
+            clustering_features=clustering_features,
+            k=k,
+            metrics={'inertia': float(kmeans.inertia_)},
+            role=model_registry.DASHBOARD_ROLE
+        )
+
+    solutions = clustering.ClusterSolutions(
+        _product_metrics[clustering_features],
+        derive=make_derive(_df_clean, _product_metrics, _sales_codes),
+        load_model=load_model,
+        save_model=save_model
     )
-    product_metrics['Avg_Weight'] = product_metrics['Avg_Weight'].fillna(product_metrics['Avg_Weight'].median())
-    product_metrics['Std_Sales'] = product_metrics['Std_Sales'].fillna(0)
-    
-    # Codificar variables categóricas
-    le_item_type = LabelEncoder()
-    le_fat_content = LabelEncoder()
-    product_metrics['Item_Type_Encoded'] = le_item_type.fit_transform(product_metrics['Item_Type'])
-    product_metrics['Item_Fat_Content_Encoded'] = le_fat_content.fit_transform(product_metrics['Item_Fat_Content'])
-    
-    # Crear variables adicionales
-    product_metrics['Sales_Stability'] = product_metrics['Std_Sales'] / (product_metrics['Avg_Sales_Per_Store'] + 1)
-    product_metrics['Price_Per_Unit_Weight'] = product_metrics['Avg_MRP'] / (product_metrics['Avg_Weight'] + 1)
-    
-    return df_clean, product_metrics, le_item_type, le_fat_content
+    # Empezar por el k inicial del slider; el resto se calcula después
+    return solutions.start(first=_first_k)
 
-@st.cache_data
-def perform_clustering(product_metrics, n_clusters=None):
-    """Realizar clustering de productos"""
-    clustering_features = [
-        'Total_Sales', 'Avg_Sales_Per_Store', 'Num_Stores', 'Avg_MRP',
-        'Avg_Weight', 'Avg_Visibility', 'Item_Type_Encoded',
-        'Item_Fat_Content_Encoded', 'Sales_Stability', 'Price_Per_Unit_Weight'
-    ]
-    
-    X_clustering = product_metrics[clustering_features].copy()
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X_clustering)
-    
-    # Determinar número óptimo si no se especifica
-    if n_clusters is None:
-        best_k = 2
-        best_score = -1
-        for k in range(2, 11):
-            kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
-            labels = kmeans.fit_predict(X_scaled)
-            score = silhouette_score(X_scaled, labels)
-            if score > best_score:
-                best_score = score
-                best_k = k
-        n_clusters = best_k
-    
-    # Aplicar clustering
-    kmeans_final = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-    product_metrics['cluster_producto'] = kmeans_final.fit_predict(X_scaled)
-    
-    # PCA para visualización 3D
-    pca = PCA(n_components=3)
-    X_pca = pca.fit_transform(X_scaled)
-    product_metrics['PC1'] = X_pca[:, 0]
-    product_metrics['PC2'] = X_pca[:, 1]
-    product_metrics['PC3'] = X_pca[:, 2]
-    
-    return product_metrics, X_scaled, scaler, pca, n_clusters
+@st.cache_resource
+def get_tree_solutions(_df_clean, _product_metrics, _sales_codes, _solutions):
+    """Árbol jerárquico sobre el X_scaled de las soluciones (en caché en disco)
+    y sus cortes para cada k"""
+    tree = hierarchy.load_or_build_tree(
+        _solutions.X_scaled, data_pipeline.cache_key(data_pipeline.DATA_PATH)
+    )
+    return hierarchy.TreeSolutions(
+        tree, _solutions.k_values, derive=make_derive(_df_clean, _product_metrics, _sales_codes)
+    )
 
 @st.cache_data
-def prepare_store_analysis(df_clean, product_metrics):
-    """Preparar análisis por tienda"""
-    # Incorporar clusters al dataset original
-    df_with_clusters = df_clean.merge(
-        product_metrics[['Item_Identifier', 'cluster_producto']],
-        on='Item_Identifier',
-        how='left'
+def select_n_clusters(_solutions, _strata, criterion='silhouette', sample_size=None):
+    """Determinar el número de clusters puntuando las soluciones ya ajustadas"""
+    return clustering.score_solutions(
+        _solutions,
+        n_jobs=-1,
+        criterion=criterion,
+        sample_size=sample_size,
+        strata=_strata
     )
-    
-    # Análisis por tienda y cluster
-    store_cluster_analysis = df_with_clusters.groupby(['Outlet_Identifier', 'cluster_producto']).agg({
-        'Item_Outlet_Sales': ['sum', 'mean', 'count'],
-        'Item_Identifier': 'nunique',
-        'Item_MRP': 'mean'
-    }).reset_index()
-    
-    store_cluster_analysis.columns = [
-        'Outlet_Identifier',
-        'cluster_producto',
-        'Total_Sales_Cluster',
-        'Avg_Sales_Per_Product',
-        'Num_Records',
-        'Num_Unique_Products',
-        'Avg_MRP'
-    ]
-    
-    store_total_sales = df_with_clusters.groupby('Outlet_Identifier')['Item_Outlet_Sales'].sum().reset_index()
-    store_total_sales.columns = ['Outlet_Identifier', 'Store_Total_Sales']
-    
-    store_cluster_analysis = store_cluster_analysis.merge(store_total_sales, on='Outlet_Identifier')
-    store_cluster_analysis['Pct_Sales_From_Cluster'] = (
-        store_cluster_analysis['Total_Sales_Cluster'] / 
-        store_cluster_analysis['Store_Total_Sales'] * 100
+
+@st.cache_resource
+def get_item_type_index(_product_metrics):
+    """Bitmaps de Item_Type (no dependen del k)"""
+    return bitmap_index.build_index(_product_metrics['Item_Type'])
+
+@st.cache_resource(max_entries=3)
+def get_product_view(_product_metrics, _solutions, _labels, n_clusters, method):
+    """Productos con el cluster de un k y las coordenadas PCA (una copia por k, no por rerun)"""
+    return _product_metrics.assign(
+        cluster_producto=_labels,
+        PC1=_solutions.pca_coords[:, 0],
+        PC2=_solutions.pca_coords[:, 1],
+        PC3=_solutions.pca_coords[:, 2]
     )
-    
-    # Dataset a nivel tienda
-    store_analysis = df_with_clusters.groupby('Outlet_Identifier').agg({
-        'Item_Outlet_Sales': 'sum',
-        'Outlet_Type': 'first',
-        'Outlet_Size': 'first',
-        'Outlet_Location_Type': 'first',
-        'Outlet_Establishment_Year': 'first',
-        'Item_Identifier': 'nunique'
-    }).reset_index()
-    
-    store_analysis.columns = [
-        'Outlet_Identifier',
-        'Total_Sales',
-        'Outlet_Type',
-        'Outlet_Size',
-        'Outlet_Location_Type',
-        'Outlet_Establishment_Year',
-        'Num_Unique_Products'
-    ]
-    
-    return df_with_clusters, store_cluster_analysis, store_analysis
+
+@st.cache_resource
+def get_similarity_index(_solutions, _identifiers):
+    """KD-tree de productos similares sobre el X_scaled de las soluciones"""
+    return similarity.build_index(_solutions.X_scaled, _identifiers)
+
+@st.cache_data(max_entries=10, show_spinner=False)
+def get_stability(_solutions, n_clusters, n_bootstrap):
+    """Estabilidad por bootstrap de la solución de un k"""
+    return stability.bootstrap_stability(
+        _solutions.X_scaled, _solutions.get(n_clusters)['labels'], n_bootstrap=n_bootstrap, n_jobs=-1
+    )
+
+# Métricas por etapa de esta ejecución (panel de depuración)
+recorder = instrumentation.Recorder()
 
 # Cargar datos
-with st.spinner("Cargando y procesando datos..."):
+with st.spinner("Cargando y procesando datos..."), recorder.stage('load') as record:
     df_clean, product_metrics, le_item_type, le_fat_content = load_and_process_data()
+    record['rows'] = len(df_clean)
 
 # Sidebar para controles
 st.sidebar.header("⚙️ Controles del Dashboard")
 
+cluster_method = st.sidebar.radio(
+    "Método de clustering",
+    options=list(CLUSTER_METHODS),
+    format_func=CLUSTER_METHODS.get,
+    horizontal=True,
+    help="Jerárquico: el árbol de fusiones se calcula una vez y cada k es un corte del árbol"
+)
+
+# Selección automática del número de clusters (barrido de KMeans)
+auto_k = st.sidebar.checkbox(
+    "Determinar número de clusters automáticamente",
+    value=False,
+    help="Evalúa k=2..10 y elige el mejor según el criterio seleccionado",
+    disabled=cluster_method != 'kmeans'
+) and cluster_method == 'kmeans'
+
 # Selector de número de clusters
 n_clusters = st.sidebar.slider(
     "Número de Clusters",
     min_value=2,
     max_value=10,
     value=4,
-    help="Ajusta el número de clusters para el análisis"
+    help="Ajusta el número de clusters para el análisis",
+    disabled=auto_k
 )
 
-# Realizar clustering
-with st.spinner("Realizando clustering..."):
-    product_metrics, X_scaled, scaler, pca, optimal_k = perform_clustering(product_metrics, n_clusters)
+criterion = 'silhouette'
+sample_size = None
+if auto_k:
+    criterion = st.sidebar.selectbox(
+        "Criterio de selección",
+        options=list(clustering.CRITERIA),
+        format_func=lambda c: clustering.CRITERIA[c]
+    )
+    if criterion == 'silhouette':
+        sample_size = st.sidebar.number_input(
+            "Tamaño de muestra para Silhouette",
+            min_value=0,
+            value=0,
+            step=500,
+            help="Muestra estratificada por tipo de producto (0 usa todos los productos)"
+        ) or None
 
-# Preparar análisis por tienda
-df_with_clusters, store_cluster_analysis, store_analysis = prepare_store_analysis(df_clean, product_metrics)
+# Soluciones de clustering para todos los k (se calculan en segundo plano
+# al arrancar, así que mover el slider es una consulta)
+with recorder.stage('cluster_solutions', rows=len(product_metrics)):
+    sales_codes = get_sales_codes(df_clean)
+    solutions = get_cluster_solutions(
+        df_clean, product_metrics, sales_codes, (le_item_type, le_fat_content), n_clusters
+    )
+
+sweep = None
+if auto_k:
+    with st.spinner("Determinando el número de clusters..."), \
+            recorder.stage('k_sweep', rows=len(product_metrics), criterion=criterion):
+        sweep = select_n_clusters(
+            solutions, product_metrics['Item_Type_Encoded'], criterion, sample_size
+        )
+    n_clusters = sweep['best_k']
+    st.sidebar.caption(f"k elegido: {clustering.describe_sweep(sweep)}")
+
+# En modo jerárquico las soluciones son cortes del árbol en caché
+tree_solutions = None
+active_solutions = solutions
+if cluster_method == 'hierarchical':
+    with st.spinner("Calculando el árbol jerárquico (solo la primera vez)..."), \
+            recorder.stage('hierarchy_tree', rows=len(product_metrics)):
+        tree_solutions = get_tree_solutions(df_clean, product_metrics, sales_codes, solutions)
+    active_solutions = tree_solutions
+
+with st.spinner("Realizando clustering..."), \
+        recorder.stage('clustering', k=n_clusters, method=cluster_method):
+    solution = active_solutions.get(n_clusters)
+
+# Vista de productos con el cluster del k elegido y las coordenadas PCA
+product_metrics = get_product_view(product_metrics, solutions, solution['labels'], n_clusters, cluster_method)
+sales_cube = solution['derived']['cube']
+# Índices bitmap de los filtros de productos (en el orden de product_metrics)
+filter_indexes = {
+    'Item_Type': get_item_type_index(product_metrics),
+    'cluster_producto': solution['derived']['cluster_index']
+}
 
 # Mostrar información en sidebar
 st.sidebar.markdown("---")
@@ -213,16 +265,33 @@ st.sidebar.metric("Productos Únicos", f"{len(product_metrics):,}")
 st.sidebar.metric("Tiendas", f"{df_clean['Outlet_Identifier'].nunique()}")
 st.sidebar.metric("Clusters", n_clusters)
 
-# Tabs para las diferentes vistas
-tab1, tab2, tab3 = st.tabs(["🎯 Vista 1: Clusters de Productos", "🏪 Vista 2: Mezcla por Tienda", "📈 Análisis Detallado"])
+debug_mode = st.sidebar.checkbox(
+    "Modo depuración",
+    value=False,
+    help="Muestra el tiempo, la CPU y la memoria de cada etapa de esta ejecución"
+)
 
-with tab1:
-    st.header("Vista 1: Clusters de Productos")
-    
-    # Visualización 3D interactiva de clusters
-    st.subheader("Visualización 3D Interactiva de Clusters")
-    st.markdown("**Rotar, hacer zoom y explorar los clusters en 3D usando los controles del gráfico**")
-    
+# Cada vista es una página de st.navigation: solo se ejecuta la que está
+# abierta. Las secciones con widgets propios son fragmentos, así que un
+# cambio en ellas solo vuelve a ejecutar esa sección.
+def instrumented(name, fragment=False):
+    """Medir cada ejecución de una vista o sección con el recorder
+
+    En modo depuración muestra su tiempo al final. Con fragment=True la
+    sección es un st.fragment y sus reruns no ejecutan el resto de la página.
+    """
+    def decorator(render):
+        def run(*args):
+            with recorder.stage(name) as record:
+                render(*args)
+            if debug_mode:
+                st.caption(f"🛠️ {name}: {record['wall_s'] * 1000:.0f} ms de reloj, {record['cpu_s'] * 1000:.0f} ms de CPU")
+        run.__name__ = run.__qualname__ = render.__name__
+        return st.fragment(run) if fragment else run
+    return decorator
+
+@instrumented('view.productos.dispersion', fragment=True)
+def product_scatter():
     # Selector de variables para los ejes
     col1, col2, col3 = st.columns(3)
     
@@ -248,17 +317,32 @@ with tab1:
         )
     
     # Filtro por tipo de producto
-    item_types = ['Todos'] + list(product_metrics['Item_Type'].unique())
+    item_types = ['Todos'] + list(filter_indexes['Item_Type']['values'])
     selected_type = st.selectbox("Filtrar por Tipo de Producto", item_types)
     
-    # Preparar datos para visualización
-    plot_data = product_metrics.copy()
+    # Preparar datos para visualización (el filtro se resuelve con el bitmap)
+    plot_data = product_metrics
     if selected_type != 'Todos':
-        plot_data = plot_data[plot_data['Item_Type'] == selected_type]
+        plot_data = bitmap_index.filter_rows(plot_data, filter_indexes, {'Item_Type': [selected_type]})
+    
+    # Con más productos que el presupuesto de puntos, permitir acotar el
+    # rango del eje X (zoom en el servidor) hasta poder ver todos
+    if len(plot_data) > lod.POINT_BUDGET_3D:
+        x_min, x_max = float(plot_data[x_axis].min()), float(plot_data[x_axis].max())
+        if x_min < x_max:
+            x_range = st.slider(f"Rango de {x_axis}", x_min, x_max, (x_min, x_max))
+            plot_data = plot_data[plot_data[x_axis].between(*x_range)]
+    
+    # Nivel de detalle: muestra estratificada por cluster con los atípicos
+    plot_data_3d, sampled = lod.downsample(
+        plot_data, lod.POINT_BUDGET_3D, outlier_columns=list(dict.fromkeys([x_axis, y_axis, z_axis]))
+    )
+    if sampled:
+        st.caption(lod.describe_lod(len(plot_data_3d), len(plot_data)))
     
-    # Crear gráfico 3D interactivo
+    # Crear gráfico 3D interactivo (scatter_3d ya se dibuja con WebGL)
     fig_3d = px.scatter_3d(
-        plot_data,
+        plot_data_3d,
         x=x_axis,
         y=y_axis,
         z=z_axis,
@@ -288,7 +372,121 @@ with tab1:
         width=1000
     )
     
-    st.plotly_chart(fig_3d, use_container_width=True)
+    st.plotly_chart(fig_3d, width='stretch')
+    
+    # Visualización 2D adicional
+    st.subheader("Visualizaciones 2D Complementarias")
+    
+    plot_data_2d, sampled = lod.downsample(
+        plot_data, lod.POINT_BUDGET_2D,
+        outlier_columns=['Total_Sales', 'Avg_MRP', 'Avg_Sales_Per_Store', 'Num_Stores']
+    )
+    if sampled:
+        st.caption(lod.describe_lod(len(plot_data_2d), len(plot_data)))
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        fig_scatter = px.scatter(
+            plot_data_2d,
+            x='Total_Sales',
+            y='Avg_MRP',
+            color='cluster_producto',
+            size='Num_Stores',
+            hover_data=['Item_Identifier', 'Item_Type'],
+            title='Total Sales vs Average MRP por Cluster',
+            color_continuous_scale='viridis',
+            render_mode='webgl'
+        )
+        st.plotly_chart(fig_scatter, width='stretch')
+    
+    with col2:
+        fig_scatter2 = px.scatter(
+            plot_data_2d,
+            x='Avg_Sales_Per_Store',
+            y='Num_Stores',
+            color='cluster_producto',
+            size='Total_Sales',
+            hover_data=['Item_Identifier', 'Item_Type'],
+            title='Avg Sales Per Store vs Number of Stores',
+            color_continuous_scale='viridis',
+            render_mode='webgl'
+        )
+        st.plotly_chart(fig_scatter2, width='stretch')
+
+@instrumented('view.productos.similares', fragment=True)
+def similar_products_panel():
+    # Productos similares: consulta al KD-tree de las variables escaladas
+    st.subheader("Productos Similares")
+    similarity_index = get_similarity_index(solutions, product_metrics['Item_Identifier'])
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        product_ids = product_metrics.sort_values('Total_Sales', ascending=False)['Item_Identifier']
+        if len(product_ids) <= lod.POINT_BUDGET_2D:
+            selected_product = st.selectbox("Producto", product_ids.tolist())
+        else:
+            selected_product = st.text_input("Producto (Item_Identifier)", value=product_ids.iloc[0]).strip()
+    with col2:
+        n_similar = st.number_input("Número de similares", min_value=1, max_value=50, value=similarity.DEFAULT_N)
+    
+    try:
+        lookup_start = time.perf_counter()
+        similar = similarity.similar_products(similarity_index, selected_product, n=int(n_similar))
+        lookup_ms = (time.perf_counter() - lookup_start) * 1000
+    except KeyError:
+        st.warning(f"Producto no encontrado: {selected_product}")
+    else:
+        similar = similar.merge(
+            product_metrics[['Item_Identifier', 'cluster_producto', 'Item_Type', 'Total_Sales', 'Avg_MRP', 'Num_Stores']],
+            on='Item_Identifier', how='left'
+        )
+        selected_cluster = product_metrics.loc[
+            product_metrics['Item_Identifier'] == selected_product, 'cluster_producto'
+        ].iloc[0]
+        st.caption(
+            f"Cluster de {selected_product}: {selected_cluster} · "
+            f"{(similar['cluster_producto'] == selected_cluster).mean():.0%} de los similares en el mismo cluster · "
+            f"consulta en {lookup_ms:.2f} ms"
+        )
+        st.dataframe(similar, width='stretch', hide_index=True)
+
+@instrumented('view.productos.dendrograma')
+def dendrogram_view():
+    # Dendrograma truncado a las últimas fusiones, con la altura del corte actual
+    st.subheader("Dendrograma")
+    tree = tree_solutions.tree
+    coords = hierarchy.dendrogram_coords(tree)
+    fig_dendrogram = go.Figure()
+    for x, y in zip(coords['icoord'], coords['dcoord']):
+        fig_dendrogram.add_trace(go.Scatter(
+            x=x, y=y, mode='lines', line=dict(color='#636EFA', width=1.5),
+            hoverinfo='skip', showlegend=False
+        ))
+    fig_dendrogram.add_hline(
+        y=hierarchy.cut_height(tree, n_clusters), line_dash='dash', line_color='red',
+        annotation_text=f'Corte en k={n_clusters}'
+    )
+    fig_dendrogram.update_layout(
+        title=f'Dendrograma (últimas {len(coords["labels"])} ramas; entre paréntesis, productos por rama)',
+        xaxis=dict(
+            tickvals=[5 + 10 * i for i in range(len(coords['labels']))],
+            ticktext=coords['labels'],
+            tickangle=-90
+        ),
+        yaxis_title='Distancia de fusión (Ward)',
+        height=500
+    )
+    st.plotly_chart(fig_dendrogram, width='stretch')
+
+@instrumented('view.productos')
+def view_product_clusters():
+    st.header("Vista 1: Clusters de Productos")
+    
+    # Visualización 3D interactiva de clusters
+    st.subheader("Visualización 3D Interactiva de Clusters")
+    st.markdown("**Rotar, hacer zoom y explorar los clusters en 3D usando los controles del gráfico**")
+    
+    product_scatter()
     
     # Estadísticas por cluster
     st.subheader("Estadísticas por Cluster")
@@ -304,7 +502,7 @@ with tab1:
         }).round(2)
         cluster_stats.columns = ['Avg_Total_Sales', 'Sum_Total_Sales', 'Num_Products', 
                                 'Avg_MRP', 'Avg_Num_Stores', 'Most_Common_Type']
-        st.dataframe(cluster_stats, use_container_width=True)
+        st.dataframe(cluster_stats, width='stretch')
     
     with col2:
         # Distribución de productos por cluster
@@ -317,42 +515,11 @@ with tab1:
             color=cluster_counts.values,
             color_continuous_scale='viridis'
         )
-        st.plotly_chart(fig_bar, use_container_width=True)
-    
-    # Visualización 2D adicional
-    st.subheader("Visualizaciones 2D Complementarias")
-    
-    col1, col2 = st.columns(2)
-    
-    with col1:
-        fig_scatter = px.scatter(
-            plot_data,
-            x='Total_Sales',
-            y='Avg_MRP',
-            color='cluster_producto',
-            size='Num_Stores',
-            hover_data=['Item_Identifier', 'Item_Type'],
-            title='Total Sales vs Average MRP por Cluster',
-            color_continuous_scale='viridis'
-        )
-        st.plotly_chart(fig_scatter, use_container_width=True)
-    
-    with col2:
-        fig_scatter2 = px.scatter(
-            plot_data,
-            x='Avg_Sales_Per_Store',
-            y='Num_Stores',
-            color='cluster_producto',
-            size='Total_Sales',
-            hover_data=['Item_Identifier', 'Item_Type'],
-            title='Avg Sales Per Store vs Number of Stores',
-            color_continuous_scale='viridis'
-        )
-        st.plotly_chart(fig_scatter2, use_container_width=True)
+        st.plotly_chart(fig_bar, width='stretch')
     
     # Distribución de tipos de producto por cluster
     st.subheader("Distribución de Tipos de Producto por Cluster")
-    item_type_by_cluster = product_metrics.groupby(['cluster_producto', 'Item_Type']).size().reset_index(name='Count')
+    item_type_by_cluster = product_metrics.groupby(['cluster_producto', 'Item_Type'], observed=True).size().reset_index(name='Count')
     item_type_pct = item_type_by_cluster.groupby('cluster_producto').apply(
         lambda x: x.assign(Pct=x['Count'] / x['Count'].sum() * 100)
     ).reset_index(drop=True)
@@ -365,32 +532,70 @@ with tab1:
         color='Pct',
         color_continuous_scale='viridis'
     )
-    st.plotly_chart(fig_sunburst, use_container_width=True)
+    st.plotly_chart(fig_sunburst, width='stretch')
+    
+    if tree_solutions is not None:
+        dendrogram_view()
+    
+    similar_products_panel()
 
-with tab2:
+@instrumented('view.tiendas.detalle', fragment=True)
+def store_detail_panel(stores, store_ids):
+    # Tabla de análisis por tienda
+    st.subheader("Análisis Detallado por Tienda")
+    
+    selected_store = st.selectbox(
+        "Seleccionar Tienda para Análisis Detallado",
+        options=store_ids
+    )
+    
+    if selected_store:
+        # Roll-up tienda × cluster del cubo, filtrado a la tienda elegida
+        store_detail = cube.rollup(sales_cube, ['Outlet_Identifier', 'cluster_producto'])
+        store_detail = store_detail[store_detail['Outlet_Identifier'] == selected_store].rename(
+            columns={'Total_Sales': 'Total_Sales_Cluster'}
+        )
+        store_info = stores[stores['Outlet_Identifier'] == selected_store].iloc[0]
+        store_detail['Pct_Sales_From_Cluster'] = (
+            store_detail['Total_Sales_Cluster'] / store_info['Total_Sales'] * 100
+        )
+        
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Ventas Totales", f"${store_info['Total_Sales']:,.2f}")
+        col2.metric("Tipo de Tienda", store_info['Outlet_Type'])
+        col3.metric("Ubicación", store_info['Outlet_Location_Type'])
+        col4.metric("Productos Únicos", f"{store_info['Num_Unique_Products']}")
+        
+        # Gráfico de distribución por cluster para la tienda seleccionada
+        fig_store_cluster = px.pie(
+            store_detail,
+            values='Pct_Sales_From_Cluster',
+            names='cluster_producto',
+            title=f'Distribución de Ventas por Cluster - {selected_store}',
+            hole=0.4
+        )
+        st.plotly_chart(fig_store_cluster, width='stretch')
+        
+        st.dataframe(store_detail[['cluster_producto', 'Total_Sales_Cluster', 'Pct_Sales_From_Cluster', 
+                                   'Num_Unique_Products', 'Avg_MRP']], width='stretch')
+
+@instrumented('view.tiendas')
+def view_store_mix():
     st.header("Vista 2: Mezcla de Clusters por Tienda")
     
     # Visualización 3D de tiendas y clusters
     st.subheader("Visualización 3D: Tiendas y Clusters")
     
-    # Preparar datos para visualización 3D de tiendas
-    store_cluster_pivot = store_cluster_analysis.pivot_table(
-        index='Outlet_Identifier',
-        columns='cluster_producto',
-        values='Pct_Sales_From_Cluster',
-        fill_value=0
-    ).reset_index()
-    
-    # Agregar información de tienda
-    store_cluster_pivot = store_cluster_pivot.merge(
-        store_analysis[['Outlet_Identifier', 'Total_Sales', 'Outlet_Type', 'Outlet_Location_Type']],
-        on='Outlet_Identifier'
-    )
+    # Corte tienda × cluster del cubo: ventas y porcentaje de cada cluster
+    cluster_sales, store_ids, cluster_ids = cube.matrix(sales_cube)
+    cluster_pct = cube.share(cluster_sales)
+    cluster_cols = [int(c) for c in cluster_ids]
     
-    # Obtener columnas de clusters (excluyendo Outlet_Identifier)
-    cluster_cols = [col for col in store_cluster_pivot.columns 
-                   if col != 'Outlet_Identifier' and col not in ['Total_Sales', 'Outlet_Type', 'Outlet_Location_Type']
-                   and isinstance(col, (int, float))]
+    # Una fila por tienda con sus atributos y la mezcla de clusters
+    stores = cube.rollup(sales_cube, ['Outlet_Identifier', 'Outlet_Type', 'Outlet_Location_Type'])
+    store_cluster_pivot = pd.concat(
+        [stores, pd.DataFrame(cluster_pct, columns=cluster_cols)], axis=1
+    )
     
     # Seleccionar ejes para visualización 3D
     if len(cluster_cols) >= 3:
@@ -436,59 +641,52 @@ with tab2:
         height=700
     )
     
-    st.plotly_chart(fig_store_3d, use_container_width=True)
+    st.plotly_chart(fig_store_3d, width='stretch')
     
     # Stacked bar chart de porcentajes por tienda
     st.subheader("Distribución de Ventas por Cluster en cada Tienda")
     
-    cluster_cols_pct = [col for col in store_analysis.columns if col.startswith('Pct_Cluster_')]
-    if cluster_cols_pct:
-        store_cluster_data = store_analysis.set_index('Outlet_Identifier')[cluster_cols_pct]
-        
-        fig_stacked = go.Figure()
-        colors = px.colors.qualitative.Set3
-        
-        for i, col in enumerate(cluster_cols_pct):
-            fig_stacked.add_trace(go.Bar(
-                name=f'Cluster {col.split("_")[-1]}',
-                x=store_cluster_data.index,
-                y=store_cluster_data[col],
-                marker_color=colors[i % len(colors)]
-            ))
-        
-        fig_stacked.update_layout(
-            barmode='stack',
-            title='Porcentaje de Ventas por Cluster en cada Tienda',
-            xaxis_title='Tienda',
-            yaxis_title='Porcentaje de Ventas (%)',
-            height=500
-        )
-        
-        st.plotly_chart(fig_stacked, use_container_width=True)
+    fig_stacked = go.Figure()
+    colors = px.colors.qualitative.Set3
+    
+    for i, cluster_id in enumerate(cluster_cols):
+        fig_stacked.add_trace(go.Bar(
+            name=f'Cluster {cluster_id}',
+            x=store_ids,
+            y=cluster_pct[:, i],
+            marker_color=colors[i % len(colors)]
+        ))
+    
+    fig_stacked.update_layout(
+        barmode='stack',
+        title='Porcentaje de Ventas por Cluster en cada Tienda',
+        xaxis_title='Tienda',
+        yaxis_title='Porcentaje de Ventas (%)',
+        height=500
+    )
+    
+    st.plotly_chart(fig_stacked, width='stretch')
     
     # Heatmap interactivo
     st.subheader("Heatmap: Porcentaje de Ventas por Cluster y Tienda")
     
-    if cluster_cols_pct:
-        heatmap_data = store_analysis.set_index('Outlet_Identifier')[cluster_cols_pct].T
-        
-        fig_heatmap = px.imshow(
-            heatmap_data.values,
-            labels=dict(x="Tienda", y="Cluster", color="Porcentaje (%)"),
-            x=heatmap_data.columns,
-            y=[f'Cluster {col.split("_")[-1]}' for col in cluster_cols_pct],
-            color_continuous_scale='YlOrRd',
-            aspect="auto",
-            title='Heatmap: Porcentaje de Ventas por Cluster y Tienda'
-        )
-        
-        fig_heatmap.update_layout(height=400)
-        st.plotly_chart(fig_heatmap, use_container_width=True)
+    fig_heatmap = px.imshow(
+        cluster_pct.T,
+        labels=dict(x="Tienda", y="Cluster", color="Porcentaje (%)"),
+        x=store_ids,
+        y=[f'Cluster {cluster_id}' for cluster_id in cluster_cols],
+        color_continuous_scale='YlOrRd',
+        aspect="auto",
+        title='Heatmap: Porcentaje de Ventas por Cluster y Tienda'
+    )
+    
+    fig_heatmap.update_layout(height=400)
+    st.plotly_chart(fig_heatmap, width='stretch')
     
     # Ventas totales por tienda
     st.subheader("Ventas Totales por Tienda")
     
-    store_sales_sorted = store_analysis.sort_values('Total_Sales', ascending=False)
+    store_sales_sorted = stores.sort_values('Total_Sales', ascending=False)
     
     fig_sales = px.bar(
         store_sales_sorted,
@@ -499,40 +697,141 @@ with tab2:
         labels={'Total_Sales': 'Ventas Totales ($)', 'Outlet_Identifier': 'Tienda'}
     )
     fig_sales.update_layout(height=500, xaxis_tickangle=-45)
-    st.plotly_chart(fig_sales, use_container_width=True)
+    st.plotly_chart(fig_sales, width='stretch')
     
-    # Tabla de análisis por tienda
-    st.subheader("Análisis Detallado por Tienda")
+    store_detail_panel(stores, store_ids)
+
+@instrumented('view.detalle.productos', fragment=True)
+def product_table():
+    # Tabla de datos
+    st.subheader("Datos de Productos con Clusters")
     
-    selected_store = st.selectbox(
-        "Seleccionar Tienda para Análisis Detallado",
-        options=store_analysis['Outlet_Identifier'].unique()
+    # Filtros
+    col1, col2 = st.columns(2)
+    with col1:
+        selected_clusters = st.multiselect(
+            "Filtrar por Clusters",
+            options=list(filter_indexes['cluster_producto']['values']),
+            default=list(filter_indexes['cluster_producto']['values'])
+        )
+    
+    with col2:
+        selected_item_types = st.multiselect(
+            "Filtrar por Tipo de Producto",
+            options=list(filter_indexes['Item_Type']['values']),
+            default=list(filter_indexes['Item_Type']['values'])
+        )
+    
+    # AND de los bitmaps de cada filtro; sin filtros activos no se copia nada
+    filtered_data = bitmap_index.filter_rows(product_metrics, filter_indexes, {
+        'cluster_producto': selected_clusters,
+        'Item_Type': selected_item_types
+    })
+    
+    st.dataframe(
+        filtered_data[['Item_Identifier', 'Item_Type', 'cluster_producto', 
+                      'Total_Sales', 'Avg_MRP', 'Num_Stores', 'Avg_Sales_Per_Store']],
+        width='stretch',
+        height=400
     )
     
-    if selected_store:
-        store_detail = store_cluster_analysis[store_cluster_analysis['Outlet_Identifier'] == selected_store]
-        store_info = store_analysis[store_analysis['Outlet_Identifier'] == selected_store].iloc[0]
-        
-        col1, col2, col3, col4 = st.columns(4)
-        col1.metric("Ventas Totales", f"${store_info['Total_Sales']:,.2f}")
-        col2.metric("Tipo de Tienda", store_info['Outlet_Type'])
-        col3.metric("Ubicación", store_info['Outlet_Location_Type'])
-        col4.metric("Productos Únicos", f"{store_info['Num_Unique_Products']}")
-        
-        # Gráfico de distribución por cluster para la tienda seleccionada
-        fig_store_cluster = px.pie(
-            store_detail,
-            values='Pct_Sales_From_Cluster',
-            names='cluster_producto',
-            title=f'Distribución de Ventas por Cluster - {selected_store}',
-            hole=0.4
+    # Descargar datos: el archivo se genera solo al pulsar el botón (Streamlit
+    # lo lee entero antes de enviarlo)
+    col1, col2 = st.columns(2)
+    with col1:
+        export_format = st.radio(
+            "Formato de descarga", export.OUTPUT_FORMATS, format_func=str.upper, horizontal=True
         )
-        st.plotly_chart(fig_store_cluster, use_container_width=True)
-        
-        st.dataframe(store_detail[['cluster_producto', 'Total_Sales_Cluster', 'Pct_Sales_From_Cluster', 
-                                   'Num_Unique_Products', 'Avg_MRP']], use_container_width=True)
+    with col2:
+        include_rows = st.checkbox(
+            "Incluir las filas de ventas",
+            value=False,
+            help="Descarga las ventas a nivel fila (con su cluster) de los productos filtrados"
+        )
+    
+    def export_data():
+        if include_rows:
+            chunks = export.row_chunks(df_clean, filtered_data, sales_codes)
+        else:
+            chunks = export.frame_chunks(filtered_data)
+        return export.stream_table(chunks, export_format)
+    
+    export_name = 'ventas_clusters' if include_rows else 'productos_clusters'
+    st.download_button(
+        label=f" Descargar Datos Filtrados ({export_format.upper()})",
+        data=export_data,
+        file_name=f"{export_name}_{pd.Timestamp.now().strftime('%Y%m%d')}.{export_format}",
+        mime=export.MIME_TYPES[export_format],
+        disabled=filtered_data.empty
+    )
+
+@instrumented('view.detalle.estabilidad', fragment=True)
+def stability_panel():
+    # Estabilidad de los clusters: se calcula solo si se pide (reajusta KMeans
+    # sobre cada remuestra) y queda en caché por k y número de remuestras
+    st.subheader("Estabilidad de los Clusters")
+    if cluster_method != 'kmeans':
+        st.info("La estabilidad por bootstrap reajusta KMeans; está disponible con el método K-Means.")
+        return
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        n_bootstrap = st.number_input(
+            "Remuestras bootstrap", min_value=5, max_value=200, value=stability.N_BOOTSTRAP, step=5
+        )
+    with col2:
+        run_stability = st.toggle(
+            "Calcular estabilidad",
+            value=False,
+            help="Reajusta KMeans sobre remuestras bootstrap de los productos y compara cada ajuste con los clusters actuales"
+        )
+    if not run_stability:
+        return
+    
+    with st.spinner("Reajustando KMeans sobre las remuestras bootstrap..."):
+        result = get_stability(solutions, n_clusters, int(n_bootstrap))
+    st.caption(stability.describe_stability(result))
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        cluster_stability = stability.cluster_table(result, product_metrics['cluster_producto'])
+        fig_jaccard = px.bar(
+            cluster_stability,
+            x='cluster_producto',
+            y='Jaccard_Mean',
+            error_y=cluster_stability['Jaccard_Mean'] - cluster_stability['Jaccard_Min'],
+            title='Jaccard Medio por Cluster (emparejado con el algoritmo húngaro)',
+            labels={'cluster_producto': 'Cluster', 'Jaccard_Mean': 'Jaccard medio'}
+        )
+        fig_jaccard.add_hline(y=stability.STABLE_JACCARD, line_dash='dash', annotation_text='Estable')
+        fig_jaccard.add_hline(y=stability.DISSOLVED_JACCARD, line_dash='dot', annotation_text='Se disuelve')
+        fig_jaccard.update_layout(yaxis_range=[0, 1])
+        st.plotly_chart(fig_jaccard, width='stretch')
+    
+    with col2:
+        fig_confidence = px.histogram(
+            x=result['confidence'],
+            color=product_metrics['cluster_producto'].astype(str),
+            nbins=20,
+            title='Confianza de Asignación por Producto',
+            labels={'x': 'Fracción de remuestras en su cluster', 'color': 'Cluster'}
+        )
+        st.plotly_chart(fig_confidence, width='stretch')
+    
+    st.dataframe(cluster_stability.round(3), width='stretch', hide_index=True)
+    
+    # Productos con la asignación menos estable
+    lowest = np.argsort(result['confidence'], kind='stable')[:20]
+    unstable = product_metrics.take(lowest).assign(Assignment_Confidence=result['confidence'][lowest])
+    st.markdown("**Productos con la asignación menos estable**")
+    st.dataframe(
+        unstable[['Item_Identifier', 'Item_Type', 'cluster_producto', 'Assignment_Confidence',
+                  'Total_Sales', 'Avg_MRP']],
+        width='stretch',
+        hide_index=True
+    )
 
-with tab3:
+@instrumented('view.detalle')
+def view_details():
     st.header("Análisis Detallado")
     
     # Resumen general
@@ -547,19 +846,13 @@ with tab3:
     # Análisis por tipo de tienda
     st.subheader("Análisis por Tipo de Tienda")
     
-    store_type_cluster = df_with_clusters.groupby(['Outlet_Type', 'cluster_producto']).agg({
-        'Item_Outlet_Sales': 'sum',
-        'Item_Identifier': 'nunique'
-    }).reset_index()
-    
-    store_type_total = df_with_clusters.groupby('Outlet_Type')['Item_Outlet_Sales'].sum().reset_index()
-    store_type_total.columns = ['Outlet_Type', 'Type_Total_Sales']
-    
-    store_type_cluster = store_type_cluster.merge(store_type_total, on='Outlet_Type')
-    store_type_cluster['Pct_Sales'] = (
-        store_type_cluster['Item_Outlet_Sales'] / 
-        store_type_cluster['Type_Total_Sales'] * 100
-    )
+    # Roll-up de las tiendas del cubo por tipo de tienda
+    type_sales, outlet_types, type_clusters = cube.matrix(sales_cube, by_outlet='Outlet_Type')
+    store_type_cluster = pd.DataFrame({
+        'Outlet_Type': np.repeat(outlet_types, len(type_clusters)),
+        'cluster_producto': np.tile(type_clusters, len(outlet_types)),
+        'Pct_Sales': cube.share(type_sales).ravel()
+    })
     
     fig_type = px.bar(
         store_type_cluster,
@@ -570,47 +863,47 @@ with tab3:
         labels={'Pct_Sales': 'Porcentaje de Ventas (%)', 'Outlet_Type': 'Tipo de Tienda'},
         barmode='stack'
     )
-    st.plotly_chart(fig_type, use_container_width=True)
+    st.plotly_chart(fig_type, width='stretch')
     
-    # Tabla de datos
-    st.subheader("Datos de Productos con Clusters")
+    stability_panel()
     
-    # Filtros
-    col1, col2 = st.columns(2)
-    with col1:
-        selected_clusters = st.multiselect(
-            "Filtrar por Clusters",
-            options=sorted(product_metrics['cluster_producto'].unique()),
-            default=sorted(product_metrics['cluster_producto'].unique())
-        )
-    
-    with col2:
-        selected_item_types = st.multiselect(
-            "Filtrar por Tipo de Producto",
-            options=product_metrics['Item_Type'].unique().tolist(),
-            default=product_metrics['Item_Type'].unique().tolist()
+    product_table()
+
+st.navigation([
+    st.Page(view_product_clusters, title="Vista 1: Clusters de Productos", icon="🎯", url_path='productos', default=True),
+    st.Page(view_store_mix, title="Vista 2: Mezcla por Tienda", icon="🏪", url_path='tiendas'),
+    st.Page(view_details, title="Análisis Detallado", icon="📈", url_path='detalle')
+], position='top').run()
+
+# Panel de depuración: métricas por etapa de esta ejecución
+if debug_mode:
+    with st.expander("🛠️ Depuración: métricas por etapa", expanded=True):
+        st.markdown("**Etapas de esta ejecución** (las llamadas en caché miden solo la consulta)")
+        st.dataframe(pd.DataFrame(recorder.records), width='stretch')
+
+        if tree_solutions is not None:
+            tree = tree_solutions.tree
+            st.markdown(
+                f"**Árbol jerárquico** ({tree['source']}): {tree['n_samples']:,} productos, "
+                f"enlace {tree['linkage']} con {tree['n_neighbors']} vecinos, "
+                f"{tree['timing']['wall_s']:.2f} s de cálculo"
+            )
+
+        st.markdown("**Soluciones de clustering precalculadas por k**")
+        st.dataframe(
+            pd.DataFrame([
+                {'k': k, 'ready': active_solutions.is_ready(k), **active_solutions.timings.get(k, {})}
+                for k in active_solutions.k_values
+            ]),
+            width='stretch'
         )
-    
-    filtered_data = product_metrics[
-        (product_metrics['cluster_producto'].isin(selected_clusters)) &
-        (product_metrics['Item_Type'].isin(selected_item_types))
-    ]
-    
-    st.dataframe(
-        filtered_data[['Item_Identifier', 'Item_Type', 'cluster_producto', 
-                      'Total_Sales', 'Avg_MRP', 'Num_Stores', 'Avg_Sales_Per_Store']],
-        use_container_width=True,
-        height=400
-    )
-    
-    # Descargar datos
-    csv = filtered_data.to_csv(index=False)
-    st.download_button(
-        label=" Descargar Datos Filtrados (CSV)",
-        data=csv,
-        file_name=f"productos_clusters_{pd.Timestamp.now().strftime('%Y%m%d')}.csv",
-        mime="text/csv"
-    )
+
+        if sweep is not None:
+            st.markdown("**Barrido de k**")
+            st.dataframe(
+                pd.DataFrame([{'k': k, **timing} for k, timing in sweep['timings'].items()]),
+                width='stretch'
+            )
 
 # Footer
 st.markdown("---")
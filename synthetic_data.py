@@ -0,0 +1,189 @@
+"""
+Generador de datos sintéticos de ventas Big Mart
+Produce un CSV con el mismo esquema que train_v9rqX0R.csv a la escala que
+se quiera (de miles a decenas de millones de filas), con un número
+configurable de productos y tiendas. Reproduce los patrones del dataset
+original: prefijos FD/DR/NC según el tipo de producto, variantes de
+Item_Fat_Content (LF, low fat, reg), visibilidad 0 en parte de las filas,
+tiendas sin Item_Weight y tiendas sin Outlet_Size.
+
+Uso:
+    python synthetic_data.py --rows 1000000 --items 20000 --outlets 50 --output ventas_1m.csv
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Tipos de producto por prefijo de identificador (como en el dataset original)
+ITEM_TYPES_BY_PREFIX = {
+    'FD': ['Fruits and Vegetables', 'Snack Foods', 'Frozen Foods', 'Dairy', 'Canned',
+           'Baking Goods', 'Meat', 'Breads', 'Starchy Foods', 'Breakfast', 'Seafood'],
+    'DR': ['Soft Drinks', 'Hard Drinks', 'Dairy'],
+    'NC': ['Household', 'Health and Hygiene', 'Others']
+}
+PREFIX_WEIGHTS = [0.72, 0.09, 0.19]
+
+# Variantes de Item_Fat_Content y su frecuencia en el dataset original
+FAT_CONTENT_VARIANTS = {
+    'Low Fat': ['Low Fat', 'LF', 'low fat'],
+    'Regular': ['Regular', 'reg']
+}
+FAT_CONTENT_NOISE = 0.07
+
+OUTLET_TYPES = ['Supermarket Type1', 'Supermarket Type2', 'Supermarket Type3', 'Grocery Store']
+OUTLET_TYPE_WEIGHTS = [0.6, 0.1, 0.1, 0.2]
+# Factor de ventas por tipo de tienda (las tiendas de barrio venden menos)
+OUTLET_TYPE_SALES_FACTOR = {
+    'Supermarket Type1': 16.0,
+    'Supermarket Type2': 14.0,
+    'Supermarket Type3': 24.0,
+    'Grocery Store': 2.5
+}
+OUTLET_SIZES = ['Small', 'Medium', 'High']
+LOCATION_TYPES = ['Tier 1', 'Tier 2', 'Tier 3']
+
+# Fracción de tiendas sin Item_Weight y sin Outlet_Size (por tienda completa)
+MISSING_WEIGHT_OUTLETS = 0.2
+MISSING_SIZE_OUTLETS = 0.3
+
+# Fracción de filas con Item_Visibility 0
+ZERO_VISIBILITY = 0.06
+
+DEFAULT_CHUNKSIZE = 1_000_000
+RANDOM_STATE = 42
+
+
+def make_items(n_items, rng):
+    """Catálogo de productos con sus atributos fijos"""
+    prefixes = rng.choice(list(ITEM_TYPES_BY_PREFIX), size=n_items, p=PREFIX_WEIGHTS)
+    item_types = np.empty(n_items, dtype=object)
+    for prefix, types in ITEM_TYPES_BY_PREFIX.items():
+        mask = prefixes == prefix
+        item_types[mask] = rng.choice(types, size=mask.sum())
+
+    # Identificadores únicos con el formato del original (FDA15, DRC01, ...)
+    positions = rng.permutation(n_items)
+    identifiers = [
+        f'{prefix}{chr(65 + pos % 26)}{pos // 26:02d}'
+        for prefix, pos in zip(prefixes, positions)
+    ]
+
+    fat_content = np.where(rng.random(n_items) < 0.64, 'Low Fat', 'Regular').astype(object)
+    fat_content[prefixes == 'NC'] = 'Low Fat'
+
+    return pd.DataFrame({
+        'Item_Identifier': identifiers,
+        'Item_Weight': np.round(rng.uniform(4.5, 21.5, n_items), 3),
+        'Item_Fat_Content': fat_content,
+        'Item_Type': item_types,
+        'Base_MRP': rng.uniform(31.0, 267.0, n_items),
+        'Base_Visibility': rng.gamma(2.0, 0.03, n_items)
+    })
+
+
+def _some_outlets(n_outlets, fraction, rng):
+    """Posiciones de round(n_outlets * fraction) tiendas (al menos una)"""
+    n = min(n_outlets, max(1, int(round(n_outlets * fraction))))
+    return rng.choice(n_outlets, size=n, replace=False)
+
+
+def make_outlets(n_outlets, rng):
+    """Tiendas con sus atributos y los patrones de faltantes por tienda"""
+    outlet_types = rng.choice(OUTLET_TYPES, size=n_outlets, p=OUTLET_TYPE_WEIGHTS)
+    sizes = rng.choice(OUTLET_SIZES, size=n_outlets).astype(object)
+    sizes[_some_outlets(n_outlets, MISSING_SIZE_OUTLETS, rng)] = np.nan
+    missing_weight = np.zeros(n_outlets, dtype=bool)
+    missing_weight[_some_outlets(n_outlets, MISSING_WEIGHT_OUTLETS, rng)] = True
+    return pd.DataFrame({
+        'Outlet_Identifier': [f'OUT{i:03d}' for i in rng.choice(max(1000, n_outlets), n_outlets, replace=False)],
+        'Outlet_Establishment_Year': rng.integers(1985, 2010, n_outlets),
+        'Outlet_Size': sizes,
+        'Outlet_Location_Type': rng.choice(LOCATION_TYPES, size=n_outlets),
+        'Outlet_Type': outlet_types,
+        'Missing_Weight': missing_weight
+    })
+
+
+def make_rows(items, outlets, n_rows, rng):
+    """Filas de ventas para un bloque de n_rows"""
+    item_idx = rng.integers(0, len(items), n_rows)
+    outlet_idx = rng.integers(0, len(outlets), n_rows)
+
+    fat_content = items['Item_Fat_Content'].to_numpy()[item_idx].copy()
+    # Variantes de escritura (LF, low fat, reg) en parte de las filas
+    noisy = np.flatnonzero(rng.random(n_rows) < FAT_CONTENT_NOISE)
+    for canonical, variants in FAT_CONTENT_VARIANTS.items():
+        rows = noisy[fat_content[noisy] == canonical]
+        fat_content[rows] = rng.choice(variants[1:], size=len(rows))
+
+    weight = items['Item_Weight'].to_numpy()[item_idx]
+    weight = np.where(outlets['Missing_Weight'].to_numpy()[outlet_idx], np.nan, weight)
+
+    visibility = items['Base_Visibility'].to_numpy()[item_idx] * rng.uniform(0.7, 1.3, n_rows)
+    visibility[rng.random(n_rows) < ZERO_VISIBILITY] = 0.0
+
+    mrp = items['Base_MRP'].to_numpy()[item_idx] + rng.normal(0, 1.5, n_rows)
+    outlet_types = outlets['Outlet_Type'].to_numpy()[outlet_idx]
+    factor = pd.Series(outlet_types).map(OUTLET_TYPE_SALES_FACTOR).to_numpy()
+    sales = mrp * factor * rng.lognormal(0.0, 0.5, n_rows)
+
+    return pd.DataFrame({
+        'Item_Identifier': items['Item_Identifier'].to_numpy()[item_idx],
+        'Item_Weight': weight,
+        'Item_Fat_Content': fat_content,
+        'Item_Visibility': np.round(visibility, 9),
+        'Item_Type': items['Item_Type'].to_numpy()[item_idx],
+        'Item_MRP': np.round(mrp, 4),
+        'Outlet_Identifier': outlets['Outlet_Identifier'].to_numpy()[outlet_idx],
+        'Outlet_Establishment_Year': outlets['Outlet_Establishment_Year'].to_numpy()[outlet_idx],
+        'Outlet_Size': outlets['Outlet_Size'].to_numpy()[outlet_idx],
+        'Outlet_Location_Type': outlets['Outlet_Location_Type'].to_numpy()[outlet_idx],
+        'Outlet_Type': outlet_types,
+        'Item_Outlet_Sales': np.round(sales, 4)
+    })
+
+
+def default_items(n_rows):
+    """Número de productos proporcional al dataset original (~5.5 filas por producto)"""
+    return max(50, int(n_rows / 5.5))
+
+
+def generate(path, n_rows, n_items=None, n_outlets=10, random_state=RANDOM_STATE,
+             chunksize=DEFAULT_CHUNKSIZE):
+    """Escribir en `path` un CSV sintético de n_rows filas
+
+    Las filas se generan y escriben por bloques, así que la memoria no
+    depende de n_rows. Devuelve la ruta del archivo.
+    """
+    if n_items is None:
+        n_items = default_items(n_rows)
+    rng = np.random.default_rng(random_state)
+    items = make_items(n_items, rng)
+    outlets = make_outlets(n_outlets, rng)
+
+    for start in range(0, n_rows, chunksize):
+        rows = make_rows(items, outlets, min(chunksize, n_rows - start), rng)
+        rows.to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generar datos sintéticos de ventas Big Mart")
+    parser.add_argument('--rows', type=int, default=100_000, help="Número de filas de ventas")
+    parser.add_argument('--items', type=int, default=None,
+                        help="Número de productos (por defecto ~1 por cada 5.5 filas)")
+    parser.add_argument('--outlets', type=int, default=10, help="Número de tiendas")
+    parser.add_argument('--seed', type=int, default=RANDOM_STATE, help="Semilla aleatoria")
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help="Filas generadas y escritas por bloque")
+    parser.add_argument('--output', default='synthetic_sales.csv', help="Archivo CSV de salida")
+    args = parser.parse_args()
+
+    generate(args.output, args.rows, args.items, args.outlets, args.seed, args.chunksize)
+    print(f"✓ {args.rows:,} filas escritas en {args.output}")
+
+
+if __name__ == '__main__':
+    main()
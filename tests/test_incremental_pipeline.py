@@ -0,0 +1,84 @@
+"""
+Ejecución completa, --append, nueva ejecución completa y ejecución por bloques
+(--chunksize) de prepare_powerbi_data.py sobre una copia del proyecto en un
+directorio temporal
+"""
+
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+DATA_FILE = 'train_v9rqX0R.csv'
+DELTA_ROWS = 50
+
+PRODUCT_FILE = 'product_metrics_with_clusters.csv'
+STORE_FILE = 'store_analysis_with_clusters.csv'
+ROWS_FILE = 'original_data_with_clusters.csv'
+
+
+def run_pipeline(workdir, *args):
+    return subprocess.run(
+        [sys.executable, 'prepare_powerbi_data.py', '--stability-resamples', '0', '--k-max', '4', *args],
+        cwd=workdir, capture_output=True, text=True
+    )
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    """Copia de los módulos con el CSV sin sus últimas filas, que forman el delta"""
+    for module in ROOT.glob('*.py'):
+        shutil.copy(module, tmp_path)
+    sales = pd.read_csv(ROOT / DATA_FILE)
+    sales.iloc[:-DELTA_ROWS].to_csv(tmp_path / DATA_FILE, index=False)
+    sales.iloc[-DELTA_ROWS:].to_csv(tmp_path / 'delta.csv', index=False)
+    return tmp_path
+
+
+def test_full_run_after_append_keeps_the_delta(workdir):
+    assert run_pipeline(workdir).returncode == 0
+    result = run_pipeline(workdir, '--append', 'delta.csv', '--drift-threshold', '0.5')
+    assert result.returncode == 0, result.stderr
+    appended = pd.read_csv(workdir / STORE_FILE).set_index('Outlet_Identifier')
+
+    result = run_pipeline(workdir)
+    assert result.returncode == 0, result.stderr
+
+    # La ejecución completa incluye las filas del delta, igual que la incremental
+    sales = pd.read_csv(ROOT / DATA_FILE)
+    assert len(pd.read_csv(workdir / ROWS_FILE)) == len(sales)
+    stores = pd.read_csv(workdir / STORE_FILE).set_index('Outlet_Identifier')
+    assert np.allclose(stores['Total_Sales'], appended.loc[stores.index, 'Total_Sales'])
+    expected = sales.groupby('Item_Identifier')['Item_Outlet_Sales'].sum()
+    products = pd.read_csv(workdir / PRODUCT_FILE).set_index('Item_Identifier')
+    assert np.allclose(products['Total_Sales'], expected.loc[products.index], rtol=1e-5)
+
+
+def test_changed_outputs_stop_the_run(workdir):
+    assert run_pipeline(workdir).returncode == 0
+    edited = (workdir / STORE_FILE).read_text() + '\n'
+    (workdir / STORE_FILE).write_text(edited)
+
+    result = run_pipeline(workdir)
+    assert result.returncode == 1
+    assert '--rerun export' in result.stdout
+    assert (workdir / STORE_FILE).read_text() == edited
+
+    assert run_pipeline(workdir, '--rerun', 'export').returncode == 0
+    assert (workdir / STORE_FILE).read_text() != edited
+
+
+def test_chunked_run_matches_full_run(workdir):
+    assert run_pipeline(workdir, '--output-dir', 'full').returncode == 0
+    result = run_pipeline(workdir, '--output-dir', 'chunked', '--chunksize', '1000', '--no-stage-cache')
+    assert result.returncode == 0, result.stderr
+
+    for name in (PRODUCT_FILE, STORE_FILE, 'store_cluster_analysis.csv', ROWS_FILE):
+        pd.testing.assert_frame_equal(
+            pd.read_csv(workdir / 'full' / name), pd.read_csv(workdir / 'chunked' / name), rtol=1e-6
+        )